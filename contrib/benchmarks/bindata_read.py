@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Benchmark of the read modes of BaseCollector.file_data().
+
+Usage:
+
+    python bindata_read.py [size_in_MiB] [chunk_size]
+
+A temporary file of the given size is created and hashed once with each
+read mode. Each read mode runs in a separate process, so that the reported
+peak memory (maximum resident set size) belongs to that read mode only.
+
+Note that in 'mmap' mode the resident set size includes the mapped pages
+of the file, which belong to the page cache and can be reclaimed by the
+kernel at any time.
+
+"""
+
+import sys
+import os
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/')] + sys.path
+
+from TinyIDS.collector import BaseCollector, READ_MODES, DEFAULT_CHUNK_SIZE
+from TinyIDS.util import sha1
+
+
+def run_mode(read_mode, path, chunk_size):
+    """Hashes the file at path and prints: <digest> <seconds> <maxrss_kb>"""
+    conf_fd, conf_path = tempfile.mkstemp(suffix='.conf')
+    os.write(conf_fd, '[main]\nread_mode = %s\nchunk_size = %s\n' % (read_mode, chunk_size))
+    os.close(conf_fd)
+    try:
+        b = BaseCollector(config_path=conf_path)
+    finally:
+        os.remove(conf_path)
+    hasher = sha1()
+    t0 = time.time()
+    for data in b.file_data(path):
+        hasher.update(data)
+    elapsed = time.time() - t0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%s %f %d' % (hasher.hexdigest(), elapsed, maxrss)
+
+
+def main():
+    size_mb = 256
+    chunk_size = DEFAULT_CHUNK_SIZE
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        chunk_size = int(sys.argv[2])
+
+    fd, path = tempfile.mkstemp(suffix='.bin')
+    try:
+        block = os.urandom(1048576)
+        for i in range(size_mb):
+            os.write(fd, block)
+        os.close(fd)
+        size = os.path.getsize(path)
+
+        print 'File size: %d MiB, chunk size: %d bytes' % (size_mb, chunk_size)
+        print '%-8s %12s %14s  %s' % ('mode', 'MiB/sec', 'peak RSS (KiB)', 'digest')
+        for read_mode in READ_MODES:
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                '--child', read_mode, path, str(chunk_size)], stdout=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+            digest, elapsed, maxrss = stdout.split()
+            rate = (size / 1048576.0) / max(float(elapsed), 1e-6)
+            print '%-8s %12.1f %14s  %s' % (read_mode, rate, maxrss, digest)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        run_mode(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main()
@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Micro-benchmark of the digest algorithms available on this machine.
+
+Usage:
+
+    python digest_algorithms.py [size_in_MiB] [algorithm ...]
+
+Hashes the given amount of random data in 1 MiB updates with each
+algorithm and reports the throughput. If no algorithms are given, all
+commonly used algorithms that are available are benchmarked. The cost
+of the migration mode can be measured by giving two algorithms joined
+with '+', for example: sha1+blake2b
+
+"""
+
+import sys
+import os
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/')] + sys.path
+
+from TinyIDS.util import MultiHasher, UnsupportedAlgorithmError
+
+
+DEFAULT_ALGORITHMS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512',
+    'blake2b', 'blake2s', 'sha3_256', 'sha3_512', 'sha1+sha256', 'sha1+blake2b')
+
+
+def main():
+    size_mb = 256
+    algorithms = DEFAULT_ALGORITHMS
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        algorithms = sys.argv[2:]
+
+    block = os.urandom(1048576)
+    print 'Data size: %d MiB' % size_mb
+    print '%-16s %12s' % ('algorithm', 'MiB/sec')
+    for name in algorithms:
+        try:
+            hasher = MultiHasher(name.split('+'))
+        except UnsupportedAlgorithmError:
+            print '%-16s %12s' % (name, 'unavailable')
+            continue
+        t0 = time.time()
+        for i in xrange(size_mb):
+            hasher.update(block)
+        hasher.hexdigest()
+        elapsed = max(time.time() - t0, 1e-6)
+        print '%-16s %12.1f' % (name, size_mb / elapsed)
+
+
+if __name__ == '__main__':
+    main()
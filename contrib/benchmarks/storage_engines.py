@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Micro-benchmark of the storage engines of the hash database.
+
+Usage:
+
+    python storage_engines.py [records] [engine ...]
+
+Creates a database with the given number of client records (default:
+100000) in a temporary directory with each engine, using the record format
+of HashDatabase, and reports the throughput of:
+
+    load    - storage.migrate() of all records (batched writes)
+    get     - HashDatabase.get() of random existing clients
+    miss    - HashDatabase.get() of clients that do not exist
+    update  - HashDatabase.put() of random existing clients, as if they
+              were sent by many clients at once: the changes are committed
+              to the disk together at the end (see HashDatabase.commit())
+
+If no engines are given, all engines that are available are benchmarked.
+For example, to compare the engines at one million records:
+
+    python storage_engines.py 1000000 gdbm sqlite
+
+"""
+
+import sys
+import os
+import time
+import random
+import shutil
+import tempfile
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/')] + sys.path
+
+from TinyIDS import database
+from TinyIDS.record import pack_ip, pack_record
+from TinyIDS.storage import STORAGE_ENGINES, migrate
+from TinyIDS.util import sha1sum
+
+
+LOOKUPS = 20000
+PASSPHRASE = 'benchmark'
+
+
+def client_ip(i):
+    return '10.%d.%d.%d' % ((i >> 16) & 255, (i >> 8) & 255, i & 255)
+
+
+class RecordSource:
+    """Generates the records of 'count' clients as the storage engines
+    store them."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def iteritems(self):
+        for i in xrange(self.count):
+            ip = client_ip(i)
+            yield pack_ip(ip), pack_record({'sha1': sha1sum(ip)}, {}, sha1sum(ip + PASSPHRASE), 0, 0)
+
+
+def rate(count, elapsed):
+    return count / max(elapsed, 1e-6)
+
+
+def benchmark(engine, count, directory):
+    db = database.HashDatabase(os.path.join(directory, 'tinyids-%s.db' % engine), engine)
+    try:
+        db.database_activate()
+    except database.InitializationError, strerror:
+        print '%-8s %s' % (engine, strerror)
+        return
+    try:
+        t0 = time.time()
+        migrate(RecordSource(count), db.db)
+        load = rate(count, time.time() - t0)
+
+        lookups = min(LOOKUPS, count)
+        ips = [client_ip(random.randrange(count)) for i in xrange(lookups)]
+        t0 = time.time()
+        for ip in ips:
+            db.get(ip)
+        get = rate(lookups, time.time() - t0)
+
+        t0 = time.time()
+        for i in xrange(lookups):
+            try:
+                db.get('192.168.%d.%d' % (i >> 8 & 255, i & 255))
+            except database.HashDoesNotExistError:
+                pass
+        miss = rate(lookups, time.time() - t0)
+
+        db.autocommit = False
+        t0 = time.time()
+        for ip in ips:
+            db.put(ip, sha1sum(ip + 'new'), PASSPHRASE)
+        db.commit()
+        db.db.sync()
+        update = rate(lookups, time.time() - t0)
+    finally:
+        db.database_close()
+    print '%-8s %12.0f %12.0f %12.0f %12.0f' % (engine, load, get, miss, update)
+
+
+def main():
+    count = 100000
+    engines = sorted(STORAGE_ENGINES.keys())
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        engines = sys.argv[2:]
+
+    directory = tempfile.mkdtemp(prefix='tinyids-benchmark-')
+    try:
+        print 'Records: %d' % count
+        print '%-8s %12s %12s %12s %12s' % ('engine', 'load/sec', 'get/sec', 'miss/sec', 'update/sec')
+        for engine in engines:
+            benchmark(engine, count, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
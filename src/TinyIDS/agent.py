@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import time
+import errno
+import random
+import socket
+import signal
+import logging
+import threading
+import SocketServer
+
+from TinyIDS.collector import FileScan
+from TinyIDS.util import format_digest_vector
+
+
+DEFAULT_AGENT_SOCKET = '/var/run/tinyids-agent.sock'
+DEFAULT_AGENT_INTERVAL = 3600   # seconds
+DEFAULT_AGENT_JITTER = 10       # percent of the interval
+AGENT_QUERY_TIMEOUT = 5         # seconds
+
+
+logger = logging.getLogger()
+
+
+class AgentConfigurationError(Exception):
+    pass
+
+class AgentQueryError(Exception):
+    pass
+
+
+def query_agent(socket_path, backends=None, timeout=AGENT_QUERY_TIMEOUT):
+    """Retrieves the latest result of a running agent.
+
+    Accepts the path to the agent socket and an optional list of backend
+    names. Returns the output of util.format_digest_vector(): the checksum
+    and the digests of all backends or, if backend names have been
+    provided, only the digests of these backends.
+
+    If the agent cannot be reached or has no result yet, raises
+    AgentQueryError.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+            request = 'GET'
+            if backends:
+                request = 'GET %s' % ','.join(backends)
+            sock.sendall(request + TinyIDSAgentHandler.cmd_end)
+            f = sock.makefile('rb')
+            try:
+                response = f.readline(TinyIDSAgentHandler.max_data_len).strip()
+            finally:
+                f.close()
+        except socket.error, strerror:
+            raise AgentQueryError(str(strerror))
+    finally:
+        sock.close()
+    status, sep, data = response.partition(' ')
+    if status != 'OK':
+        raise AgentQueryError(data or 'Invalid response')
+    return data
+
+
+class TinyIDSAgentHandler(SocketServer.StreamRequestHandler):
+    """Handles the queries of the local agent socket.
+
+    Syntax: GET [<backend_name>[,<backend_name>...]]
+
+    Response: OK <digest_vector> | ERR <message>
+
+    """
+
+    max_data_len = 8192
+    cmd_end = '\r\n'
+
+    def handle(self):
+        data = self.rfile.readline(self.max_data_len).strip()
+        parts = data.split()
+        if not parts or parts[0].upper() != 'GET' or len(parts) > 2:
+            response = 'ERR Invalid command'
+        else:
+            backends = None
+            if len(parts) == 2:
+                backends = [name for name in parts[1].split(',') if name]
+            try:
+                response = 'OK %s' % self.server.agent.get_result(backends)
+            except AgentQueryError, strerror:
+                response = 'ERR %s' % strerror
+        self.wfile.write(response + self.cmd_end)
+
+
+class TinyIDSAgentServer(SocketServer.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, agent):
+        self.agent = agent
+        SocketServer.ThreadingUnixStreamServer.__init__(self, socket_path, TinyIDSAgentHandler)
+
+
+class TinyIDSAgent:
+    """A resident client that runs each backend periodically.
+
+    The backends are loaded once and kept in memory together with their
+    configuration and caches (for example, the watched files and the digest
+    cache). Each backend runs in its own thread every 'interval' seconds.
+    A random jitter of up to 'jitter' percent of the interval is added to
+    each interval, so that the runs of many hosts do not coincide. After
+    each run, the digest of the backend is checked with the servers using
+    a partial CHECK.
+
+    The latest results can be retrieved through a local Unix socket (see
+    query_agent()), so that 'tinyids --check' does not have to hash the
+    data again.
+
+    Configuration:
+
+    [agent]
+    socket = /var/run/tinyids-agent.sock
+    interval = 3600
+    intervals = network:60, kernel:300, bindata:86400
+    jitter = 10
+
+    """
+
+    def __init__(self, client):
+        """Accepts a TinyIDSClient instance, which is used in order to load
+        the backends, hash the collected information and contact the
+        servers.
+
+        On invalid configuration, raises AgentConfigurationError.
+
+        """
+        self.client = client
+        if not client.per_backend_digests:
+            raise AgentConfigurationError('The agent requires per_backend_digests')
+        cfg = client.cfg
+        self.socket_path = cfg.get_or_default('agent', 'socket', DEFAULT_AGENT_SOCKET)
+        self.default_interval = self._get_seconds(
+            cfg.get_or_default('agent', 'interval', str(DEFAULT_AGENT_INTERVAL)), 'interval')
+        self.jitter = self._get_seconds(
+            cfg.get_or_default('agent', 'jitter', str(DEFAULT_AGENT_JITTER)), 'jitter', allow_zero=True) / 100.0
+        self.intervals = {}
+        if cfg.has_option('agent', 'intervals'):
+            for item in cfg.getlist('agent', 'intervals'):
+                name, sep, value = item.partition(':')
+                if not sep:
+                    raise AgentConfigurationError('Invalid interval: %s' % item)
+                self.intervals[name.strip()] = self._get_seconds(value, 'interval of %s' % name.strip())
+
+        # name : CollectorBackend instance
+        self.backends = {}
+        # name : time of the next run
+        self.next_run = {}
+        # name : (MultiHasher instance, time the run finished)
+        self.results = {}
+        # Names of the backends that are running
+        self.running = set()
+
+        self._lock = threading.Lock()
+        # Serializes the communication with the servers
+        self._report_lock = threading.Lock()
+        self._stop = threading.Event()
+        # Wakes up the scheduler
+        self._wakeup = threading.Event()
+        self.server = None
+
+    def _get_seconds(self, value, name, allow_zero=False):
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = -1
+        if seconds < 0 or (seconds == 0 and not allow_zero):
+            raise AgentConfigurationError('Invalid %s: %s' % (name, value))
+        return seconds
+
+    def _get_interval(self, name):
+        """Returns the interval until the next run of the backend, including
+        the random jitter."""
+        interval = self.intervals.get(name, self.default_interval)
+        return interval * (1 + random.uniform(0, self.jitter))
+
+    def _run_backend(self, name):
+        """Runs the backend, stores its digest and reports it to the servers."""
+        b = self.backends[name]
+        try:
+            try:
+                # The filesystem scan must not be reused between runs
+                b.scan = FileScan()
+                hasher = self.client._collect_backend((name, b))
+            except Exception, strerror:
+                logger.error('%s: Collection failed: %s' % (name, strerror))
+                return
+            self._lock.acquire()
+            try:
+                self.results[name] = (hasher, time.time())
+            finally:
+                self._lock.release()
+            self._report(name)
+        finally:
+            self._lock.acquire()
+            try:
+                self.running.discard(name)
+                self.next_run[name] = time.time() + self._get_interval(name)
+            finally:
+                self._lock.release()
+            self._wakeup.set()
+
+    def _report(self, name):
+        """Checks the latest digest of the backend with the servers."""
+        enabled_servers = self.client._get_enabled_server_list()
+        if not enabled_servers:
+            return
+        self._report_lock.acquire()
+        try:
+            self.client.checksum = self.get_result([name])
+            try:
+                self.client._contact_servers(enabled_servers)
+            finally:
+                self.client.checksum = None
+        finally:
+            self._report_lock.release()
+
+    def _start_server(self):
+        """Starts the thread that serves queries on the Unix socket."""
+        if os.path.exists(self.socket_path):
+            # Remove a stale socket, unless another agent accepts connections
+            # on it. A running agent may not have any results yet, so the
+            # socket is only considered stale if the connection fails.
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(AGENT_QUERY_TIMEOUT)
+            try:
+                try:
+                    sock.connect(self.socket_path)
+                except socket.error, (err, strerror):
+                    if err not in (errno.ECONNREFUSED, errno.ENOENT):
+                        raise AgentConfigurationError('Cannot check the agent socket %s: %s' % (
+                            self.socket_path, strerror))
+                    if err == errno.ECONNREFUSED:
+                        os.remove(self.socket_path)
+                else:
+                    raise AgentConfigurationError('Another agent is running: %s' % self.socket_path)
+            finally:
+                sock.close()
+        old_umask = os.umask(077)
+        try:
+            self.server = TinyIDSAgentServer(self.socket_path, self)
+        finally:
+            os.umask(old_umask)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        logger.info('Agent listening on: %s' % self.socket_path)
+
+    def _SIGTERM_handler(self, signo, frame):
+        logger.info('Caught TERM signal')
+        self.stop()
+
+    # Public API
+
+    def get_result(self, backends=None):
+        """Returns the latest result as the output of
+        util.format_digest_vector().
+
+        If a list of backend names is provided, only the digests of these
+        backends are returned. Otherwise, the checksum is calculated from
+        the latest digests of all backends and is returned together with
+        them.
+
+        If a backend has not completed a run yet, raises AgentQueryError.
+
+        """
+        self._lock.acquire()
+        try:
+            names = backends or self.backends.keys()
+            digests = {}
+            for name in names:
+                if not self.backends.has_key(name):
+                    raise AgentQueryError('Unknown backend: %s' % name)
+                if not self.results.has_key(name):
+                    raise AgentQueryError('No result yet: %s' % name)
+                digests[name] = self.results[name][0]
+        finally:
+            self._lock.release()
+        backend_digests = [(name, hasher.hexdigest()) for name, hasher in digests.items()]
+        if backends:
+            return format_digest_vector(None, backend_digests)
+        checksum = self.client._combine_backend_digests(digests).hexdigest()
+        return format_digest_vector(checksum, backend_digests)
+
+    def run(self):
+        """Loads the backends and runs them until stop() is called or a TERM
+        or INT signal is caught.
+
+        Each backend runs once at startup. Raises NoBackendsToRun if there
+        are no backends.
+
+        """
+        self.backends = dict(self.client._load_backends())
+        self.client._set_priority()
+        now = time.time()
+        for name in self.backends.keys():
+            # The jitter only applies to the subsequent runs
+            self.next_run[name] = now
+            logger.info('%s: Runs every %s seconds' % (name, self.intervals.get(name, self.default_interval)))
+        self._start_server()
+        signal.signal(signal.SIGTERM, self._SIGTERM_handler)
+        signal.signal(signal.SIGINT, self._SIGTERM_handler)
+        try:
+            while not self._stop.isSet():
+                self._wakeup.clear()
+                self._lock.acquire()
+                try:
+                    now = time.time()
+                    due = [name for name, t in self.next_run.items() if t <= now and name not in self.running]
+                    for name in due:
+                        self.running.add(name)
+                    waiting = [t for name, t in self.next_run.items() if name not in self.running]
+                finally:
+                    self._lock.release()
+                for name in sorted(due):
+                    t = threading.Thread(target=self._run_backend, args=(name,))
+                    t.setDaemon(True)
+                    t.start()
+                timeout = 60
+                if waiting:
+                    timeout = min(max(min(waiting) - time.time(), 0.01), timeout)
+                self._wakeup.wait(timeout)
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            try:
+                os.remove(self.socket_path)
+            except OSError, (err, strerror):
+                if err != errno.ENOENT:
+                    logger.warning('Cannot remove the agent socket: %s' % strerror)
+        self.client.close_connections()
+        logger.info('Agent stopped')
+
@@ -25,7 +25,8 @@
 
 import sys
 
-from TinyIDS.collector import BaseCollector
+from TinyIDS.collector import BaseCollector, BackendConfigurationError
+from TinyIDS.util import DEFAULT_DIGEST_ALGORITHM
 
 
 DEFAULT_GLOB_EXP = (
@@ -46,16 +47,39 @@ class CollectorBackend(BaseCollector):
     
     name = __name__
     
+    def _get_hash_mode(self):
+        """Returns the hash mode: 'content' or 'digest'.
+        
+        In 'content' mode the contents of all files are passed through the
+        hashing algorithm. In 'digest' mode the digest of each file is
+        calculated separately, possibly by several hashing workers, and only
+        the digests are passed through the hashing algorithm in sorted path
+        order. The two modes produce different checksums.
+        
+        """
+        hash_mode = self.cfg.get_or_default('main', 'hash_mode', 'content').lower()
+        if hash_mode not in ('content', 'digest'):
+            raise BackendConfigurationError('Invalid hash mode: %s' % hash_mode)
+        return hash_mode
+    
     def collect(self):
+        if self._get_hash_mode() == 'digest':
+            # Digests are hashed in canonical path order. Each algorithm
+            # hashes the file digests of the same algorithm.
+            for path, digests in self.file_results(DEFAULT_GLOB_EXP, self.file_digests, sort=True):
+                yield dict([(algorithm, '%s\n' % digest) for algorithm, digest in digests.items()])
+            return
+        if self.cfg.has_option('main', 'digest_cache') and self.cfg.getboolean('main', 'digest_cache'):
+            self.logger.warning('%s: The digest cache requires: hash_mode = digest' % self.name)
         for path in self.file_paths(DEFAULT_GLOB_EXP):
             #print 'checking: %s' % path
-            f = open(path, 'rb')
-            data = f.read()
-            yield data
-            f.close()
+            for data in self.file_data(path):
+                yield data
 
 if __name__ == '__main__':
     for data in CollectorBackend().collect():
+        if isinstance(data, dict):
+            data = data[DEFAULT_DIGEST_ALGORITHM]
         sys.stdout.write(data)
     sys.stdout.flush()
 
@@ -24,7 +24,6 @@
 #
 
 import sys
-import os
 
 from TinyIDS.collector import BaseCollector
 
@@ -47,11 +46,15 @@ class CollectorBackend(BaseCollector):
     
     name = __name__
     
-    def collect(self):
-        for path in self.file_paths(DEFAULT_GLOB_EXP):
+    def _metadata(self, paths, complete=True):
+        for path in paths:
             #print 'checking: %s' % path
-            fst = os.stat(path)
+            fst = self.file_stat(path)
             data = '%s %s %s %s %s %s %s\n' % (path, fst.st_mode, fst.st_ino, fst.st_uid, fst.st_gid, fst.st_size, fst.st_mtime)
+            yield path, data
+    
+    def collect(self):
+        for path, data in self.file_results(DEFAULT_GLOB_EXP, self._metadata):
             yield data
 
 if __name__ == '__main__':
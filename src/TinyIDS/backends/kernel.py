@@ -24,8 +24,10 @@
 #
 
 import sys
+import os
+import glob
 
-from TinyIDS.collector import BaseCollector
+from TinyIDS.collector import BaseCollector, BackendConfigurationError
 
 
 DEFAULT_COMMANDS = [
@@ -33,15 +35,109 @@ DEFAULT_COMMANDS = [
     '/sbin/lsmod',
 ]
 
+SOURCES = ('commands', 'native')
+DEFAULT_SOURCE = 'commands'
+
+PROC_MODULES = '/proc/modules'
+PROC_TAINTED = '/proc/sys/kernel/tainted'
+PROC_SYS = '/proc/sys'
+SYS_MODULE_TAINT_GLOB = '/sys/module/*/taint'
+
 
 class CollectorBackend(BaseCollector):
     
     name = __name__
     
+    def _read_file(self, path):
+        """Returns the stripped contents of a file or None if the file
+        does not exist."""
+        try:
+            f = open(path)
+        except IOError:
+            return None
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    
+    def _modules(self):
+        """Returns the loaded modules as read from /proc/modules.
+        
+        The use count and the load address of each module change without
+        the module itself changing, so they are left out. The modules are
+        sorted by name, so that the load order does not matter. Each line
+        has the format:
+        
+          <name> <size> <dependencies> <state> [<taint flags>]
+        
+        """
+        data = self._read_file(PROC_MODULES)
+        if not data:
+            return ''
+        lines = []
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) < 6:
+                continue
+            name, size, refcount, deps, state, address = fields[:6]
+            deps = ','.join(sorted([d for d in deps.split(',') if d and d != '-'])) or '-'
+            lines.append(' '.join([name, size, deps, state] + fields[6:]))
+        lines.sort()
+        return ''.join(['%s\n' % line for line in lines])
+    
+    def _module_taints(self):
+        """Returns the taint flags of each module from /sys/module."""
+        lines = []
+        for path in sorted(glob.glob(SYS_MODULE_TAINT_GLOB)):
+            taint = self._read_file(path)
+            if taint:
+                lines.append('%s %s\n' % (os.path.basename(os.path.dirname(path)), taint))
+        return ''.join(lines)
+    
+    def _sysctl_values(self):
+        """Returns the values of the kernel parameters that have been set in
+        the 'sysctl_keys' option."""
+        lines = []
+        keys = []
+        if self.cfg.has_option('main', 'sysctl_keys'):
+            keys = self.cfg.getlist('main', 'sysctl_keys')
+        for key in keys:
+            path = os.path.join(PROC_SYS, *key.split('.'))
+            value = self._read_file(path)
+            if value is None:
+                self.logger.warning('%s: Unknown kernel parameter: %s' % (self.name, key))
+                continue
+            lines.append('%s = %s\n' % (key, ' '.join(value.split())))
+        return ''.join(lines)
+    
+    def _tainted(self):
+        """Returns the taint flags of the kernel. If they cannot be read, a
+        warning is logged and the line is left out."""
+        tainted = self._read_file(PROC_TAINTED)
+        if tainted is None:
+            self.logger.warning('%s: Cannot read %s' % (self.name, PROC_TAINTED))
+            return ''
+        return 'tainted = %s\n' % tainted
+    
+    def _collect_native(self):
+        """Reads the kernel state directly from /proc and /sys."""
+        yield self._modules()
+        yield self._module_taints()
+        yield self._tainted()
+        yield self._sysctl_values()
+    
     def collect(self):
-        for args in self.command_args(DEFAULT_COMMANDS):
-            stdout = self.external_command(args)
-            yield '%s\n' % stdout
+        source = self.cfg.get_or_default('main', 'source', DEFAULT_SOURCE).lower()
+        if source not in SOURCES:
+            raise BackendConfigurationError('Invalid source: %s' % source)
+        if source == 'native':
+            for data in self._collect_native():
+                yield data
+            return
+        for chunks in self.command_streams(DEFAULT_COMMANDS):
+            for data in chunks:
+                yield data
+            yield '\n'
 
 if __name__ == '__main__':
     for data in CollectorBackend().collect():
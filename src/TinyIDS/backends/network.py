@@ -24,8 +24,12 @@
 #
 
 import sys
+import re
+import errno
+import socket
+import struct
 
-from TinyIDS.collector import BaseCollector
+from TinyIDS.collector import BaseCollector, BackendConfigurationError
 
 
 DEFAULT_COMMANDS = [
@@ -34,15 +38,163 @@ DEFAULT_COMMANDS = [
     #'ifconfig',
 ]
 
+DEFAULT_FIREWALL_COMMANDS = [
+    '/sbin/iptables-save',
+]
+
+SOURCES = ('commands', 'native')
+DEFAULT_SOURCE = 'commands'
+
+PROC_NET_TCP = {
+    socket.AF_INET: '/proc/net/tcp',
+    socket.AF_INET6: '/proc/net/tcp6',
+}
+
+TCP_LISTEN = 10
+
+# Netlink socket diagnostics (see sock_diag(7))
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLMSG_HEADER = struct.Struct('=IHHII')             # len, type, flags, seq, pid
+INET_DIAG_REQ_V2 = struct.Struct('=BBBxI48x')      # family, protocol, ext, states, id
+INET_DIAG_MSG = struct.Struct('=BBBB2s2s16s16s')   # family, state, timer, retrans, sport, dport, src, dst
+NETLINK_TIMEOUT = 5     # seconds
+
+# Volatile parts of firewall ruleset dumps
+RE_RULESET_COMMENT = re.compile(r'^#.*$\n?', re.M)
+RE_RULESET_COUNTERS = re.compile(r'\[\d+:\d+\]')
+RE_RULESET_JSON_COUNTERS = re.compile(r'"(packets|bytes)":\s*\d+')
+
+
+class NetlinkError(Exception):
+    pass
+
 
 class CollectorBackend(BaseCollector):
     
     name = __name__
     
+    def _format_socket(self, family, address, port):
+        return 'tcp %s %s\n' % (socket.inet_ntop(family, address), port)
+    
+    def _listening_sockets_netlink(self, family):
+        """Returns the listening TCP sockets of the address family.
+        
+        Uses a sock_diag netlink request, so that the kernel only returns the
+        sockets in the LISTEN state. If the kernel does not complete the
+        dump within NETLINK_TIMEOUT seconds, the request fails.
+        
+        On error, raises NetlinkError.
+        
+        """
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_SOCK_DIAG)
+        except (AttributeError, socket.error), strerror:
+            raise NetlinkError(strerror)
+        try:
+            # socket.timeout is a socket.error and raises NetlinkError too
+            sock.settimeout(NETLINK_TIMEOUT)
+            payload = INET_DIAG_REQ_V2.pack(family, socket.IPPROTO_TCP, 0, 1 << TCP_LISTEN)
+            header = NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload),
+                SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+            try:
+                sock.sendto(header + payload, (0, 0))
+            except socket.error, strerror:
+                raise NetlinkError(strerror)
+            lines = []
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except socket.error, strerror:
+                    raise NetlinkError(strerror)
+                pos = 0
+                while pos + NLMSG_HEADER.size <= len(data):
+                    length, msg_type, flags, seq, pid = NLMSG_HEADER.unpack_from(data, pos)
+                    if length < NLMSG_HEADER.size:
+                        raise NetlinkError('Invalid netlink message')
+                    if msg_type == NLMSG_DONE:
+                        return lines
+                    elif msg_type == NLMSG_ERROR:
+                        err = -struct.unpack_from('=i', data, pos + NLMSG_HEADER.size)[0]
+                        raise NetlinkError(errno.errorcode.get(err, err))
+                    elif msg_type == SOCK_DIAG_BY_FAMILY:
+                        (msg_family, state, timer, retrans, sport, dport,
+                            src, dst) = INET_DIAG_MSG.unpack_from(data, pos + NLMSG_HEADER.size)
+                        if state == TCP_LISTEN:
+                            if msg_family == socket.AF_INET:
+                                src = src[:4]
+                            port = struct.unpack('!H', sport)[0]
+                            lines.append(self._format_socket(msg_family, src, port))
+                    pos += (length + 3) & ~3
+        finally:
+            sock.close()
+    
+    def _listening_sockets_procfs(self, family):
+        """Returns the listening TCP sockets of the address family from
+        /proc/net/tcp or /proc/net/tcp6."""
+        lines = []
+        try:
+            f = open(PROC_NET_TCP[family])
+        except IOError:
+            return lines
+        try:
+            f.readline()    # Header
+            for line in f:
+                fields = line.split(None, 4)
+                if len(fields) < 4 or int(fields[3], 16) != TCP_LISTEN:
+                    continue
+                address, port = fields[1].split(':')
+                # The address is printed as 32-bit words in host byte order
+                address = ''.join([struct.pack('=I', int(address[i:i + 8], 16))
+                    for i in range(0, len(address), 8)])
+                lines.append(self._format_socket(family, address, int(port, 16)))
+        finally:
+            f.close()
+        return lines
+    
+    def _listening_sockets(self):
+        """Returns the sorted list of listening TCP sockets."""
+        lines = []
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                lines.extend(self._listening_sockets_netlink(family))
+            except NetlinkError, strerror:
+                self.logger.debug('%s: sock_diag unavailable (%s). Using %s' % (
+                    self.name, strerror, PROC_NET_TCP[family]))
+                lines.extend(self._listening_sockets_procfs(family))
+        # Several sockets may listen on the same address (SO_REUSEPORT)
+        return sorted(set(lines))
+    
+    def _normalize_ruleset(self, data):
+        """Removes comments and packet/byte counters from a ruleset dump."""
+        data = RE_RULESET_COMMENT.sub('', data)
+        data = RE_RULESET_COUNTERS.sub('[0:0]', data)
+        data = RE_RULESET_JSON_COUNTERS.sub(r'"\1": 0', data)
+        return data
+    
+    def _collect_native(self):
+        """Collects the listening sockets without running any commands and
+        the firewall ruleset from the 'firewall_commands'."""
+        yield ''.join(self._listening_sockets())
+        for stdout in self.command_outputs(DEFAULT_FIREWALL_COMMANDS, 'firewall_commands'):
+            yield '%s\n' % self._normalize_ruleset(stdout)
+    
     def collect(self):
-        for args in self.command_args(DEFAULT_COMMANDS):
-            stdout = self.external_command(args)
-            yield '%s\n' % stdout
+        source = self.cfg.get_or_default('main', 'source', DEFAULT_SOURCE).lower()
+        if source not in SOURCES:
+            raise BackendConfigurationError('Invalid source: %s' % source)
+        if source == 'native':
+            for data in self._collect_native():
+                yield data
+            return
+        for chunks in self.command_streams(DEFAULT_COMMANDS):
+            for data in chunks:
+                yield data
+            yield '\n'
 
 if __name__ == '__main__':
     for data in CollectorBackend().collect():
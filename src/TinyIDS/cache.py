@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import time
+import hmac
+import threading
+import collections
+
+from TinyIDS.util import sha1
+
+
+CACHE_FORMAT = 'TINYIDS-DIGEST-CACHE 1'
+KEY_LENGTH = 32
+# Estimated memory used by an LRUCache entry, besides the key and the value
+LRU_ENTRY_OVERHEAD = 200    # bytes
+
+
+class DigestCacheError(Exception):
+    pass
+
+class CacheIntegrityError(DigestCacheError):
+    pass
+
+
+def stat_fingerprint(st):
+    """Returns the fingerprint of a file as a tuple of integers:
+
+        (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns)
+
+    Accepts an os.stat() result. If the nanosecond timestamps are not
+    available, they are calculated from the floating point timestamps.
+
+    """
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    ctime_ns = getattr(st, 'st_ctime_ns', None)
+    if ctime_ns is None:
+        ctime_ns = int(st.st_ctime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns)
+
+
+def compare_digest(a, b):
+    """Returns True if the two strings are equal.
+
+    The time taken does not depend on the position of the first difference,
+    so that a forged HMAC cannot be guessed byte by byte. Uses
+    hmac.compare_digest() (Python 2.7.7 and later), if it is available.
+
+    """
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class DigestCache:
+    """Persistent cache of per-file digests.
+
+    Digests are keyed on the stat fingerprint of the file (see
+    stat_fingerprint()). If the fingerprint of a file has not changed since
+    the previous run, the stored digest is reused and the file is not read.
+
+    The cache file is protected with an HMAC, which is calculated using a
+    secret key that is stored in a separate file. If the key file does not
+    exist, a new random key is generated. A cache file that fails the HMAC
+    verification is discarded and CacheIntegrityError is raised by load().
+
+    Every 'verify_interval' seconds the cache is not used for lookups, so
+    that all files are read and hashed again (full verification).
+
+    Lookups and stores are thread-safe.
+
+    Cache file format:
+
+    TINYIDS-DIGEST-CACHE 1 <last_full_verification> <hmac>
+    <st_dev> <st_ino> <st_size> <st_mtime_ns> <st_ctime_ns> <digest>
+    ...
+
+    """
+
+    def __init__(self, path, key_path, verify_interval):
+        self.path = path
+        self.key_path = key_path
+        self.verify_interval = verify_interval
+
+        # Digests read from the cache file
+        self.entries = {}
+        # Digests that should be stored in the cache file
+        self.entries_new = {}
+        # Time of the last full verification
+        self.last_full_verification = 0
+        # If True, lookups always miss
+        self.full_verification = True
+
+        self.hits = 0
+        self.misses = 0
+
+        self._key = None
+        self._lock = threading.Lock()
+
+    def _get_key(self):
+        """Returns the HMAC key. The key is created, if it does not exist."""
+        if self._key is None:
+            if not os.path.exists(self.key_path):
+                fd = os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+                try:
+                    os.write(fd, os.urandom(KEY_LENGTH).encode('hex'))
+                finally:
+                    os.close(fd)
+            f = open(self.key_path)
+            try:
+                self._key = f.read().strip()
+            finally:
+                f.close()
+        return self._key
+
+    def _get_mac(self, header, body):
+        return hmac.new(self._get_key(), header + '\n' + body, sha1).hexdigest()
+
+    # Public API
+
+    def load(self):
+        """Loads the cache file.
+
+        A missing cache file results in an empty cache. If the cache file
+        cannot be parsed or if the HMAC verification fails, the cache is
+        left empty and CacheIntegrityError is raised.
+
+        """
+        self.entries = {}
+        self.last_full_verification = 0
+        self.full_verification = True
+        if os.path.exists(self.path):
+            f = open(self.path, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            header, sep, body = data.partition('\n')
+            try:
+                header, last_full_verification, mac = header.rsplit(' ', 2)
+                last_full_verification = int(last_full_verification)
+            except ValueError:
+                raise CacheIntegrityError('Invalid cache header')
+            if header != CACHE_FORMAT:
+                raise CacheIntegrityError('Unknown cache format')
+            expected_mac = self._get_mac('%s %s' % (header, last_full_verification), body)
+            if not compare_digest(expected_mac, mac):
+                raise CacheIntegrityError('HMAC verification failed')
+            entries = {}
+            for line in body.splitlines():
+                parts = line.split()
+                if len(parts) != 6:
+                    raise CacheIntegrityError('Invalid cache entry')
+                entries[tuple([long(x) for x in parts[:5]])] = parts[5]
+            self.entries = entries
+            self.last_full_verification = last_full_verification
+        elapsed = time.time() - self.last_full_verification
+        self.full_verification = elapsed >= self.verify_interval
+
+    def lookup(self, fingerprint):
+        """Returns the cached digest for the fingerprint or None."""
+        digest = None
+        self._lock.acquire()
+        try:
+            if not self.full_verification:
+                digest = self.entries.get(fingerprint)
+            if digest is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries_new[fingerprint] = digest
+        finally:
+            self._lock.release()
+        return digest
+
+    def store(self, fingerprint, digest):
+        """Stores the digest of the file with the provided fingerprint."""
+        self._lock.acquire()
+        try:
+            self.entries_new[fingerprint] = digest
+        finally:
+            self._lock.release()
+
+    def save(self, prune=True):
+        """Writes the cache file.
+
+        If 'prune' is True, only the entries that have been looked up or
+        stored during this run are saved, so digests of files that no longer
+        exist are dropped. Otherwise, the entries that have been read from
+        the cache file are saved too.
+
+        """
+        last_full_verification = self.last_full_verification
+        if self.full_verification and prune:
+            last_full_verification = int(time.time())
+        entries = self.entries_new
+        if not prune:
+            entries = self.entries.copy()
+            entries.update(self.entries_new)
+        lines = ['%s %s %s %s %s %s\n' % (fp + (digest,)) for fp, digest in sorted(entries.items())]
+        body = ''.join(lines)
+        header = '%s %s' % (CACHE_FORMAT, last_full_verification)
+        data = '%s %s\n%s' % (header, self._get_mac(header, body), body)
+
+        # Write the new cache atomically
+        tmp_path = '%s.tmp' % self.path
+        f = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+
+class LRUCache:
+    """Cache of a bounded size, which evicts the least recently used entries.
+    
+    The size is limited to 'max_entries' entries and to 'max_bytes' bytes,
+    as estimated from the length of the keys and values plus
+    LRU_ENTRY_OVERHEAD for each entry. A limit of 0 disables that limit.
+    
+    None may be stored as a value, for example to remember that a key does
+    not exist (negative caching).
+    
+    Instances are not thread-safe. Callers serialize access to them.
+    
+    Counters:
+    
+      hits: lookups of cached keys.
+      negative_hits: hits on keys cached with the value None.
+      misses: lookups of keys that are not cached.
+      evictions: entries removed to stay within the limits.
+      invalidations: entries removed by invalidate().
+    
+    """
+    
+    def __init__(self, max_entries=0, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def _entry_size(self, key, value):
+        return len(key) + len(value or '') + LRU_ENTRY_OVERHEAD
+    
+    def _remove(self, key):
+        value = self.entries.pop(key)
+        self.size -= self._entry_size(key, value)
+    
+    # Public API
+    
+    def lookup(self, key):
+        """Returns a (found, value) tuple. 'found' is False if the key is
+        not cached."""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return False, None
+        # Mark the entry as the most recently used one
+        self.entries[key] = value
+        self.hits += 1
+        if value is None:
+            self.negative_hits += 1
+        return True, value
+    
+    def store(self, key, value):
+        if self.entries.has_key(key):
+            self._remove(key)
+        self.entries[key] = value
+        self.size += self._entry_size(key, value)
+        while self.entries and ((self.max_entries and len(self.entries) > self.max_entries)
+                or (self.max_bytes and self.size > self.max_bytes)):
+            self._remove(iter(self.entries).next())
+            self.evictions += 1
+    
+    def invalidate(self, key):
+        if self.entries.has_key(key):
+            self._remove(key)
+            self.invalidations += 1
+    
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+    
+    def get_hit_rate(self):
+        """Returns the share of lookups that were hits (0 to 1)."""
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+    
+    def get_stats(self):
+        """Returns a string with the counters of the cache."""
+        return ('%d entries, %d bytes, hit rate %.1f%% (%d hits, %d negative hits, '
+            '%d misses), %d evictions, %d invalidations') % (
+            len(self.entries), self.size, self.get_hit_rate() * 100, self.hits,
+            self.negative_hits, self.misses, self.evictions, self.invalidations)
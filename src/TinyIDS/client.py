@@ -25,15 +25,28 @@
 
 import os
 import logging
-import glob
 import socket
 import getpass
 import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import TinyIDS.backends
 from TinyIDS import config
 from TinyIDS import crypto
-from TinyIDS.util import sha1, load_backend
+from TinyIDS.agent import query_agent, AgentQueryError, DEFAULT_AGENT_SOCKET
+from TinyIDS.collector import FileScan
+from TinyIDS.registry import BackendRegistry, DEFAULT_BACKEND_CACHE_DIR
+from TinyIDS.throttle import PressureMonitor, PriorityError, DEFAULT_PRESSURE_THRESHOLD
+from TinyIDS.throttle import set_idle_io_priority, set_idle_cpu_priority
+from TinyIDS.util import MultiHasher, UnsupportedAlgorithmError, format_digest_vector
+from TinyIDS.util import format_frame, read_message, FrameError
+from TinyIDS.watcher import DEFAULT_RESCAN_INTERVAL
+
+
+DEFAULT_CONNECT_TIMEOUT = 10   # seconds
+DEFAULT_RESPONSE_TIMEOUT = 30  # seconds
 
 
 logger = logging.getLogger()
@@ -42,6 +55,215 @@ logger = logging.getLogger()
 class NoBackendsToRun(Exception):
     pass
 
+class ClientConfigurationError(Exception):
+    pass
+
+class ServerConnectionClosed(Exception):
+    pass
+
+class ProtocolRevisionError(Exception):
+    pass
+
+
+class ServerConnection:
+    """Runs commands on a single TinyIDS server.
+    
+    Each instance uses its own socket and PKI module, so that several
+    servers can be contacted at the same time from different threads. The
+    messages are not logged immediately, but are kept in self.messages
+    until flush_log() is called, so that the messages of each server are
+    not mixed with the messages of the other servers.
+    
+    The protocol revision is negotiated when the first connection is
+    established: a framed TEST command of config.PROTOCOL_REVISION is sent,
+    followed by the command itself in the same packet (pipelining). A server
+    that answers with a plain line, or closes or resets the connection, only
+    speaks config.LEGACY_PROTOCOL_REVISION, so the command is sent again on a
+    new connection without framing. With protocol revision 3 the connection is
+    kept open and reused by the next command until close() is called. If a
+    reused connection has been closed by the server in the meantime, for
+    example because of its idle timeout, a new connection is established.
+    
+    """
+    
+    def __init__(self, client, section):
+        """Accepts a TinyIDSClient instance and the configuration section of
+        the server ('server__<name>')."""
+        cfg = client.cfg
+        self.name = client._get_server_canonical_name(section)
+        self.command = client.command
+        self.host = cfg.get(section, 'host')
+        self.port = config.DEFAULT_PORT
+        if cfg.has_option(section, 'port'):
+            self.port = cfg.getint(section, 'port')
+        self.public_key_fname = cfg.get_or_default(section, 'public_key', '')
+        self.connect_timeout, self.response_timeout = client.server_timeouts[section]
+        self.debug_protocol = client.debug_protocol
+        self.pki = crypto.RSAModule(client.keys_dir)
+        
+        # The data that is sent to the server
+        self.data = None
+        # List of (level, message) tuples
+        self.messages = []
+        # Protocol revision the server speaks or None, if not known yet
+        self.revision = None
+        self.sock = None
+        self.rfile = None
+    
+    def _log(self, level, msg):
+        self.messages.append((level, msg))
+    
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(self.connect_timeout)
+        try:
+            self.sock.connect((self.host, self.port))
+        except:
+            self.sock.close()
+            self.sock = None
+            raise
+        self.sock.settimeout(self.response_timeout)
+        self.rfile = self.sock.makefile('rb')
+        self._log('info', '- Established connection to server: %s' % self.name)
+    
+    def _encode(self, data, framed):
+        if self.debug_protocol:
+            self._log('debug', '-> Sending command: %s' % data)
+        if self.pki.public_key is not None:
+            data = self.pki.encrypt(data)
+            self._log('info', '- PKI: data encrypted')
+        if framed:
+            return format_frame(data, TinyIDSClient.cmd_end)
+        return data + TinyIDSClient.cmd_end
+    
+    def _get_response(self, framed):
+        """Receives a response of the server.
+        
+        If the server closes the connection, raises ServerConnectionClosed.
+        If a frame is expected, but the response is a plain line, raises
+        ProtocolRevisionError.
+        
+        """
+        self._log('info', '- Awaiting server response...')
+        response, is_frame = read_message(self.rfile, TinyIDSClient.max_response_len, TinyIDSClient.cmd_end)
+        if response is None:
+            raise ServerConnectionClosed
+        if framed and not is_frame:
+            raise ProtocolRevisionError(response)
+        self._log('info', '- Received response from server: %s' % self.name)
+        if self.pki.public_key is not None:
+            response = self.pki.verify(response)
+            self._log('info', '- PKI: data verified')
+        if self.debug_protocol:
+            self._log('debug', '-> Received response: %s' % response.strip())
+        return response.strip()
+    
+    def _exchange(self, commands, framed=True):
+        """Sends all commands at once and returns the list of responses."""
+        self.sock.sendall(''.join([self._encode(data, framed) for data in commands]))
+        self._log('info', '- Sent %s command to server: %s' % (self.command, self.name))
+        return [self._get_response(framed) for data in commands]
+    
+    def _request(self, data):
+        """Sends a command to the server and returns the response."""
+        if self.sock is not None:
+            try:
+                return self._exchange([data])[0]
+            except socket.timeout:
+                raise
+            except (socket.error, ServerConnectionClosed):
+                self._log('info', '- Connection closed by server: %s. Reconnecting...' % self.name)
+                self.close()
+        
+        self._connect()
+        if self.revision != config.LEGACY_PROTOCOL_REVISION:
+            test = 'TEST %s' % config.PROTOCOL_REVISION
+            commands = [test]
+            if data != test:
+                commands.append(data)
+            try:
+                try:
+                    responses = self._exchange(commands)
+                except socket.timeout:
+                    raise
+                except socket.error:
+                    # The connection is reset if the server closes it
+                    # before the pipelined command has been read.
+                    raise ServerConnectionClosed
+            except (ProtocolRevisionError, ServerConnectionClosed):
+                self._log('info', '- Server %s supports protocol revision %s' % (
+                    self.name, config.LEGACY_PROTOCOL_REVISION))
+                self.close()
+                self.revision = config.LEGACY_PROTOCOL_REVISION
+                self._connect()
+            else:
+                self.revision = config.PROTOCOL_REVISION
+                return responses[-1]
+        
+        # Protocol revision 2: one command per connection
+        if data == 'TEST %s' % config.PROTOCOL_REVISION:
+            data = 'TEST %s' % config.LEGACY_PROTOCOL_REVISION
+        try:
+            return self._exchange([data], framed=False)[0]
+        finally:
+            self.close()
+    
+    def run(self):
+        """Sends self.data to the server and checks the response.
+        
+        Errors are not raised, but are recorded as messages.
+        
+        """
+        self._log('info', '* Contacting server: %s' % self.name)
+        if self.public_key_fname:
+            try:
+                self.pki.load_external_public_key(self.public_key_fname) # sets self.pki.public_key
+            except crypto.InvalidPublicKey:
+                self._log('warning', '- RESULT: %s on %s: FAILURE with PKI error: invalid server public key: %s' % (self.command, self.name, self.public_key_fname))
+                return
+        try:
+            try:
+                response = self._request(self.data)
+            except socket.timeout:
+                self._log('error', 'Connection error: \'timed out\'')
+                self._log('warning', 'Skipping server: %s' % self.name)
+                self.close()
+            except socket.error, (err, strerror):
+                self._log('error', 'Connection error: \'%s\'' % strerror)
+                self._log('warning', 'Skipping server: %s' % self.name)
+                self.close()
+            except (ServerConnectionClosed, FrameError):
+                self._log('error', 'Connection error: \'invalid response\'')
+                self._log('warning', 'Skipping server: %s' % self.name)
+                self.close()
+            except crypto.DataEncryptionError:
+                self._log('warning', '- RESULT: %s on %s: FAILURE with PKI error: could not encrypt data for server' % (self.command, self.name))
+                self.close()
+            except crypto.DataVerificationError:
+                self._log('warning', '- RESULT: %s on %s: FAILURE with PKI error: could not verify response from server' % (self.command, self.name))
+                self.close()
+            else:
+                if response.startswith('20'):
+                    self._log('info', '- RESULT: %s on %s: SUCCESS' % (self.command, self.name))
+                else:
+                    self._log('warning', '- RESULT: %s on %s: FAILURE with error: %s' % (self.command, self.name, response))
+        finally:
+            self.pki.reset()    # sets self.pki.public_key to None
+    
+    def flush_log(self):
+        """Logs the messages that have been recorded and clears them."""
+        for level, msg in self.messages:
+            getattr(logger, level)(msg)
+        self.messages = []
+    
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+            self.rfile = None
+            self._log('info', '- Closed connection with server: %s' % self.name)
+
 
 class TinyIDSClient:
     """A client implementation of the TinyIDS protocol."""
@@ -49,7 +271,7 @@ class TinyIDSClient:
     cmd_end = '\r\n'
     max_response_len = 1024
     
-    def __init__(self, command):
+    def __init__(self, command, backends=None):
         
         # Client configuration (config.TinyIDSConfigParser instance)
         self.cfg = config.get_client_configuration()
@@ -57,105 +279,386 @@ class TinyIDSClient:
         # Holds the current command
         self.command = command  # TEST | CHECK | UPDATE | DELETE | CHANGEPHRASE
         
-        # Default hashing delay
-        self.default_hashing_delay = self._get_hashing_delay()
+        # List of backend names for a partial CHECK or None. Only these
+        # backends run and only their digests are sent to the servers.
+        self.partial_backends = backends
+        
+        # Default rate limits of the backends that read files
+        self.max_bytes_per_sec, self.max_files_per_sec = self._get_rate_limits()
+        
+        # Number of threads used by backends that hash files concurrently
+        self.hashing_workers = self._get_hashing_workers()
+        
+        # Adjusts the rate limits according to the load of the host
+        self.pressure_monitor = self._get_pressure_monitor()
+        
+        # Total time backends have waited because of the rate limits
+        self.throttled_time = 0.0
+        self.throttled_count = 0
+        self._throttle_lock = threading.Lock()
+        
+        # Calculate a separate digest for each backend and run up to
+        # 'backend_workers' backends at the same time
+        self.per_backend_digests = False
+        if self.cfg.has_option('main', 'per_backend_digests'):
+            self.per_backend_digests = self.cfg.getboolean('main', 'per_backend_digests')
+        if self.partial_backends:
+            self.per_backend_digests = True
+        self.backend_workers = self._get_backend_workers()
+        
+        # Per-backend digests of the last collection: {name: MultiHasher}
+        self.backend_digests = {}
+        
+        # If set, it is sent to the servers instead of the calculated
+        # checksum, for example when the result is retrieved from the agent.
+        self.checksum = None
+        
+        # Keep track of changed files between collections
+        self.watch_files = False
+        if self.cfg.has_option('main', 'watch_files'):
+            self.watch_files = self.cfg.getboolean('main', 'watch_files')
+        self.watch_rescan_interval = self._get_timeout('main', 'watch_rescan_interval', DEFAULT_RESCAN_INTERVAL)
         
         # Debug protocol
         self.debug_protocol = self.cfg.getboolean('main', 'debug_protocol')
  
-        # Data hashing object
-        self.hasher = sha1()
+        # Data hashing object. In migration mode it calculates the digests
+        # of two algorithms in a single pass.
+        self.digest_algorithms = self._get_digest_algorithms()
+        self.hasher = MultiHasher(self.digest_algorithms)
         # Immediately hash the machine's hostname to avoid possible
         # identical hashes among identical machines (issue: #248)
         self.hash_data(socket.gethostname())
         
-        # PKI Module
-        _keys_dir = self.cfg.get('main', 'keys_dir')
-        self.pki = crypto.RSAModule(_keys_dir)
+        # Used to encrypt the data for the servers
+        self.keys_dir = self.cfg.get('main', 'keys_dir')
         
-        # This is socket.socket object while connected to server
-        # Should be set to None as soon the connection is closed
-        # or a socket error occurs.
-        self.sock = None
+        # Timeouts in seconds of the communication with each server
+        self.server_timeouts = self._get_server_timeouts()
         
-        # Should hold the name of the server as long as there is a
-        # valid connection to it.
-        self.server_name = None
+        # ServerConnection instances by server section. They are kept, so
+        # that their connections are reused by subsequent commands.
+        self.server_connections = {}
         
-    def _close_socket(self):
-        """Should be called after all socket errors."""
-        if isinstance(self.sock, socket.socket):
-            self.sock.close()
-            if self.server_name:
-                logger.info('- Closed connection with server: %s' % self.server_name)
-        self.sock = None
-        self.server_name = None
+    def _get_rate_limits(self):
+        """Returns the (max_bytes_per_sec, max_files_per_sec) tuple.
+        
+        The deprecated 'hashing_delay' option, a delay in milliseconds
+        after each hashed file, is converted to a files per second limit,
+        unless 'max_files_per_sec' is set. The limit is applied once per
+        file, so reading a file in chunks does not multiply the delay.
+        
+        On invalid values, raises ClientConfigurationError.
+        
+        """
+        limits = []
+        for option, cast in (('max_bytes_per_sec', int), ('max_files_per_sec', float)):
+            value = self.cfg.get_or_default('main', option, '0').strip()
+            try:
+                limit = cast(value)
+            except ValueError:
+                limit = -1
+            if limit < 0:
+                raise ClientConfigurationError('Invalid %s: %s' % (option, value))
+            limits.append(limit)
+        max_bytes_per_sec, max_files_per_sec = limits
+        try:
+            delay_msec = float(self.cfg.get_or_default('main', 'hashing_delay', '0'))
+        except ValueError:
+            raise ClientConfigurationError('Invalid hashing_delay: %s' % self.cfg.get('main', 'hashing_delay'))
+        if delay_msec > 0 and not self.cfg.get_or_default('main', 'max_files_per_sec', ''):
+            max_files_per_sec = 1000.0 / delay_msec
+            logger.warning('The hashing_delay option is deprecated. Using max_files_per_sec = %.3f' % max_files_per_sec)
+        logger.debug('Rate limits set to %s bytes and %s files per second (0 is unlimited)' % (
+            max_bytes_per_sec, max_files_per_sec))
+        return max_bytes_per_sec, max_files_per_sec
+    
+    def _get_pressure_monitor(self):
+        """Returns a PressureMonitor instance, if adaptive throttling has
+        been enabled, or None.
+        
+        On invalid values, raises ClientConfigurationError.
+        
+        """
+        if not self.cfg.has_option('main', 'adaptive_throttling'):
+            return None
+        elif not self.cfg.getboolean('main', 'adaptive_throttling'):
+            return None
+        thresholds = []
+        for option, default in (('pressure_threshold', DEFAULT_PRESSURE_THRESHOLD), ('load_threshold', 0)):
+            value = self.cfg.get_or_default('main', option, str(default)).strip()
+            try:
+                threshold = float(value)
+            except ValueError:
+                threshold = -1
+            if threshold < 0:
+                raise ClientConfigurationError('Invalid %s: %s' % (option, value))
+            thresholds.append(threshold)
+        pressure_threshold, load_threshold = thresholds
+        if not self.max_bytes_per_sec and not self.max_files_per_sec:
+            logger.warning('Adaptive throttling only has an effect on backends with rate limits')
+        logger.debug('Adaptive throttling enabled (pressure threshold: %s%%, load threshold: %s)' % (
+            pressure_threshold, load_threshold))
+        return PressureMonitor(pressure_threshold, load_threshold)
     
-    def _get_hashing_delay(self):
-        """Returns the hashing delay in seconds."""
-        delay_msec = self.cfg.getfloat('main', 'hashing_delay')
-        delay_sec = delay_msec / 1000
-        logger.debug('Hashing delay set to %.3f seconds' % delay_sec)
-        return delay_sec
+    def _set_priority(self):
+        """Lowers the CPU and I/O scheduling priority of the process according
+        to the 'io_priority', 'cpu_priority' and 'nice' options.
+        
+        Failures are logged and ignored.
+        
+        """
+        if self.cfg.get_or_default('main', 'io_priority', 'normal').strip().lower() == 'idle':
+            try:
+                set_idle_io_priority()
+            except PriorityError, strerror:
+                logger.warning('Cannot set the idle I/O priority: %s' % strerror)
+            else:
+                logger.debug('I/O scheduling class set to idle')
+        if self.cfg.get_or_default('main', 'cpu_priority', 'normal').strip().lower() == 'idle':
+            try:
+                set_idle_cpu_priority()
+            except PriorityError, strerror:
+                logger.warning('Cannot set the SCHED_IDLE policy: %s' % strerror)
+            else:
+                logger.debug('CPU scheduling policy set to SCHED_IDLE')
+        value = self.cfg.get_or_default('main', 'nice', '0').strip()
+        try:
+            increment = int(value)
+        except ValueError:
+            logger.warning('Invalid nice value: %s' % value)
+            increment = 0
+        if increment > 0:
+            try:
+                logger.debug('Niceness set to %d' % os.nice(increment))
+            except OSError, (err, strerror):
+                logger.warning('Cannot set the niceness: %s' % strerror)
     
-    def _run_backends(self):
-        """Runs all collector backends and passes the yielded information
-        through the hashing algorithm."""
+    def _log_throttled_time(self, backend_name, b):
+        """Logs the time the backend has waited because of the rate limits
+        and adds it to the total."""
+        seconds, count = b.get_throttled_time()
+        if not count:
+            return
+        logger.info('%s: Throttled for %.3f seconds (%d waits, %.3f seconds on average)' % (
+            backend_name, seconds, count, seconds / count))
+        self._throttle_lock.acquire()
+        try:
+            self.throttled_time += seconds
+            self.throttled_count += count
+        finally:
+            self._throttle_lock.release()
+    
+    def _get_digest_algorithms(self):
+        """Returns the list of digest algorithms the checksum is calculated with.
+        
+        The list contains the algorithm set in the 'digest_algorithm' option
+        and, in migration mode, the algorithm set in the
+        'migration_digest_algorithm' option.
+        
+        If an algorithm is not supported, raises ClientConfigurationError.
+        
+        """
+        algorithms = [self.cfg.get_or_default('main', 'digest_algorithm', 'sha1').strip().lower()]
+        migration_algorithm = self.cfg.get_or_default('main', 'migration_digest_algorithm', '').strip().lower()
+        if migration_algorithm and migration_algorithm not in algorithms:
+            algorithms.append(migration_algorithm)
+        for algorithm in algorithms:
+            try:
+                MultiHasher([algorithm])
+            except UnsupportedAlgorithmError:
+                raise ClientConfigurationError('Unsupported digest algorithm: %s' % algorithm)
+        logger.debug('Digest algorithm(s): %s' % ', '.join(algorithms))
+        return algorithms
+    
+    def _get_hashing_workers(self):
+        """Returns the number of hashing workers.
+        
+        The 'hashing_workers' option accepts a positive integer or 'auto'.
+        'auto' uses as many workers as the number of CPUs.
+        
+        On invalid values, raises ClientConfigurationError.
         
+        """
+        value = self.cfg.get_or_default('main', 'hashing_workers', '1').strip().lower()
+        if value == 'auto':
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        else:
+            try:
+                workers = int(value)
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                raise ClientConfigurationError('Invalid hashing_workers: %s' % value)
+        logger.debug('Hashing workers set to %d' % workers)
+        return workers
+    
+    def _get_backend_workers(self):
+        """Returns the number of backends that run at the same time.
+        
+        Backends only run concurrently if per-backend digests are enabled,
+        so that the checksum does not depend on the order in which the
+        backends finish.
+        
+        On invalid values, raises ClientConfigurationError.
+        
+        """
+        value = self.cfg.get_or_default('main', 'backend_workers', '1').strip()
+        try:
+            workers = int(value)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            raise ClientConfigurationError('Invalid backend_workers: %s' % value)
+        if workers > 1 and not self.per_backend_digests:
+            logger.warning('backend_workers requires per_backend_digests. Backends will run one at a time')
+            workers = 1
+        logger.debug('Backend workers set to %d' % workers)
+        return workers
+    
+    def _collect_backend(self, backend):
+        """Runs a backend and returns a MultiHasher instance containing
+        the digest of the collected information.
+        
+        Accepts a (name, CollectorBackend instance) tuple.
+        
+        """
+        backend_name, b = backend
+        logger.info('Processing backend: %s' % backend_name)
+        t0 = time.time()
+        hasher = MultiHasher(self.digest_algorithms)
+        for data in b.collect():
+            self.hash_data(data, hasher)
+        logger.info('%s: Complete' % backend_name)
+        logger.debug('%s: Collection took %.3f seconds' % (backend_name, time.time() - t0))
+        self._log_throttled_time(backend_name, b)
+        return hasher
+    
+    def _run_backends_per_digest(self, backends):
+        """Runs the backends, up to 'backend_workers' at the same time, and
+        combines their digests into the checksum.
+        
+        Accepts a list of (name, CollectorBackend instance) tuples.
+        
+        The digest of each backend is passed through the hashing algorithm
+        as a '<name> <hexdigest>' line, in the order of the backend names,
+        so that the checksum does not depend on the order in which the
+        backends finish.
+        
+        """
+        t0 = time.time()
+        if self.backend_workers > 1 and len(backends) > 1:
+            pool = ThreadPool(min(self.backend_workers, len(backends)))
+            try:
+                hashers = pool.map(self._collect_backend, backends)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            hashers = map(self._collect_backend, backends)
+        logger.debug('Backends completed in %.3f seconds' % (time.time() - t0))
+        self.backend_digests = {}
+        for (backend_name, b), hasher in zip(backends, hashers):
+            logger.debug('%s: Digest: %s' % (backend_name, hasher.hexdigest()))
+            self.backend_digests[backend_name] = hasher
+        self.hasher = self._combine_backend_digests(self.backend_digests)
+    
+    def _combine_backend_digests(self, backend_digests):
+        """Returns a MultiHasher instance containing the checksum that is
+        calculated from the digests of the backends.
+        
+        Accepts a dictionary: {backend_name: MultiHasher instance}
+        
+        The hostname is hashed first (see __init__()), followed by the digest
+        of each backend as a '<name> <hexdigest>' line, in the order of the
+        backend names.
+        
+        """
+        hasher = MultiHasher(self.digest_algorithms)
+        hasher.update(socket.gethostname())
+        for backend_name in sorted(backend_digests.keys()):
+            hasher.update_digests(backend_name, backend_digests[backend_name])
+        return hasher
+    
+    def _load_backends(self):
+        """Loads the collector backends and returns a list of
+        (name, CollectorBackend instance) tuples.
+        
+        If a user-defined list of backends has been set, only the backends
+        in the list are loaded.
+        
+        If no backends can be loaded, raises NoBackendsToRun.
+        
+        """
         backends_conf_dir = self.cfg.get('main', 'backends_conf_dir')
         
-        # Get a list of all backend paths
-        backend_paths = []
+        # Get a list of all backends
+        t0 = time.time()
         core_backends_dir = TinyIDS.backends.__path__[0]
-        backend_paths.extend(glob.glob(os.path.join(core_backends_dir, '*.py')))
         extra_backends_dir = self.cfg.get('main', 'extra_backends_dir')
-        backend_paths.extend(glob.glob(os.path.join(extra_backends_dir, '*.py')))
+        backend_cache_dir = self.cfg.get_or_default('main', 'backend_cache_dir', DEFAULT_BACKEND_CACHE_DIR)
+        registry = BackendRegistry([core_backends_dir, extra_backends_dir], backends_conf_dir, backend_cache_dir)
+        backend_entries = registry.discover()
+        logger.debug('Backend discovery: %d backends found in %.3f seconds (manifest %s)' % (
+            len(backend_entries), time.time() - t0, registry.manifest_reused and 'reused' or 'rebuilt'))
         
-        if not backend_paths:
+        if not backend_entries:
             raise NoBackendsToRun
         
         # 
-        user_defined_backend_list = self.cfg.getlist('main', 'tests')
-        user_defined_backend_list_finished = [] # holds names of backends that have finished
+        user_defined_backend_list = self.partial_backends or self.cfg.getlist('main', 'tests')
+        user_defined_backend_list_finished = [] # holds names of backends that have been loaded
         if user_defined_backend_list:
             logger.debug('Using user-defined list of backends')
         
+        # Time spent importing backends
+        import_time = 0.0
+        
+        backends = []
+        
         # Load all needed backends and store them in a list
-        for backend_path in backend_paths:
-            backend_name = os.path.basename(backend_path)[:-3]
-            backend_dir = os.path.dirname(backend_path)
-            if backend_name == '__init__':
-                continue
-            elif user_defined_backend_list:
+        for entry in backend_entries:
+            backend_name = entry.name
+            backend_path = entry.path
+            if user_defined_backend_list:
                 #print "checking user list"
                 if not backend_name in user_defined_backend_list:
                     logger.debug('Skipping backend: %s' % backend_name)
                     continue
             # Load backend
-            m = load_backend(backend_dir, backend_name)
+            t0 = time.time()
+            m = registry.load(entry)
+            import_time += time.time() - t0
             if not hasattr(m, 'CollectorBackend'):
                 logger.warning('Skipping invalid backend: %s' % backend_path)
                 continue
             
-            logger.info('Processing backend: %s' % backend_name)
-            
-            backend_config_file = os.path.join(backends_conf_dir, m.__name__ + '.conf')
-            b = m.CollectorBackend(config_path=backend_config_file)
+            b = m.CollectorBackend(config_path=entry.config_path)
             if not hasattr(b, 'collect'):
                 logger.error('Invalid TinyIDS backend: %s' % backend_path)
                 continue
-            
-            # Collect information
-            for data in b.collect():
-                self.hash_data(data)
-            logger.info('%s: Complete' % backend_name)
+            b.hashing_workers = self.hashing_workers
+            b.digest_algorithms = self.digest_algorithms
+            b.watch_files = self.watch_files
+            b.watch_rescan_interval = self.watch_rescan_interval
+            b.max_bytes_per_sec = self.max_bytes_per_sec
+            b.max_files_per_sec = self.max_files_per_sec
+            b.pressure_monitor = self.pressure_monitor
+            backends.append((backend_name, b))
             
             if user_defined_backend_list:
                 # If a user-defined list of backends is used, add the name of
-                # the backend that has just run to the list:
+                # the backend that has just been loaded to the list:
                 # user_defined_backend_list_finished
                 user_defined_backend_list_finished.append(backend_name)
         
+        registry.save()
+        logger.debug('Backend imports: %d in %.3f seconds (%d from cached bytecode)' % (
+            registry.imports, import_time, registry.bytecode_hits))
+        
         if user_defined_backend_list:
             invalid_user_defined_tests = []
             for test in user_defined_backend_list:
@@ -163,8 +666,46 @@ class TinyIDSClient:
                     invalid_user_defined_tests.append(test)
             if invalid_user_defined_tests:
                 logger.warning('Invalid user-defined test(s): %s' % ', '.join(invalid_user_defined_tests))
-                if not user_defined_backend_list_finished:
-                    raise NoBackendsToRun
+        if not backends:
+            raise NoBackendsToRun
+        return backends
+    
+    def _run_backends(self):
+        """Runs all collector backends and passes the yielded information
+        through the hashing algorithm."""
+        
+        backends = self._load_backends()
+        
+        # Lower the priority of the process before any threads are started
+        self._set_priority()
+        
+        # Filesystem scan shared by all backends of this run
+        scan = FileScan()
+        for backend_name, b in backends:
+            b.scan = scan
+        
+        # Total time backends have waited because of the rate limits
+        self.throttled_time = 0.0
+        self.throttled_count = 0
+        
+        if self.per_backend_digests:
+            self._run_backends_per_digest(backends)
+        else:
+            for backend_name, b in backends:
+                logger.info('Processing backend: %s' % backend_name)
+                # Collect information
+                for data in b.collect():
+                    self.hash_data(data)
+                logger.info('%s: Complete' % backend_name)
+                self._log_throttled_time(backend_name, b)
+        
+        if self.throttled_count:
+            logger.info('Throttled for %.3f seconds in total (%d waits, %.3f seconds on average)' % (
+                self.throttled_time, self.throttled_count, self.throttled_time / self.throttled_count))
+        if self.pressure_monitor is not None:
+            logger.debug('Host load checked %d times, busy %d times' % (
+                self.pressure_monitor.checks, self.pressure_monitor.busy_checks))
+        logger.debug('File scan: %d directory listings, %d stat calls' % (scan.listdir_calls, scan.stat_calls))
     
     def _get_server_canonical_name(self, server_name):
         """Returns the name of the server after stripping the 'server__' prefix'"""
@@ -188,42 +729,35 @@ class TinyIDSClient:
                 enabled_servers.append(section)
         return enabled_servers
     
-    def _send(self, host, port, data):
-        """Sends the command to a TinyIDS server."""
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, port))
-        logger.info('- Established connection to server: %s' % self.server_name)
-        if self.debug_protocol:
-            logger.debug('-> Sending command: %s' % data)
-        if self.pki.public_key is not None:
-            data = self.pki.encrypt(data)
-            logger.info('- PKI: data encrypted')
-        self.sock.send(data + self.cmd_end)
-        logger.info('- Sent %s command to server: %s' % (self.command, self.server_name))
-    
-    def _get_server_response(self):
-        """Receives a response from a TinyIDS server."""
-        logger.info('- Awaiting server response...')
-        response = self.sock.recv(self.max_response_len).strip()
-        response = response.rstrip(self.cmd_end)
-        logger.info('- Received response from server: %s' % self.server_name)
-        if self.pki.public_key is not None:
-            response = self.pki.verify(response)
-            logger.info('- PKI: data verified')
-        if self.debug_protocol:
-            logger.debug('-> Received response: %s' % response.strip())
-        return response.strip()
-    
-    def _check_command_status(self, response):
-        if response.startswith('20'):
-            logger.info('- RESULT: %s on %s: SUCCESS' % (self.command, self.server_name))
-        else:
-            logger.warning('- RESULT: %s on %s: FAILURE with error: %s' % (self.command, self.server_name, response))
+    def _get_timeout(self, section, option, default):
+        """Returns the timeout or interval in seconds that is set in the
+        section or the default value.
+        
+        On invalid values, raises ClientConfigurationError.
+        
+        """
+        value = self.cfg.get_or_default(section, option, str(default))
+        try:
+            timeout = float(value)
+        except ValueError:
+            timeout = 0
+        if timeout <= 0:
+            raise ClientConfigurationError('Invalid %s of %s: %s' % (option, section, value))
+        return timeout
     
-    def _communicate(self, host, port, data):
-        self._send(host, port, data)
-        response = self._get_server_response()
-        self._check_command_status(response)
+    def _get_server_timeouts(self):
+        """Returns a dictionary of (connect_timeout, response_timeout) tuples
+        by server section. The timeouts of the [main] section are used for
+        servers that do not set their own."""
+        connect_timeout = self._get_timeout('main', 'connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        response_timeout = self._get_timeout('main', 'response_timeout', DEFAULT_RESPONSE_TIMEOUT)
+        timeouts = {}
+        for section in self.cfg.sections():
+            if section.startswith('server__'):
+                timeouts[section] = (
+                    self._get_timeout(section, 'connect_timeout', connect_timeout),
+                    self._get_timeout(section, 'response_timeout', response_timeout))
+        return timeouts
     
     def _get_passphrase(self, msg):
         """Prompts the user for a passphrase."""
@@ -232,59 +766,134 @@ class TinyIDSClient:
             data = getpass.getpass('%s: ' % msg)
         return data
     
-    def _com_TEST(self, host, port):
+    def _com_TEST(self, server):
         """
         Syntax: TEST <protocol_revision>
         """
-        data = '%s %s' % (self.command, config.PROTOCOL_REVISION)
-        self._communicate(host, port, data)
+        return '%s %s' % (self.command, config.PROTOCOL_REVISION)
         
-    def _com_CHECK(self, host, port):
+    def _com_CHECK(self, server):
         """
         Syntax: CHECK <hash>
+        
+        <hash> is either an untagged sha1 digest or a comma-delimited list
+        of <algorithm>:<hexdigest> items (see util.format_digests()),
+        optionally followed by the digests of the backends, or only the
+        digests of some backends in a partial check (see
+        util.format_digest_vector()).
         """
-        data = '%s %s' % (self.command, self.get_checksum())
-        self._communicate(host, port, data)
+        return '%s %s' % (self.command, self.get_checksum())
     
-    def _com_UPDATE(self, host, port):
+    def _com_UPDATE(self, server):
         """
         Syntax: UPDATE <hash> <passphrase>
         """
-        passphrase = self._get_passphrase('Passphrase')
-        data = '%s %s %s' % (self.command, self.get_checksum(), passphrase)
-        self._communicate(host, port, data)
+        passphrase = self._get_passphrase('Passphrase for %s' % server.name)
+        return '%s %s %s' % (self.command, self.get_checksum(), passphrase)
     
-    def _com_DELETE(self, host, port):
+    def _com_DELETE(self, server):
         """
         Syntax: DELETE <passphrase>
         """
-        passphrase = self._get_passphrase('Passphrase')
-        data = '%s %s' % (self.command, passphrase)
-        self._communicate(host, port, data)
+        passphrase = self._get_passphrase('Passphrase for %s' % server.name)
+        return '%s %s' % (self.command, passphrase)
     
-    def _com_CHANGEPHRASE(self, host, port):
+    def _com_CHANGEPHRASE(self, server):
         """
         Syntax: CHANGEPHRASE <old_passphrase> <new_passphrase>
         """
-        passphrase_old = self._get_passphrase('Old passphrase')
+        passphrase_old = self._get_passphrase('Old passphrase for %s' % server.name)
         while True:
             passphrase_new = self._get_passphrase('New passphrase')
             passphrase_new_confirm = self._get_passphrase('Confirm new passphrase')
             if passphrase_new == passphrase_new_confirm:
                 break
             logger.error('passphrases do not match. try again...')
-        data = '%s %s %s' % (self.command, passphrase_old, passphrase_new)
-        self._communicate(host, port, data)
+        return '%s %s %s' % (self.command, passphrase_old, passphrase_new)
+    
+    def _query_agent(self):
+        """Retrieves the latest result of the agent, if the 'query' option of
+        the [agent] section is enabled, and sets it as the checksum.
+        
+        Returns True on success. If the agent cannot be queried, returns
+        False, so that the checksum is calculated by this process.
+        
+        """
+        if not self.cfg.has_option('agent', 'query'):
+            return False
+        elif not self.cfg.getboolean('agent', 'query'):
+            return False
+        socket_path = self.cfg.get_or_default('agent', 'socket', DEFAULT_AGENT_SOCKET)
+        try:
+            self.checksum = query_agent(socket_path, self.partial_backends)
+        except AgentQueryError, strerror:
+            logger.info('Cannot use the result of the agent: %s' % strerror)
+            return False
+        return True
+    
+    def _contact_servers(self, enabled_servers):
+        """Runs the command on all enabled servers at the same time.
+        
+        The passphrases are requested before any server is contacted. The
+        messages of each server are logged after all servers have finished,
+        in the order the servers appear in the configuration.
+        
+        """
+        
+        # Decide which method to execute
+        func = getattr(self, '_com_%s' % self.command)
+        
+        servers = []
+        for section in enabled_servers:
+            server = self.server_connections.get(section)
+            if server is None:
+                server = ServerConnection(self, section)
+                self.server_connections[section] = server
+            server.data = func(server)
+            servers.append(server)
+        
+        logger.info('Contacting %d servers' % len(servers))
+        pool = ThreadPool(len(servers))
+        try:
+            pool.map(ServerConnection.run, servers)
+        finally:
+            pool.close()
+            pool.join()
+        
+        for server in servers:
+            server.flush_log()
+        logger.info('Finished with servers')
     
     # Public API
     
     def get_checksum(self):
-        return self.hasher.hexdigest()
+        """Returns the checksum that is sent to the servers.
+        
+        If per-backend digests are enabled, the digests of the backends are
+        sent together with the checksum (see util.format_digest_vector()).
+        In a partial CHECK, only the digests of the backends are sent.
+        
+        """
+        if self.checksum is not None:
+            return self.checksum
+        if not self.per_backend_digests:
+            return self.hasher.hexdigest()
+        backend_digests = [(name, hasher.hexdigest()) for name, hasher in self.backend_digests.items()]
+        if self.partial_backends:
+            backend_digests = [(name, digest) for name, digest in backend_digests if name in self.partial_backends]
+            return format_digest_vector(None, backend_digests)
+        return format_digest_vector(self.hasher.hexdigest(), backend_digests)
     
-    def hash_data(self, data):
-        """Passes data through the hashing algorithm.""" 
-        self.hasher.update(data)
-        time.sleep(self.default_hashing_delay)
+    def hash_data(self, data, hasher=None):
+        """Passes data through the hashing algorithm.
+        
+        If a MultiHasher instance is provided, the data is passed through it
+        instead of the checksum hasher.
+        
+        """
+        if hasher is None:
+            hasher = self.hasher
+        hasher.update(data)
     
     def run(self):
         """Main client method."""
@@ -297,11 +906,12 @@ class TinyIDSClient:
             return
         logger.info('Servers found. Proceeding with data hashing...')
         
-        # Decide which method to execute
-        func = getattr(self, '_com_%s' % self.command)
+        # The CHECK command uses the latest result of the agent, if possible
+        if self.command == 'CHECK' and self._query_agent():
+            logger.info('Using the latest result of the agent')
         
         # Tests are required to run only with the CHECK and UPDATE commands
-        if self.command in ('CHECK', 'UPDATE'):
+        elif self.command in ('CHECK', 'UPDATE'):
             logger.info('Hashing data. Please wait...')
             try:
                 self._run_backends()
@@ -313,47 +923,18 @@ class TinyIDSClient:
                 logger.info('Data hashing complete')
         
         # Execute command on server
-        logger.info('Preparing to contact servers')
-        for server in enabled_servers:
-            # server is in 'server__<name>' format (a section name)
-            # Here we set self.server_name to the canonical server name
-            self.server_name = self._get_server_canonical_name(server)
-            logger.info('* Contacting server: %s' % self.server_name)
-            
-            # Get server settings
-            host = self.cfg.get(server, 'host')
-            port = config.DEFAULT_PORT
-            if self.cfg.has_option(server, 'port'):
-                port = self.cfg.getint(server, 'port')
-            if self.cfg.has_option(server, 'public_key'):
-                public_key_fname = self.cfg.get(server, 'public_key')
-                if public_key_fname:
-                    try:
-                        self.pki.load_external_public_key(public_key_fname) # sets self.pki.public_key
-                    except crypto.InvalidPublicKey:
-                        logger.warning('- RESULT: %s on %s: FAILURE with PKI error: invalid server public key: %s' % (self.command, self.server_name, public_key_fname))
-                        self.server_name = None
-                        continue
-                    
-            # Run command on the server
-            try:
-                func(host, port)
-            except socket.error, (errno, strerror):
-                logger.error('Connection error: \'%s\'' % strerror)
-                logger.warning('Skipping server: %s' % self.server_name)
-                self.server_name = None
-            except crypto.DataEncryptionError:
-                logger.warning('- RESULT: %s on %s: FAILURE with PKI error: could not encrypt data for server' % (self.command, self.server_name))
-            except crypto.DataVerificationError:
-                logger.warning('- RESULT: %s on %s: FAILURE with PKI error: could not verify response from server' % (self.command, self.server_name))
-            
-            self._close_socket()
-            self.pki.reset()    # sets self.pki.public_key to None
-        
-        logger.info('Finished with servers')
+        self._contact_servers(enabled_servers)
         
         self.client_close()
     
+    def close_connections(self):
+        """Closes the connections to the servers."""
+        for server in self.server_connections.values():
+            server.close()
+            server.flush_log()
+        self.server_connections = {}
+    
     def client_close(self):
+        self.close_connections()
         logger.info('Client shutting down...')
 
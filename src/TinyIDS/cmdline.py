@@ -35,7 +35,11 @@ USAGE_CLIENT = """
 
 Only one of the following can be used at a time:
 
-    [--test] [--check] [--update] [--delete] [--change-phrase]
+    [--test] [--check] [--update] [--delete] [--change-phrase] [--agent]
+
+A subset of the backends can be checked using:
+
+    --check --backends NAME[,NAME...]
     
 """
 
@@ -49,6 +53,8 @@ USAGE_SERVER = """
 
 %prog [--config PATH] [--debug]
 
+%prog [--config PATH] --migrate-from ENGINE:PATH
+
 """
 
 
@@ -74,6 +80,8 @@ def parse_client():
         update = False,
         delete = False,
         changephrase = False,
+        backends = None,
+        agent = False,
         debug = False,
     )
 
@@ -101,6 +109,18 @@ You will be prompted for the passphrase.""")
             help="""Change the passphrase on the remote servers. \
 You will be prompted for the current and the new passphrase.""")
     
+    parser.add_option('--agent', action='store_true', dest='agent',
+            help="""Run as a resident agent, which runs each backend \
+periodically, checks its digest with the remote servers after each run and \
+answers queries of tinyids --check on a local socket. The agent runs in the \
+foreground until it receives a TERM or INT signal.""")
+    
+    parser.add_option('--backends', action='store', type='string',
+            dest='backends', metavar='NAMES', help="""Only run the backends \
+in the comma-delimited list NAMES and check their digests with those stored \
+at the remote servers. Can only be used with --check and requires that the \
+hash has been updated with per-backend digests enabled.""")
+    
     parser.add_option('--debug', action='store_true', dest='debug',
             help="""Run in debug mode. All messages will be printed to stdout.""")
     
@@ -109,11 +129,17 @@ You will be prompted for the current and the new passphrase.""")
         parser.error('invalid number of arguments')
     # Only one of the following options can be used at a time:
     # --check, --update, --delete, --change-phrase
-    nr = [opts.test, opts.check, opts.update, opts.delete, opts.changephrase].count(True)
+    nr = [opts.test, opts.check, opts.update, opts.delete, opts.changephrase, opts.agent].count(True)
     if nr == 0:
-        parser.error('a command must be run: --test, --check, --update, --delete, --change-phrase')
+        parser.error('a command must be run: --test, --check, --update, --delete, --change-phrase, --agent')
     elif nr != 1:
-        parser.error('only one of the following options can be used at a time: --test, --check, --update, --delete, --change-phrase')
+        parser.error('only one of the following options can be used at a time: --test, --check, --update, --delete, --change-phrase, --agent')
+    if opts.backends is not None:
+        if not opts.check:
+            parser.error('--backends can only be used with --check')
+        opts.backends = [name.strip() for name in opts.backends.split(',') if name.strip()]
+        if not opts.backends:
+            parser.error('--backends requires at least one backend name')
     
     return opts
 
@@ -130,6 +156,7 @@ def parse_server():
     parser.set_defaults(
         confpath = DEFAULT_SERVER_CONFIG,
         debug = False,
+        migrate_from = None,
     )
 
     parser.add_option('-c', '--config', action='store', type='string',
@@ -142,6 +169,12 @@ searched at the default location. [Default: %s]""" % (DEFAULT_CLIENT_CONFIG))
 into the background, will not drop privileges and all messages will be printed \
 to stderr. The logfile is not used.""")
     
+    parser.add_option('--migrate-from', action='store', type='string',
+            dest='migrate_from', metavar='ENGINE:PATH', help="""Copies all \
+records of the database at PATH, which uses the storage engine ENGINE, to the \
+database that is set in the configuration file (db_path, db_engine) and \
+exits. The server should not be running.""")
+    
     opts, args = parser.parse_args()
     if args:
         parser.error("invalid number of arguments")
@@ -24,13 +24,43 @@
 #
 
 import os
+import io
+import time
+import signal
 import glob
+import stat
+import fnmatch
+import mmap
 import logging
+import threading
 import subprocess
 import shlex
 import ConfigParser
+from multiprocessing.pool import ThreadPool
 
 from TinyIDS.config import TinyIDSConfigParser
+from TinyIDS.cache import DigestCache, CacheIntegrityError, stat_fingerprint
+from TinyIDS.throttle import TokenBucket
+from TinyIDS.watcher import InotifyWatcher, WatcherError, DEFAULT_RESCAN_INTERVAL
+from TinyIDS.util import MultiHasher, format_digests, parse_digests, DEFAULT_DIGEST_ALGORITHM
+
+
+# Read modes supported by BaseCollector.file_data()
+READ_MODES = ('read', 'stream', 'mmap')
+DEFAULT_READ_MODE = 'stream'
+DEFAULT_CHUNK_SIZE = 1048576    # 1 MiB
+
+# Defaults of the per-file digest cache used by BaseCollector.file_digests()
+DEFAULT_DIGEST_CACHE_DIR = '/var/lib/tinyids'
+DEFAULT_DIGEST_CACHE_KEY_DIR = '/etc/tinyids/keys'
+DEFAULT_DIGEST_CACHE_VERIFY_INTERVAL = 7    # days
+
+# Defaults of the external commands executed by BaseCollector.command_outputs()
+DEFAULT_COMMAND_CONCURRENCY = 1
+DEFAULT_COMMAND_TIMEOUT = 300   # seconds
+COMMAND_READ_SIZE = 65536
+STDERR_LIMIT = 65536
+COMMAND_POLL_INTERVAL = 0.05    # seconds
 
 
 class BaseBackendError(Exception):
@@ -45,6 +75,125 @@ class BackendConfigurationError(BaseBackendError):
 class ExternalCommandError(BaseBackendError):
     pass
 
+class ExternalCommandTimeout(ExternalCommandError):
+    pass
+
+
+class FileScan:
+    """Filesystem scan service, which is shared by all backends in a run.
+    
+    Expands glob expressions in the same way as glob.glob() does, but each
+    directory is listed and each path is stat'ed at most once per instance.
+    The expansion of each glob expression is also cached, so backends that
+    scan the same paths receive the same, already stat'ed, entries in the
+    same order.
+    
+    Since the results are cached, a new instance should be used for each
+    run. An instance may be shared between threads. Concurrent lookups of
+    the same entry may at worst repeat the system call.
+    
+    Counters:
+    
+      listdir_calls: number of directories listed.
+      stat_calls: number of paths stat'ed.
+    
+    """
+    
+    def __init__(self):
+        self._listings = {}
+        self._stats = {}
+        self._lstats = {}
+        self._expansions = {}
+        self.listdir_calls = 0
+        self.stat_calls = 0
+    
+    def listdir(self, directory):
+        """Returns the list of entries of the directory or an empty list."""
+        try:
+            return self._listings[directory]
+        except KeyError:
+            self.listdir_calls += 1
+            try:
+                names = os.listdir(directory)
+            except os.error:
+                names = []
+            self._listings[directory] = names
+            return names
+    
+    def stat(self, path):
+        """Returns the os.stat() result of the path or None, if the path
+        does not exist. Symbolic links are followed."""
+        try:
+            return self._stats[path]
+        except KeyError:
+            self.stat_calls += 1
+            try:
+                st = os.stat(path)
+            except os.error:
+                st = None
+            self._stats[path] = st
+            return st
+    
+    def _lexists(self, path):
+        try:
+            return self._lstats[path]
+        except KeyError:
+            self.stat_calls += 1
+            self._lstats[path] = os.path.lexists(path)
+            return self._lstats[path]
+    
+    def _glob1(self, dirname, pattern):
+        names = self.listdir(dirname or os.curdir)
+        if pattern[0] != '.':
+            names = [name for name in names if name[0] != '.']
+        return fnmatch.filter(names, pattern)
+    
+    def _glob0(self, dirname, basename):
+        if basename == '':
+            st = self.stat(dirname)
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                return [basename]
+        elif self._lexists(os.path.join(dirname, basename)):
+            return [basename]
+        return []
+    
+    def _iglob(self, pathname):
+        """Same as glob.iglob() using the cached directory listings."""
+        if not glob.has_magic(pathname):
+            if self._lexists(pathname):
+                yield pathname
+            return
+        dirname, basename = os.path.split(pathname)
+        if not dirname:
+            for name in self._glob1(os.curdir, basename):
+                yield name
+            return
+        if dirname != pathname and glob.has_magic(dirname):
+            dirs = self._iglob(dirname)
+        else:
+            dirs = [dirname]
+        if glob.has_magic(basename):
+            glob_in_dir = self._glob1
+        else:
+            glob_in_dir = self._glob0
+        for dirname in dirs:
+            for name in glob_in_dir(dirname, basename):
+                yield os.path.join(dirname, name)
+    
+    def expand(self, glob_exp):
+        """Returns a list of (path, stat) tuples for all the regular files
+        that match the glob expression. Symbolic links are followed."""
+        try:
+            return self._expansions[glob_exp]
+        except KeyError:
+            entries = []
+            for path in self._iglob(glob_exp):
+                st = self.stat(path)
+                if st is not None and stat.S_ISREG(st.st_mode):
+                    entries.append((path, st))
+            self._expansions[glob_exp] = entries
+            return entries
+
 
 class BaseCollector:
     """Base class for data collector backends.
@@ -69,7 +218,14 @@ class BaseCollector:
     duplicating work between different backends. 
     
     * file_paths(): a file path generator (helper method)
+    * file_entries(): a (path, stat) generator (helper method)
+    * file_results(): an incremental per-file result generator (helper method)
+    * file_data(): a file content generator (helper method)
+    * file_digests(): a per-file digest generator (helper method)
     * command_args(): a command generator (helper method)
+    * command_outputs(): a command output generator (helper method)
+    * command_streams(): a streaming command output generator (helper method)
+    * command_stream(): executes a system command (streaming helper method)
     * external_command(): executes a system command (helper method)
     
     Instance Mandatory Methods
@@ -81,6 +237,33 @@ class BaseCollector:
     
     name = 'OVERRIDE'
     
+    # Number of threads file_digests() uses in order to hash files
+    # concurrently. It is set by the client.
+    hashing_workers = 1
+    
+    # Digest algorithms of the per-file digests. It is set by the client
+    # to the algorithms of the checksum.
+    digest_algorithms = [DEFAULT_DIGEST_ALGORITHM]
+    
+    # FileScan instance shared by all backends of a run. It is set by the
+    # client. If it is not set, each call to file_entries() uses its own.
+    scan = None
+    
+    # If True, file_results() keeps track of changed files with inotify
+    # between collections. It is set by the client.
+    watch_files = False
+    watch_rescan_interval = DEFAULT_RESCAN_INTERVAL
+    
+    # Default limits of the rate at which file_data() reads files (0 means
+    # unlimited). They are set by the client and can be overridden by the
+    # options of the same name in the backend configuration.
+    max_bytes_per_sec = 0
+    max_files_per_sec = 0
+    
+    # PressureMonitor instance that adjusts the rate limits according to
+    # the load of the host. It is set by the client in adaptive mode.
+    pressure_monitor = None
+    
     def __init__(self, config_path=None):
         """Constructor.
         
@@ -92,6 +275,8 @@ class BaseCollector:
         
           logger: a logging logger object.
           cfg: a ConfigParser instance containing the backend configuration.
+          read_mode: the mode file_data() uses in order to read files.
+          chunk_size: the size of the chunks in 'stream' read mode.
         
         """
         self.logger = logging.getLogger()
@@ -100,7 +285,113 @@ class BaseCollector:
             if os.path.exists(config_path):
                 self.cfg.read(config_path)
                 self.logger.debug('%s: Using configuration from: %s' % (self.name, config_path))
+        self.read_mode, self.chunk_size = self._get_read_settings()
+        self.command_concurrency = self._get_number('command_concurrency', DEFAULT_COMMAND_CONCURRENCY, int)
+        self.command_timeout = self._get_number('command_timeout', DEFAULT_COMMAND_TIMEOUT, float, allow_zero=True)
+        
+        # Rate limits set in the backend configuration (None if not set) and
+        # the TokenBucket instances that enforce the limits. The buckets are
+        # shared by all hashing worker threads.
+        self._max_bytes_per_sec = self._get_number('max_bytes_per_sec', None, int, allow_zero=True)
+        self._max_files_per_sec = self._get_number('max_files_per_sec', None, float, allow_zero=True)
+        self._throttle = None
+        
+        # Holds the buffer that is reused for all chunks read in 'stream'
+        # mode. Each hashing worker thread uses its own buffer.
+        self._local = threading.local()
+        
+        # Used by file_results(): the InotifyWatcher instance, the paths and
+        # the per-path results of the previous collection.
+        self.watcher = None
+        self._watched_paths = None
+        self._watched_results = None
+    
+    def _get_number(self, option, default, cast, allow_zero=False):
+        """Returns the value of a numeric option of the [main] section.
+        
+        Returns 'default' if the option is not set or if it is empty. If the
+        value is not a positive number (or zero, if 'allow_zero' is True),
+        raises BackendConfigurationError.
         
+        """
+        value = self.cfg.get_or_default('main', option, '')
+        if not value:
+            return default
+        try:
+            number = cast(value)
+        except ValueError:
+            number = -1
+        if number < 0 or (number == 0 and not allow_zero):
+            raise BackendConfigurationError('Invalid %s: %s' % (option, value))
+        return number
+    
+    def _get_read_settings(self):
+        """Returns the (read_mode, chunk_size) tuple.
+        
+        Optional configuration file.
+        
+        [main]
+        read_mode = stream
+        chunk_size = 1048576
+        
+        On invalid values, raises BackendConfigurationError.
+        
+        """
+        read_mode = self.cfg.get_or_default('main', 'read_mode', DEFAULT_READ_MODE).lower()
+        if read_mode not in READ_MODES:
+            raise BackendConfigurationError('Invalid read mode: %s' % read_mode)
+        chunk_size = self._get_number('chunk_size', DEFAULT_CHUNK_SIZE, int)
+        return read_mode, chunk_size
+    
+    def _get_throttle(self):
+        """Returns the (bytes, files) tuple of TokenBucket instances that
+        limit the rate at which file_data() reads files.
+        
+        Optional configuration file.
+        
+        [main]
+        max_bytes_per_sec = 0
+        max_files_per_sec = 0
+        
+        If an option is not set in the backend configuration, the value set
+        by the client is used. 0 means unlimited. If the client has set a
+        pressure monitor, the limits are lowered while the host is busy.
+        
+        """
+        if self._throttle is None:
+            max_bytes_per_sec = self._max_bytes_per_sec
+            if max_bytes_per_sec is None:
+                max_bytes_per_sec = self.max_bytes_per_sec
+            max_files_per_sec = self._max_files_per_sec
+            if max_files_per_sec is None:
+                max_files_per_sec = self.max_files_per_sec
+            if max_bytes_per_sec or max_files_per_sec:
+                self.logger.debug('%s: Reading at most %s bytes and %s files per second (0 is unlimited)' % (
+                    self.name, max_bytes_per_sec, max_files_per_sec))
+            # Allow bursts of one chunk, so that files are read in whole chunks
+            monitor = self.pressure_monitor
+            self._throttle = (
+                TokenBucket(max_bytes_per_sec, max(max_bytes_per_sec, self.chunk_size), monitor),
+                TokenBucket(max_files_per_sec, max(max_files_per_sec, 1), monitor))
+        return self._throttle
+    
+    def get_throttled_time(self):
+        """Returns a (seconds, count) tuple: the total time file_data() has
+        waited because of the rate limits and the number of waits."""
+        if self._throttle is None:
+            return 0.0, 0
+        seconds = sum([bucket.throttled_time for bucket in self._throttle])
+        count = sum([bucket.throttled_count for bucket in self._throttle])
+        return seconds, count
+    
+    def _get_read_buffer(self):
+        """Returns the buffer of the current thread that is used for reading
+        in 'stream' mode."""
+        buf = getattr(self._local, 'read_buffer', None)
+        if buf is None or len(buf) != self.chunk_size:
+            buf = self._local.read_buffer = bytearray(self.chunk_size)
+        return buf
+    
     def file_paths(self, default_glob_exp):
         """File path generator.
         
@@ -121,6 +412,21 @@ class BaseCollector:
             a. Expands each glob expression into a list of paths.
             b. Iterates over the list of paths and returns them one by one. 
         
+        """
+        for path, st in self.file_entries(default_glob_exp):
+            yield path
+    
+    def file_entries(self, default_glob_exp):
+        """File entry generator.
+        
+        Same as file_paths(), but yields a (path, stat) tuple for each file,
+        where stat is the os.stat() result of the path.
+        
+        The glob expressions are expanded by the FileScan instance that is
+        shared by all backends (see the 'scan' attribute), so directories
+        that are scanned by several backends are listed once and each path
+        is stat'ed once.
+        
         """
         paths = default_glob_exp
         try:
@@ -129,13 +435,340 @@ class BaseCollector:
             self.logger.debug('%s: Scanning internal default paths' % self.name)
         else:
             self.logger.debug('%s: Scanning user-defined paths' % self.name)
+        scan = self.scan
+        if scan is None:
+            scan = FileScan()
+        for path in paths:
+            for entry in scan.expand(path):  # Follows symbolic links
+                yield entry
+    
+    def file_stat(self, path):
+        """Returns the os.stat() result of the path.
+        
+        The result is retrieved from the shared FileScan instance, if the path
+        has already been stat'ed during this run.
+        
+        """
+        if self.scan is not None:
+            st = self.scan.stat(path)
+            if st is not None:
+                return st
+        return os.stat(path)
+    
+    def file_data(self, path):
+        """File content generator.
+        
+        Yields the contents of the file at 'path'. How the file is read
+        depends on the 'read_mode' option of the backend configuration:
+        
+          read: the whole file is read into memory and yielded at once.
+          stream: the file is read in chunks of 'chunk_size' bytes into a
+            buffer, which is reused for all chunks. Memory usage does not
+            depend on the size of the file.
+          mmap: the file is memory-mapped and the mapping is yielded
+            without copying its contents.
+        
+        Whatever the read mode is, the yielded pieces add up to the same
+        data, so they produce the same checksum when they are hashed.
+        
+        The rate at which files are opened and bytes are read is limited
+        according to the 'max_files_per_sec' and 'max_bytes_per_sec' options
+        (see _get_throttle()). Each chunk is accounted for before it is
+        read, so a large file is read at a steady rate, while reading a small
+        file hardly ever waits.
+        
+        The yielded objects support the buffer interface. They are only
+        valid until the generator is resumed, so consumers should pass
+        them through the hashing algorithm immediately and keep no
+        references to them.
+        
+        """
+        byte_bucket, file_bucket = self._get_throttle()
+        file_bucket.consume(1)
+        if self.read_mode == 'read':
+            f = open(path, 'rb')
+            try:
+                byte_bucket.consume(os.fstat(f.fileno()).st_size)
+                yield f.read()
+            finally:
+                f.close()
+        elif self.read_mode == 'stream':
+            buf = self._get_read_buffer()
+            f = io.open(path, 'rb', buffering=0)
+            try:
+                size = os.fstat(f.fileno()).st_size
+                while True:
+                    # The last chunk is usually smaller than the buffer
+                    byte_bucket.consume(max(min(size, len(buf)), 1))
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    size -= n
+                    yield buffer(buf, 0, n)
+            finally:
+                f.close()
+        elif self.read_mode == 'mmap':
+            f = open(path, 'rb')
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    # Empty files cannot be mapped
+                    return
+                byte_bucket.consume(size)
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    yield m
+                finally:
+                    m.close()
+            finally:
+                f.close()
+    
+    def _get_digest_cache(self):
+        """Returns a loaded DigestCache instance or None.
+        
+        Optional configuration file.
+        
+        [main]
+        digest_cache = 0
+        digest_cache_path = /var/lib/tinyids/<backend_name>.cache
+        digest_cache_key = /etc/tinyids/keys/<backend_name>.cache.key
+        digest_cache_verify_interval = 7
+        
+        Returns None if the digest cache has not been enabled or if it
+        cannot be used. On invalid values, raises BackendConfigurationError.
+        
+        """
+        if not self.cfg.has_option('main', 'digest_cache'):
+            return None
+        elif not self.cfg.getboolean('main', 'digest_cache'):
+            return None
+        basename = self.name.split('.')[-1]
+        path = self.cfg.get_or_default('main', 'digest_cache_path',
+            os.path.join(DEFAULT_DIGEST_CACHE_DIR, '%s.cache' % basename))
+        key_path = self.cfg.get_or_default('main', 'digest_cache_key',
+            os.path.join(DEFAULT_DIGEST_CACHE_KEY_DIR, '%s.cache.key' % basename))
+        verify_interval = self._get_number('digest_cache_verify_interval',
+            DEFAULT_DIGEST_CACHE_VERIFY_INTERVAL, float, allow_zero=True)
+        cache = DigestCache(path, key_path, verify_interval * 86400)
+        try:
+            cache.load()
+        except CacheIntegrityError, strerror:
+            self.logger.warning('%s: Digest cache discarded: %s: %s' % (self.name, strerror, path))
+        except (IOError, OSError), (errno, strerror):
+            self.logger.warning('%s: Digest cache disabled: %s' % (self.name, strerror))
+            return None
+        if cache.full_verification:
+            self.logger.info('%s: Digest cache: performing full verification' % self.name)
+        return cache
+    
+    def file_digest(self, path, algorithms=None):
+        """Returns the digests of the contents of the file at 'path' as a
+        dictionary: {<algorithm>: <hexdigest>, ...}
+        
+        The digests of all algorithms (default: 'digest_algorithms') are
+        calculated while the file is read once.
+        
+        """
+        hasher = MultiHasher(algorithms or self.digest_algorithms)
+        for data in self.file_data(path):
+            hasher.update(data)
+        return dict(hasher.hexdigests())
+    
+    def _lookup_file_digest(self, cache, fingerprint):
+        """Returns the cached digests of all 'digest_algorithms' or None."""
+        cached = cache.lookup(fingerprint)
+        if cached is None:
+            return None
+        try:
+            digests = parse_digests(cached)
+        except ValueError:
+            return None
+        for algorithm in self.digest_algorithms:
+            if not digests.has_key(algorithm):
+                return None
+        return dict([(algorithm, digests[algorithm]) for algorithm in self.digest_algorithms])
+    
+    def _get_file_digest(self, path, cache):
+        """Returns the (path, digests) tuple for the file at 'path' (see
+        file_digest()).
+        
+        Uses the provided DigestCache instance, if it is not None. The
+        digests are cached together with their algorithm names (see
+        util.format_digests()), so cached digests of other algorithms are
+        never used.
+        
+        """
+        if cache is None:
+            return path, self.file_digest(path)
+        fingerprint = stat_fingerprint(self.file_stat(path))
+        digests = self._lookup_file_digest(cache, fingerprint)
+        if digests is None:
+            digests = self.file_digest(path)
+            # Do not cache the digest of a file that changed while it
+            # was being read.
+            if stat_fingerprint(os.stat(path)) == fingerprint:
+                cache.store(fingerprint, format_digests(sorted(digests.items())))
+        return path, digests
+    
+    def file_digests(self, paths, complete=True):
+        """Per-file digest generator.
+        
+        Accepts an iterable of file paths and yields a (path, digests) tuple
+        for each one of them, in the same order (see file_digest()).
+        'complete' should be False if 'paths' is only a part of the files
+        of the backend.
+        
+        If 'hashing_workers' is greater than 1, the files are read and
+        hashed concurrently by a pool of threads. The digests are still
+        yielded in the order of the provided paths, so the result does not
+        depend on the number of workers or on the order in which the
+        workers finish.
+        
+        Each file is read at most once. Paths that resolve to the device and
+        inode of a path that precedes them yield the digest of that path.
+        The number of bytes that did not have to be read is logged.
+        
+        If the digest cache has been enabled in the backend configuration
+        (see _get_digest_cache()), the digests of files whose stat
+        fingerprint has not changed since the previous run are retrieved
+        from the cache and the files are not read. The cache is saved and
+        the number of cache hits and misses is logged after the last path
+        has been processed. The digests of files that have not been
+        processed are dropped from the cache only if 'complete' is True.
+        
+        """
+        # Files that are reachable through several paths (hard links,
+        # symbolic links, merged-/usr directories) are identified by their
+        # device and inode numbers and are read and hashed only once.
+        paths = list(paths)
+        unique_paths = []
+        inode2index = {}
+        indexes = []
+        saved_bytes = 0
         for path in paths:
-            file_list = glob.glob(path)
-            for fpath in file_list:
-                if os.path.isfile(fpath):   # Follows symbolic links
-                    yield fpath
+            st = self.file_stat(path)
+            key = (st.st_dev, st.st_ino)
+            if inode2index.has_key(key):
+                saved_bytes += st.st_size
+            else:
+                inode2index[key] = len(unique_paths)
+                unique_paths.append(path)
+            indexes.append(inode2index[key])
+        
+        cache = self._get_digest_cache()
+        pool = None
+        if self.hashing_workers > 1:
+            self.logger.debug('%s: Hashing files using %d workers' % (self.name, self.hashing_workers))
+            # Create the rate limiters before the workers share them
+            self._get_throttle()
+            pool = ThreadPool(self.hashing_workers)
+            results = pool.imap(lambda path: self._get_file_digest(path, cache), unique_paths)
+        else:
+            results = (self._get_file_digest(path, cache) for path in unique_paths)
+        try:
+            # The first path of each inode always precedes the paths that
+            # reference its digest, so the digests are retrieved in order.
+            digests = []
+            for path, index in zip(paths, indexes):
+                if index == len(digests):
+                    digests.append(results.next()[1])
+                yield path, digests[index]
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if len(unique_paths) < len(paths):
+            self.logger.info('%s: Deduplication: %d paths reference already hashed files, %d bytes not read' % (
+                self.name, len(paths) - len(unique_paths), saved_bytes))
+        if cache is not None:
+            try:
+                cache.save(prune=complete)
+            except (IOError, OSError), (errno, strerror):
+                self.logger.warning('%s: Could not save digest cache: %s' % (self.name, strerror))
+            self.logger.info('%s: Digest cache: %d hits, %d misses' % (self.name, cache.hits, cache.misses))
     
-    def command_args(self, default_commands):
+    def _get_watcher(self):
+        """Returns the InotifyWatcher instance or None, if files should not
+        be watched or if inotify is not available."""
+        if not self.watch_files:
+            return None
+        if self.watcher is None:
+            try:
+                self.watcher = InotifyWatcher(self.watch_rescan_interval)
+            except WatcherError, strerror:
+                self.logger.warning('%s: File watcher disabled: %s' % (self.name, strerror))
+                self.watch_files = False
+                return None
+        return self.watcher
+    
+    def _expand_paths(self, default_glob_exp, sort):
+        paths = self.file_paths(default_glob_exp)
+        if sort:
+            return sorted(set(paths))
+        return list(paths)
+    
+    def file_results(self, default_glob_exp, results_func, sort=False):
+        """Incremental per-file result generator.
+        
+        Expands the glob expressions using file_paths() and yields a
+        (path, result) tuple for each path. If 'sort' is True, each path
+        is yielded once in sorted order.
+        
+        'results_func' should be a generator function that accepts a list
+        of paths and a boolean, which is True if the list contains all the
+        paths, and yields a (path, result) tuple for each path of the list
+        in the same order.
+        
+        If files are watched (see 'watch_files'), the results of the
+        previous collection are kept. The next collection passes only the
+        paths that have changed since then to 'results_func' and reuses
+        the previous results of all other paths. The paths are expanded
+        again only if entries have been added to or removed from a watched
+        directory. Whenever the watcher has lost events, all paths are
+        passed to 'results_func'.
+        
+        """
+        watcher = self._get_watcher()
+        if watcher is None:
+            for item in results_func(self._expand_paths(default_glob_exp, sort), True):
+                yield item
+            return
+        
+        rescan, listing_changed, dirty = watcher.get_changes()
+        if rescan or self._watched_results is None:
+            self.logger.debug('%s: File watcher: full rescan' % self.name)
+            paths = self._expand_paths(default_glob_exp, sort)
+            watcher.watch(paths)
+            previous = {}
+            pending = paths
+        else:
+            paths = self._watched_paths
+            if listing_changed:
+                paths = self._expand_paths(default_glob_exp, sort)
+                watcher.watch(paths, rescan=False)
+            previous = self._watched_results
+            pending = [path for path in paths if path in dirty or not previous.has_key(path)]
+            self.logger.debug('%s: File watcher: %d of %d paths changed' % (self.name, len(pending), len(paths)))
+        
+        results = {}
+        pending_set = set(pending)
+        pending_results = results_func(pending, pending is paths)
+        for path in paths:
+            if path in pending_set:
+                path, result = pending_results.next()
+            else:
+                result = previous[path]
+            results[path] = result
+            yield path, result
+        for item in pending_results:
+            pass
+        
+        self._watched_paths = paths
+        self._watched_results = results
+        self.logger.info('%s: File watcher: %d events, %d overflows, %d rescans' % (
+            self.name, watcher.events, watcher.overflows, watcher.rescans))
+    
+    def command_args(self, default_commands, option='commands'):
         """Command generator.
         
         Each command is returned as a list of arguments.
@@ -151,6 +784,7 @@ class BaseCollector:
         The command_args() generator:
         
           1. tries to retrieve a list of commands from the configuration file.
+             The name of the option can be changed with 'option'.
           2. If this is not possible, it uses the default_commands list.
         
         Iterates over the list of commands and returns each command as a
@@ -159,7 +793,7 @@ class BaseCollector:
         """
         commands = default_commands
         try:
-            commands = self.cfg.getlist('main', 'commands')
+            commands = self.cfg.getlist('main', option)
         except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             if not default_commands:
                 raise InternalBackendError('No commands to execute')
@@ -169,22 +803,199 @@ class BaseCollector:
         for command in commands:
             yield shlex.split(command)
     
-    def external_command(self, args):
+    def command_outputs(self, default_commands, option='commands'):
+        """Command output generator.
+        
+        Executes the commands returned by command_args() and yields the
+        output of each command from STDOUT in the order the commands have
+        been configured.
+        
+        Optional configuration file.
+        
+        [main]
+        command_concurrency = 1
+        command_timeout = 300
+        
+        Up to 'command_concurrency' commands are executed at the same time.
+        Each command is killed if it runs for longer than 'command_timeout'
+        seconds (0 disables the timeout). See external_command().
+        
+        """
+        for chunks in self.command_streams(default_commands, option):
+            yield ''.join(chunks)
+    
+    def command_streams(self, default_commands, option='commands'):
+        """Command output stream generator.
+        
+        Same as command_outputs(), but yields an iterator over the chunks of
+        the output of each command (see command_stream()) instead of the
+        whole output. Each iterator should be exhausted before the next one
+        is requested.
+        
+        If commands are executed one at a time, the output of each command
+        is yielded while the command runs. If they are executed concurrently,
+        the output of the commands that wait for their turn is kept in
+        memory. If a command fails or the generator is closed early, the
+        commands that are still running are killed.
+        
+        """
+        commands = list(self.command_args(default_commands, option))
+        if self.command_concurrency > 1 and len(commands) > 1:
+            # The running commands by process ID
+            running = {}
+            pool = ThreadPool(min(self.command_concurrency, len(commands)))
+            try:
+                for stdout in pool.imap(lambda args: ''.join(self.command_stream(args, running=running)), commands):
+                    yield iter([stdout])
+            finally:
+                # The worker threads cannot be stopped while they wait for
+                # their commands.
+                for p, lock, killed in running.values():
+                    self._kill_process_group(p, lock, killed)
+                pool.terminate()
+                pool.join()
+        else:
+            for args in commands:
+                yield self.command_stream(args)
+    
+    def external_command(self, args, timeout=None):
         """Executes an external command.
         
-        Accepts a list of command-line arguments.
+        Accepts a list of command-line arguments and an optional timeout in
+        seconds. If the timeout is not set, the 'command_timeout' option
+        of the backend configuration is used.
         
         Returns the command output from STDOUT.
         
+        See command_stream() for information about timeouts and errors.
+        
+        """
+        return ''.join(self.command_stream(args, timeout))
+    
+    def command_stream(self, args, timeout=None, running=None):
+        """Executes an external command and yields its output from STDOUT in
+        chunks as soon as they become available.
+        
+        Accepts a list of command-line arguments and an optional timeout in
+        seconds. If the timeout is not set, the 'command_timeout' option
+        of the backend configuration is used.
+        
+        If the 'running' dictionary is provided, the command is kept in it
+        while it runs (see command_streams()).
+        
+        STDERR is read concurrently by a separate thread, which keeps only
+        its last STDERR_LIMIT bytes, so that memory usage does not depend on
+        the size of the output.
+        
+        The command runs in its own process group. If it is still running
+        when the timeout expires, or when the generator is closed before
+        the output has been read, the whole process group is killed. In the
+        former case the ExternalCommandTimeout exception is raised. The
+        process is only reaped while its lock is held, so that the process
+        group is never killed after the process has exited and its ID may
+        have been reused.
+        
         On error, raises the ExternalCommandError exception containing the
-        STDERR information.
+        STDERR information. Since the output is yielded as it arrives, the
+        exception is raised after all of it has been yielded.
+        
+        The duration and the exit status of the command are logged.
         
         """
-        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
+        if timeout is None:
+            timeout = self.command_timeout
+        t0 = time.time()
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            preexec_fn=os.setsid, close_fds=True)
+        lock = threading.Lock()
+        killed = threading.Event()
+        if running is not None:
+            running[p.pid] = (p, lock, killed)
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._kill_process_group, (p, lock, killed))
+            timer.start()
+        stderr = []
+        stderr_reader = threading.Thread(target=self._drain_stderr, args=(p.stderr, stderr))
+        stderr_reader.setDaemon(True)
+        stderr_reader.start()
+        try:
+            fd = p.stdout.fileno()
+            while True:
+                data = os.read(fd, COMMAND_READ_SIZE)
+                if not data:
+                    break
+                yield data
+            self._wait_process(p, lock)
+            stderr_reader.join()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if p.returncode is None:
+                # The generator has been closed early
+                self._kill_process_group(p, lock, killed)
+                self._wait_process(p, lock)
+            if running is not None:
+                del running[p.pid]
+            p.stdout.close()
+        elapsed = time.time() - t0
+        command = ' '.join(args)
+        if killed.is_set():
+            self.logger.warning('%s: Command killed after %.3f seconds: %s' % (self.name, elapsed, command))
+            raise ExternalCommandTimeout('Timed out after %s seconds: %s' % (timeout, command))
+        self.logger.info('%s: Command finished in %.3f seconds with exit status %s: %s' % (
+            self.name, elapsed, p.returncode, command))
         if p.returncode != 0:
-            raise ExternalCommandError(stderr)
-        return stdout
+            raise ExternalCommandError(''.join(stderr)[-STDERR_LIMIT:])
+    
+    def _drain_stderr(self, f, stderr):
+        """Reads f until EOF and keeps its last STDERR_LIMIT bytes in the
+        'stderr' list."""
+        size = 0
+        try:
+            while True:
+                data = os.read(f.fileno(), COMMAND_READ_SIZE)
+                if not data:
+                    break
+                stderr.append(data)
+                size += len(data)
+                while size - len(stderr[0]) >= STDERR_LIMIT:
+                    size -= len(stderr.pop(0))
+        finally:
+            f.close()
+    
+    def _wait_process(self, p, lock):
+        """Waits until the subprocess.Popen instance exits.
+        
+        The process is polled while the lock is held, so that it is not
+        reaped while _kill_process_group() runs.
+        
+        """
+        delay = 0.001
+        while True:
+            lock.acquire()
+            try:
+                if p.poll() is not None:
+                    return
+            finally:
+                lock.release()
+            time.sleep(delay)
+            delay = min(delay * 2, COMMAND_POLL_INTERVAL)
+    
+    def _kill_process_group(self, p, lock, killed):
+        """Kills the process group of the subprocess.Popen instance and
+        sets the 'killed' event, if the process is still running."""
+        lock.acquire()
+        try:
+            if p.poll() is not None:
+                return
+            killed.set()
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        finally:
+            lock.release()
     
     def collect(self):
         """Information generator.
@@ -193,6 +1004,10 @@ class BaseCollector:
         
         The yielded information will finally pass through a hashing algorithm.
         
+        A dictionary {<algorithm>: <data>, ...} may be yielded instead of a
+        string, so that different data passes through each digest algorithm
+        (see util.MultiHasher.update()).
+        
         Should be overridden by backends that derive from the base class.
         
         """
@@ -23,11 +23,17 @@
 #  limitations under the License.
 #
 
-PROTOCOL_REVISION = 2
-COMPATIBLE_PROTOCOL_REVISIONS = (PROTOCOL_REVISION,)
+PROTOCOL_REVISION = 3
+# Revision 2 carries a single plain command line per connection.
+LEGACY_PROTOCOL_REVISION = 2
+COMPATIBLE_PROTOCOL_REVISIONS = (LEGACY_PROTOCOL_REVISION, PROTOCOL_REVISION)
 DEFAULT_SERVER_CONFIG = '/etc/tinyids/tinyidsd.conf'
 DEFAULT_CLIENT_CONFIG = '/etc/tinyids/tinyids.conf'
 DEFAULT_PORT = 10500
+DEFAULT_IDLE_TIMEOUT = 60   # seconds
+DEFAULT_LISTEN_BACKLOG = 128
+DEFAULT_SERVER_ENGINE = 'threading'
+DEFAULT_SERVER_WORKERS = 4
 DEFAULT_DATABASE_PATH = '/var/lib/tinyids/tinyids.db'
 DEFAULT_LOGFILE_PATH = '/var/log/tinyidsd.log'
 DEFAULT_LOGLEVEL = 'info'
@@ -24,9 +24,17 @@
 #
 
 import os
-import anydbm
+import time
+import threading
 
-from TinyIDS.util import sha1sum
+from TinyIDS.util import sha1sum, parse_digest_vector
+from TinyIDS.storage import get_storage_engine, StorageError, DEFAULT_STORAGE_ENGINE
+from TinyIDS.record import pack_ip, unpack_ip, get_record_key, pack_record, unpack_record
+from TinyIDS.record import format_hash, build_index, RecordIndex
+
+
+# The time of the last check of a client is stored at most this often
+LAST_CHECK_INTERVAL = 3600  # seconds
 
 
 class InitializationError(Exception):
@@ -43,19 +51,65 @@ class HashDatabase:
     """Implements a database object, where hashes and passphrases are stored
     for each client IP address.
     
-    Records are of the format:
+    Records are stored by the binary form of the client IP address (see
+    record.pack_ip()) in the binary format of record.pack_record(), which
+    contains the digests, the encrypted passphrase and the times of the
+    last update and of the last check of the client.
+    
+    Records of previous versions are of the format:
     
     <client_ip> : <hash>____<passhphrase_crypted>
     
+    They are read as they are and are replaced by a binary record when they
+    are changed.
+    
+    The records are kept by a storage engine (see storage.STORAGE_ENGINES).
+    Access to the storage engine is serialized, so the methods of the
+    public API may be called from several threads.
+    
+    If a cache.LRUCache instance is provided, the records that are read from
+    the storage engine are cached, including the client IPs for which there
+    is no record. A cached record is invalidated whenever a change of it is
+    published.
+    
+    The methods that change the database return after the storage engine
+    has written the change to the disk (see storage.StorageEngine.commit()),
+    unless 'autocommit' is set to False, in which case the caller should
+    call commit().
+    
+    Changes are published by commit(): until then get() and check() return
+    the previous records, so that no client is answered with a change that
+    could still be lost in a crash. The methods that change the database
+    always see the latest changes, so that their passphrase checks use the
+    latest records.
+    
+    If index_build() has been called, the published changes are also written
+    to the record index (see record.RecordIndex).
+    
     """
-    def __init__(self, path):
+    def __init__(self, path, engine=DEFAULT_STORAGE_ENGINE, cache=None, engine_options=None):
         """Database object constructor.
         
-        Accepts a path to the database on the filesystem.
+        Accepts a path to the database on the filesystem, the name of the
+        storage engine, an optional cache.LRUCache instance and a dictionary
+        of options for the storage engine.
         
         """
         self.path = os.path.abspath(path)
+        self.engine = engine
+        self.cache = cache
+        self.engine_options = engine_options or {}
+        self.autocommit = True
         self.db = None
+        self.index = None
+        # Number of changed records that are not in the index
+        self.index_outdated = 0
+        self._lock = threading.Lock()
+        # client_ip : (sequence number, record, checked) of the changes that
+        # have not been published. The record of a removed client IP is None.
+        # 'checked' is True if only the time of the last check was changed.
+        self._unpublished = {}
+        self._sequence = 0
     
     # Private API
     
@@ -75,33 +129,110 @@ class HashDatabase:
         passphrase_enc = self._get_crypted_passphrase(client_ip, passphrase_raw)
         return passphrase_enc == passphrase_db
     
-    def _read(self, client_ip):
-        """Reads the client IP's data from the database and returns a tuple:
+    def _get_record(self, client_ip):
+        record = self.db.get(pack_ip(client_ip))
+        if record is None:
+            # Record of a previous version
+            record = self.db.get(client_ip)
+        return record
+    
+    def _read(self, client_ip, latest=False):
+        """Reads the client IP's data from the database and returns a tuple
+        (see record.unpack_record()):
+        
+            digests, backend_digests, passphrase, last_update, last_check
+        
+        If 'latest' is True, changes that have not been published are also
+        returned.
         
-            hash, passphrase
+        If there is no data for the client IP, raises HashDoesNotExistError.
         
         """
-        return self.db[client_ip].split('____')
+        if latest and self._unpublished.has_key(client_ip):
+            record = self._unpublished[client_ip][1]
+        elif self.cache is None:
+            record = self._get_record(client_ip)
+        else:
+            found, record = self.cache.lookup(client_ip)
+            if not found:
+                record = self._get_record(client_ip)
+                self.cache.store(client_ip, record)
+        if record is None:
+            raise HashDoesNotExistError
+        return unpack_record(record)
     
-    def _write(self, client_ip, hash, passphrase):
+    def _write(self, client_ip, digests, backend_digests, passphrase, last_update, last_check, checked=False):
         """Writes data to the database.
         
-        Data for each client is stored using the convention:
-        
-        <hash>____<passhphrase_crypted>
+        Data for each client is stored in the format of record.pack_record().
+        A record of a previous version is removed. 'checked' is True if only
+        the time of the last check is changed.
         
         """
-        self.db[client_ip] = '%s____%s' % (hash, passphrase)
+        record = pack_record(digests, backend_digests, passphrase, last_update, last_check)
+        self.db.put(pack_ip(client_ip), record)
+        self.db.delete(client_ip)
+        self._sequence += 1
+        self._unpublished[client_ip] = (self._sequence, record, checked)
+    
+    def _publish(self, sequence):
+        """Publishes the changes up to the sequence number to the cache and
+        the index. Should be called with the lock held."""
+        for client_ip, (change_sequence, record, checked) in self._unpublished.items():
+            if change_sequence > sequence:
+                # Published by the commit() that follows the change
+                continue
+            del self._unpublished[client_ip]
+            if self.cache is not None:
+                self.cache.invalidate(client_ip)
+            if self.index is not None and not self.index.update(pack_ip(client_ip), record) and record is not None:
+                self.index_outdated += 1
     
     # Public API
     
     def get(self, client_ip):
-        """Returns the stored hash for the client IP or Nonee if there is
-        no hash stored for the client IP."""
-        if not self.db.has_key(client_ip):
-            raise HashDoesNotExistError
-        hash_db, passphrase_db = self._read(client_ip)
-        return hash_db
+        """Returns the stored hash for the client IP.
+        
+        If there is no hash stored for the client IP, raises
+        HashDoesNotExistError.
+        
+        """
+        self._lock.acquire()
+        try:
+            digests, backend_digests = self._read(client_ip)[:2]
+        finally:
+            self._lock.release()
+        return format_hash(digests, backend_digests)
+    
+    def check(self, client_ip):
+        """Returns the digests stored for the client IP as a tuple:
+        
+            digests, backend_digests
+        
+        in the format of util.parse_digest_vector(), and stores the time of
+        the check. The time is stored at most once every LAST_CHECK_INTERVAL
+        seconds and is committed like the other changes.
+        
+        If there is no hash stored for the client IP, raises
+        HashDoesNotExistError.
+        
+        """
+        now = int(time.time())
+        changed = False
+        self._lock.acquire()
+        try:
+            digests, backend_digests, passphrase_db, last_update, last_check = self._read(client_ip)
+            # A pending change of the record by put() or remove() takes
+            # precedence
+            pending = self._unpublished.get(client_ip)
+            if now - last_check >= LAST_CHECK_INTERVAL and (pending is None or pending[2]):
+                self._write(client_ip, digests, backend_digests, passphrase_db, last_update, now, checked=True)
+                changed = True
+        finally:
+            self._lock.release()
+        if changed and self.autocommit:
+            self.commit()
+        return digests, backend_digests
     
     def put(self, client_ip, hash, passphrase_raw):
         """Stores a new hash for client IP or updates the existing one.
@@ -113,39 +244,85 @@ class HashDatabase:
         If a hash for the client IP does not exist in the database, store
         the hash and the encrypted passphrase in the db.
         
+        If the hash is invalid (see util.parse_digest_vector()), raises
+        ValueError.
+        
         """
-        if self.db.has_key(client_ip):
-            hash_db, passphrase_db = self._read(client_ip)
-            if not self._check_passphrase(client_ip, passphrase_raw, passphrase_db):
-                raise InvalidPassphraseError
-            self._write(client_ip, hash, passphrase_db)
-        else:
-            passphrase_enc = self._get_crypted_passphrase(client_ip, passphrase_raw)
-            self._write(client_ip, hash, passphrase_enc)
+        digests, backend_digests = parse_digest_vector(hash)
+        now = int(time.time())
+        self._lock.acquire()
+        try:
+            try:
+                passphrase_db, last_update, last_check = self._read(client_ip, latest=True)[2:]
+            except HashDoesNotExistError:
+                passphrase_enc = self._get_crypted_passphrase(client_ip, passphrase_raw)
+                self._write(client_ip, digests, backend_digests, passphrase_enc, now, 0)
+            else:
+                if not self._check_passphrase(client_ip, passphrase_raw, passphrase_db):
+                    raise InvalidPassphraseError
+                self._write(client_ip, digests, backend_digests, passphrase_db, now, last_check)
+        finally:
+            self._lock.release()
+        if self.autocommit:
+            self.commit()
     
     def remove(self, client_ip, passphrase_raw):
         """Removes the client IP's hash from the database if passphrase is OK."""
-        if not self.db.has_key(client_ip):
-            raise HashDoesNotExistError
-
-        hash_db, passphrase_db = self._read(client_ip)
-        if not self._check_passphrase(client_ip, passphrase_raw, passphrase_db):
-            raise InvalidPassphraseError
-        del self.db[client_ip]
+        self._lock.acquire()
+        try:
+            passphrase_db = self._read(client_ip, latest=True)[2]
+            if not self._check_passphrase(client_ip, passphrase_raw, passphrase_db):
+                raise InvalidPassphraseError
+            self.db.delete(pack_ip(client_ip))
+            self.db.delete(client_ip)
+            self._sequence += 1
+            self._unpublished[client_ip] = (self._sequence, None, False)
+        finally:
+            self._lock.release()
+        if self.autocommit:
+            self.commit()
     
     def change_passphrase(self, client_ip, passphrase_raw_old, passphrase_raw_new):
         """Changes client IP's passphrase if passphrase_raw_old is verified."""
-        if not self.db.has_key(client_ip):
-            raise HashDoesNotExistError
-        hash_db, passphrase_db = self._read(client_ip)
-        if not self._check_passphrase(client_ip, passphrase_raw_old, passphrase_db):
-            raise InvalidPassphraseError
-        passphrase_enc = self._get_crypted_passphrase(client_ip, passphrase_raw_new)
-        self._write(client_ip, hash_db, passphrase_enc)
+        self._lock.acquire()
+        try:
+            digests, backend_digests, passphrase_db, last_update, last_check = self._read(client_ip, latest=True)
+            if not self._check_passphrase(client_ip, passphrase_raw_old, passphrase_db):
+                raise InvalidPassphraseError
+            passphrase_enc = self._get_crypted_passphrase(client_ip, passphrase_raw_new)
+            self._write(client_ip, digests, backend_digests, passphrase_enc, last_update, last_check)
+        finally:
+            self._lock.release()
+        if self.autocommit:
+            self.commit()
+    
+    def commit(self):
+        """Waits until the changes are on the disk and publishes them.
+        
+        The lock is not held while waiting, so that the changes of
+        concurrent requests are written together.
+        
+        On error raises storage.StorageError.
+        
+        """
+        db = self.db
+        if db is None:
+            return
+        self._lock.acquire()
+        try:
+            sequence = self._sequence
+        finally:
+            self._lock.release()
+        db.commit()
+        self._lock.acquire()
+        try:
+            self._publish(sequence)
+        finally:
+            self._lock.release()
     
     def dbprint(self):
         for k, v in self.db.iteritems():
-            print k, '\t', repr(v)
+            print unpack_ip(get_record_key(k, v)), '\t', unpack_record(v)
         print '-'*40
     
     def database_activate(self):
@@ -156,16 +333,48 @@ class HashDatabase:
         
         """
         try:
-            self.db = anydbm.open(self.path, 'c', 0640)
-        except anydbm.error, (errno, strerror):
+            db = get_storage_engine(self.engine, self.path, **self.engine_options)
+            db.open()
+        except StorageError, strerror:
             self.db = None
             raise InitializationError(strerror)
+        self.db = db
+    
+    def index_build(self, path):
+        """Writes the record index of all records to path and keeps it up
+        to date with the changes. A previous index is marked stale, so that
+        its readers open the new one.
+        
+        On error raises record.RecordIndexError.
+        
+        """
+        self._lock.acquire()
+        try:
+            build_index(path, self.db.iteritems())
+            index = RecordIndex(path)
+            index.open(writable=True)
+            if self.index is not None:
+                self.index.mark_stale()
+                self.index.close()
+            self.index = index
+            self.index_outdated = 0
+        finally:
+            self._lock.release()
     
     def database_close(self):
         """Closes the database."""
+        if self.index is not None:
+            self.index.close()
+            self.index = None
         if self.db is not None:
             self.db.close()
-
-    
-    
+            self.db = None
+        if self.cache is not None:
+            self.cache.clear()
     
+    def get_stats(self):
+        """Returns a string with the counters of the cache or None, if
+        there is no cache."""
+        if self.cache is None:
+            return None
+        return self.cache.get_stats()
@@ -33,8 +33,13 @@ from TinyIDS import config
 from TinyIDS import info
 from TinyIDS import process
 from TinyIDS import crypto
-from TinyIDS.server import TinyIDSServer, TinyIDSCommandHandler, InternalServerError, TerminationSignal
-from TinyIDS.client import TinyIDSClient
+from TinyIDS import database
+from TinyIDS.prefork import PreforkMaster
+from TinyIDS.server import TinyIDSCommandHandler, InternalServerError, TerminationSignal, SERVER_ENGINES
+from TinyIDS.server import get_database, get_server_options, ServerConfigurationError
+from TinyIDS.storage import get_storage_engine, migrate, StorageError
+from TinyIDS.client import TinyIDSClient, ClientConfigurationError, NoBackendsToRun
+from TinyIDS.agent import TinyIDSAgent, AgentConfigurationError
 
 
 
@@ -70,16 +75,107 @@ def main():
         command = 'DELETE'
     elif opts.changephrase:
         command = 'CHANGEPHRASE'
+    elif opts.agent:
+        # The agent checks the digests of the backends after each run
+        command = 'CHECK'
     
-    client = TinyIDSClient(command)
+    try:
+        client = TinyIDSClient(command, opts.backends)
+    except ClientConfigurationError, strerror:
+        logger.error('Configuration error: %s' % strerror)
+        sys.exit(1)
     logger.info('TinyIDS Client v%s initialized' % info.version)
-    logger.info('Running in mode: %s' % command)
     
-    client.run()
+    if opts.agent:
+        logger.info('Running in mode: AGENT')
+        try:
+            agent = TinyIDSAgent(client)
+            agent.run()
+        except AgentConfigurationError, strerror:
+            logger.error('Agent error: %s' % strerror)
+            sys.exit(1)
+        except NoBackendsToRun:
+            logger.error('No valid backends. Shutting down...')
+            sys.exit(1)
+    else:
+        logger.info('Running in mode: %s' % command)
+        client.run()
 
     logger.debug('terminated')
 
 
+def migrate_database(cfg, source):
+    """Copies all records of the source database to the database of the
+    server configuration. The source is given as <engine>:<path>.
+    
+    Returns the exit status.
+    
+    """
+    engine, sep, path = source.partition(':')
+    if not sep or not path:
+        sys.stderr.write('ERROR: Invalid source database: %s\n' % source)
+        return 1
+    path = os.path.abspath(path)
+    try:
+        db = get_database(cfg)
+    except ServerConfigurationError, strerror:
+        sys.stderr.write('ERROR: %s\n' % strerror)
+        return 1
+    if engine == db.engine and path == db.path:
+        sys.stderr.write('ERROR: The source and the target database are the same\n')
+        return 1
+    try:
+        source_db = get_storage_engine(engine, path)
+        source_db.open()
+    except StorageError, strerror:
+        sys.stderr.write('ERROR: Cannot open the source database: %s\n' % strerror)
+        return 1
+    try:
+        try:
+            db.database_activate()
+        except database.InitializationError, strerror:
+            sys.stderr.write('ERROR: Cannot open the target database: %s\n' % strerror)
+            return 1
+        try:
+            count = migrate(source_db, db.db)
+        finally:
+            db.database_close()
+    finally:
+        source_db.close()
+    sys.stdout.write('Copied %d records from %s (%s) to %s (%s)\n' % (
+        count, path, engine, db.path, db.engine))
+    return 0
+
+
+def run_server(server_class, server_address, pki, db=None, reuse_port=False):
+    """Runs the server until it is terminated."""
+    logger = logging.getLogger()
+    try:
+        service = server_class(server_address, TinyIDSCommandHandler, pki, db, reuse_port)
+    except InternalServerError:
+        logger.debug('Terminated')
+    else:
+        try:
+            service.serve_forever()
+        except KeyboardInterrupt:
+            logger.warning('Caught keyboard interrupt')
+            service.server_forced_shutdown()
+        except TerminationSignal:
+            service.server_close()
+            logger.info('Server shutdown complete')
+        except:
+            import traceback
+            exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
+            message = traceback.format_exception_only(exceptionType, exceptionValue)[0]
+            logger.critical('unhandled exception: %s' % message.strip())
+            service.server_forced_shutdown()
+            print '-'*70
+            traceback.print_exc()
+            print '-'*70
+        else:
+            logger.info('Server shutdown complete')
+
+
 def server_main():
     opts = cmdline.parse_server()
     config_path = os.path.abspath(opts.confpath)
@@ -90,6 +186,9 @@ def server_main():
         sys.stderr.flush()
         sys.exit(1)
     
+    if opts.migrate_from:
+        sys.exit(migrate_database(cfg, opts.migrate_from))
+    
     # Settings
     interface = cfg.get('main', 'interface')
     port = cfg.getint('main', 'port')
@@ -101,6 +200,25 @@ def server_main():
     use_keys = cfg.getboolean('main', 'use_keys')
     keys_dir = cfg.get('main', 'keys_dir')
     key_bits = cfg.getint('main', 'key_bits')
+    processes = cfg.get_or_default('main', 'processes', '1')
+    if not processes.isdigit() or int(processes) < 1:
+        sys.stderr.write('ERROR: Invalid number of processes: %s\n' % processes)
+        sys.stderr.flush()
+        sys.exit(1)
+    processes = int(processes)
+    engine = cfg.get_or_default('main', 'engine', config.DEFAULT_SERVER_ENGINE)
+    server_class = SERVER_ENGINES.get(engine)
+    if server_class is None:
+        sys.stderr.write('ERROR: Unknown server engine: %s\n' % engine)
+        sys.stderr.flush()
+        sys.exit(1)
+    try:
+        get_server_options(cfg)
+        db = get_database(cfg)
+    except ServerConfigurationError, strerror:
+        sys.stderr.write('ERROR: %s\n' % strerror)
+        sys.stderr.flush()
+        sys.exit(1)
     
     # Initialize logging
     logger = logging.getLogger()
@@ -162,29 +280,16 @@ def server_main():
     
     logger.info('TinyIDS Server v%s starting...' % info.version)
     
-    try:
-        service = TinyIDSServer((interface, port), TinyIDSCommandHandler, pki)
-    except InternalServerError:
-        logger.debug('Terminated')
-    else:
+    if processes > 1:
+        master = PreforkMaster(db, processes,
+            lambda db: run_server(server_class, (interface, port), pki, db, reuse_port=True))
         try:
-            service.serve_forever()
-        except KeyboardInterrupt:
-            logger.warning('Caught keyboard interrupt')
-            service.server_forced_shutdown()
-        except TerminationSignal:
-            service.server_close()
-            logger.info('Server shutdown complete')
-        except:
-            import traceback
-            exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
-            message = traceback.format_exception_only(exceptionType, exceptionValue)[0]
-            logger.critical('unhandled exception: %s' % message.strip())
-            service.server_forced_shutdown()
-            print '-'*70
-            traceback.print_exc()
-            print '-'*70
+            master.run()
+        except database.InitializationError, strerror:
+            logger.error('Database initialization error: %s' % strerror)
         else:
             logger.info('Server shutdown complete')
+    else:
+        run_server(server_class, (interface, port), pki, db)
     logger.debug('terminated')
 
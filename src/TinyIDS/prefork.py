@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import time
+import errno
+import select
+import signal
+import socket
+import struct
+import marshal
+import logging
+import threading
+
+from TinyIDS import database
+from TinyIDS.record import pack_ip, unpack_record, RecordIndex, RecordIndexError
+
+
+# Methods of database.HashDatabase that workers may call
+STORAGE_METHODS = ('get', 'check', 'put', 'remove', 'change_passphrase')
+# Exceptions of the database that are passed on to the workers
+STORAGE_EXCEPTIONS = {
+    'HashDoesNotExistError': database.HashDoesNotExistError,
+    'InvalidPassphraseError': database.InvalidPassphraseError,
+}
+MESSAGE_HEADER = struct.Struct('!I')    # length of the marshalled message
+MAX_MESSAGE_LEN = 1048576
+# Workers that exit sooner after they have been started are not restarted
+MIN_WORKER_LIFETIME = 5     # seconds
+SHUTDOWN_TIMEOUT = 10       # seconds
+# The record index is rebuilt when the number of changed records that are
+# not in it exceeds this share of the indexed records (or the minimum).
+INDEX_REBUILD_RATIO = 0.1
+INDEX_REBUILD_MIN = 1000    # records
+
+
+logger = logging.getLogger()
+
+
+class StorageError(Exception):
+    pass
+
+
+def _send_message(sock, obj):
+    data = marshal.dumps(obj)
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+def _recv_exact(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(length)
+        if not chunk:
+            raise StorageError('Channel closed')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+def _recv_message(sock):
+    length = MESSAGE_HEADER.unpack(_recv_exact(sock, MESSAGE_HEADER.size))[0]
+    if length > MAX_MESSAGE_LEN:
+        raise StorageError('Message too long: %d' % length)
+    try:
+        return marshal.loads(_recv_exact(sock, length))
+    except (EOFError, ValueError, TypeError):
+        raise StorageError('Invalid message')
+
+
+class RemoteHashDatabase:
+    """Provides the interface of database.HashDatabase in a worker process.
+
+    Each call is sent to the storage owner (see PreforkMaster) through a
+    Unix socket and the result is returned, or the exception of the
+    database is raised again. Calls from several threads are serialized.
+
+    If the path of a record index (see record.RecordIndex) is provided,
+    check() searches the index and only calls the storage owner for the
+    records that the index does not know or whose time of the last check
+    has to be stored.
+
+    On communication errors, raises StorageError.
+
+    """
+
+    def __init__(self, sock, index_path=None):
+        self.sock = sock
+        self.index_path = index_path
+        self.index = None
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+
+    def _call(self, method, *args):
+        self._lock.acquire()
+        try:
+            try:
+                _send_message(self.sock, (method, args))
+                status, value = _recv_message(self.sock)
+            except socket.error, (err, strerror):
+                raise StorageError(strerror)
+        finally:
+            self._lock.release()
+        if status == 'ok':
+            return value
+        name, strerror = value
+        if STORAGE_EXCEPTIONS.has_key(name):
+            raise STORAGE_EXCEPTIONS[name](strerror)
+        raise StorageError(strerror)
+
+    # Public API
+
+    def get(self, client_ip):
+        return self._call('get', client_ip)
+
+    def check(self, client_ip):
+        if self.index is not None:
+            self._index_lock.acquire()
+            try:
+                found, record = self.index.lookup(pack_ip(client_ip))
+            finally:
+                self._index_lock.release()
+            if found:
+                if record is None:
+                    raise database.HashDoesNotExistError
+                digests, backend_digests, passphrase, last_update, last_check = unpack_record(record)
+                if time.time() - last_check < database.LAST_CHECK_INTERVAL:
+                    return digests, backend_digests
+        return self._call('check', client_ip)
+
+    def put(self, client_ip, hash, passphrase_raw):
+        return self._call('put', client_ip, hash, passphrase_raw)
+
+    def remove(self, client_ip, passphrase_raw):
+        return self._call('remove', client_ip, passphrase_raw)
+
+    def change_passphrase(self, client_ip, passphrase_raw_old, passphrase_raw_new):
+        return self._call('change_passphrase', client_ip, passphrase_raw_old, passphrase_raw_new)
+
+    def database_activate(self):
+        """The database is opened by the storage owner. Opens the record
+        index, if there is one."""
+        if self.index_path is None:
+            return
+        index = RecordIndex(self.index_path)
+        try:
+            index.open()
+        except RecordIndexError, strerror:
+            logger.warning('Cannot open the record index: %s' % strerror)
+        else:
+            self.index = index
+
+    def database_close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        self.sock.close()
+
+
+class PreforkMaster:
+    """Runs the server in several worker processes and owns the database.
+
+    The master process forks 'processes' workers. Each worker calls
+    'worker' with a RemoteHashDatabase instance and binds its own listening
+    socket to the server address using SO_REUSEPORT, so that the kernel
+    distributes the connections among the workers. The workers parse the
+    commands and perform the PKI operations, so they are not limited by the
+    global interpreter lock of a single process.
+
+    The master process is the only process that opens the database. It
+    serves the database calls of all workers one at a time, through a pair
+    of connected Unix sockets for each worker. Workers that exit are
+    restarted, unless they exit right after they have been started, in
+    which case the server is shut down.
+
+    The master also writes a record index next to the database (see
+    record.RecordIndex), which the workers search for CHECK commands
+    without calling the master. The index is rebuilt when many records
+    have been added since it was built.
+
+    """
+
+    def __init__(self, db, processes, worker):
+        """Accepts a database.HashDatabase instance, the number of worker
+        processes and the function each worker runs."""
+        self.db = db
+        self.processes = processes
+        self.worker = worker
+        # pid : (master end of the channel, start time)
+        self.workers = {}
+        # fd : master end of the channel
+        self.channels = {}
+        self.index_path = db.path + '.idx'
+        self.poll = None
+        self._stop = False
+
+    def _spawn(self):
+        """Forks a worker process."""
+        sock, worker_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            sock.close()
+            for channel in self.channels.values():
+                channel.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            status = 0
+            try:
+                index_path = None
+                if self.db.index is not None:
+                    index_path = self.index_path
+                self.worker(RemoteHashDatabase(worker_sock, index_path))
+            except:
+                logger.exception('Worker %d failed' % os.getpid())
+                status = 1
+            os._exit(status)
+        worker_sock.close()
+        self.workers[pid] = (sock, time.time())
+        self.channels[sock.fileno()] = sock
+        self.poll.register(sock.fileno(), select.POLLIN)
+        logger.info('Started worker process: %d' % pid)
+
+    def _close_channel(self, sock):
+        fd = sock.fileno()
+        if self.channels.pop(fd, None) is not None:
+            self.poll.unregister(fd)
+        sock.close()
+
+    def _handle(self, sock):
+        """Serves a database call of a worker and returns the response.
+        Returns None if the worker has exited."""
+        try:
+            method, args = _recv_message(sock)
+        except (StorageError, socket.error, ValueError):
+            # The worker has exited
+            self._close_channel(sock)
+            return None
+        if method not in STORAGE_METHODS:
+            response = ('err', ('StorageError', 'Unknown method: %s' % method))
+        else:
+            try:
+                response = ('ok', getattr(self.db, method)(*args))
+            except (database.HashDoesNotExistError, database.InvalidPassphraseError), e:
+                response = ('err', (e.__class__.__name__, str(e)))
+            except Exception, e:
+                logger.error('Database error: %s' % e)
+                response = ('err', ('StorageError', str(e)))
+        return response
+
+    def _reap(self):
+        """Collects the workers that have exited and restarts them."""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, (err, strerror):
+                if err == errno.EINTR:
+                    continue
+                return
+            if not pid:
+                return
+            if not self.workers.has_key(pid):
+                continue
+            sock, started = self.workers.pop(pid)
+            self._close_channel(sock)
+            if self._stop:
+                continue
+            if time.time() - started < MIN_WORKER_LIFETIME:
+                logger.error('Worker %d exited at startup with status %d' % (pid, status))
+                self._stop = True
+                continue
+            logger.warning('Worker %d exited with status %d. Restarting...' % (pid, status))
+            self._spawn()
+
+    def _serve(self, timeout):
+        try:
+            events = self.poll.poll(timeout * 1000)
+        except select.error, (err, strerror):
+            if err == errno.EINTR:
+                return
+            raise
+        responses = []
+        for fd, event in events:
+            sock = self.channels.get(fd)
+            if sock is not None:
+                response = self._handle(sock)
+                if response is not None:
+                    responses.append((sock, response))
+        if responses:
+            # The changes of all the calls are written to the disk together
+            # before the workers are answered (group commit).
+            try:
+                self.db.commit()
+            except Exception, e:
+                logger.error('Database error: %s' % e)
+                error = ('err', ('StorageError', str(e)))
+                responses = [(sock, error) for sock, response in responses]
+        for sock, response in responses:
+            try:
+                _send_message(sock, response)
+            except socket.error:
+                self._close_channel(sock)
+        self._reap()
+
+    def _build_index(self):
+        t0 = time.time()
+        try:
+            self.db.index_build(self.index_path)
+        except RecordIndexError, strerror:
+            logger.error('Cannot write the record index: %s' % strerror)
+            return
+        logger.info('Record index written: %d records in %.1f seconds' % (
+            self.db.index.slots, time.time() - t0))
+
+    def _index_outdated(self):
+        if self.db.index is None:
+            return False
+        limit = max(INDEX_REBUILD_MIN, self.db.index.slots * INDEX_REBUILD_RATIO)
+        return self.db.index_outdated > limit
+
+    def _SIGTERM_handler(self, signo, frame):
+        logger.info('Caught signal %d' % signo)
+        self._stop = True
+
+    def _SIGUSR1_handler(self, signo, frame):
+        self._log_stats()
+
+    def _log_stats(self):
+        stats = self.db.get_stats()
+        if stats is not None:
+            logger.info('Database cache: %s' % stats)
+
+    # Public API
+
+    def run(self):
+        """Starts the workers and serves the database calls until a TERM or
+        INT signal is caught.
+
+        If the database cannot be opened, raises database.InitializationError.
+
+        """
+        self.db.autocommit = False
+        self.db.database_activate()
+        logger.info('Hash database activated')
+        self._build_index()
+        signal.signal(signal.SIGTERM, self._SIGTERM_handler)
+        signal.signal(signal.SIGINT, self._SIGTERM_handler)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, self._SIGUSR1_handler)
+        self.poll = select.poll()
+        try:
+            for i in range(self.processes):
+                self._spawn()
+            while not self._stop:
+                self._serve(1)
+                if self._index_outdated():
+                    self._build_index()
+        finally:
+            self._stop = True
+            for pid in self.workers.keys():
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            # Workers may need the database while they shut down
+            deadline = time.time() + SHUTDOWN_TIMEOUT
+            while self.workers and time.time() < deadline:
+                self._serve(0.1)
+            for pid in self.workers.keys():
+                logger.warning('Killing worker: %d' % pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            self._log_stats()
+            self.db.database_close()
+            logger.info('Hash database closed')
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import mmap
+import struct
+import socket
+import binascii
+import logging
+
+from TinyIDS.util import parse_digest_vector, format_digests, format_digest_vector
+
+
+# Binary records
+
+RECORD_VERSION = 1
+RECORD_MARK = chr(RECORD_VERSION)
+# version, raw passphrase hash, last update, last check, number of digests
+RECORD_HEADER = struct.Struct('!B20sIIH')
+# backend name length (0 for the checksum), algorithm id, number of hex digits
+DIGEST_HEADER = struct.Struct('!BBH')
+# Algorithms that are stored by id. Other algorithms are stored by name (id 0).
+ALGORITHMS = ('sha1', 'sha224', 'sha256', 'sha384', 'sha512', 'md5',
+    'blake2b', 'blake2s', 'sha3_224', 'sha3_256', 'sha3_384', 'sha3_512')
+ALGORITHM_IDS = dict([(name, i + 1) for i, name in enumerate(ALGORITHMS)])
+# Records of previous versions: <hash>____<passphrase>
+LEGACY_SEPARATOR = '____'
+
+# Record index
+
+INDEX_FORMAT = 'TINYIDX1'
+# format, number of slots, size of the record field of the slots, stale flag
+INDEX_HEADER = struct.Struct('!8sIIB')
+INDEX_HEADER_SIZE = 32
+INDEX_STALE_OFFSET = 16
+# sequence number, key, record length
+SLOT_HEADER = struct.Struct('!I16sH')
+SLOT_SEQUENCE = struct.Struct('!I')
+SLOT_LENGTH = struct.Struct('!H')
+SLOT_KEY_OFFSET = 4
+SLOT_LENGTH_OFFSET = 20
+SLOT_REMOVED = 0
+SLOT_MOVED = 0xffff     # the record no longer fits in the slot
+# Space for records that grow after the index has been built
+INDEX_RECORD_HEADROOM = 64  # bytes
+INDEX_READ_RETRIES = 3
+IPV4_MAPPED_PREFIX = '\0' * 10 + '\xff' * 2
+
+
+logger = logging.getLogger()
+
+
+class RecordIndexError(Exception):
+    pass
+
+
+def pack_ip(client_ip):
+    """Returns the binary form of an IP address: 4 bytes for IPv4 and 16
+    bytes for IPv6.
+
+    On invalid input, raises ValueError.
+
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, client_ip)
+        except (socket.error, ValueError):
+            pass
+    raise ValueError('Invalid IP address: %s' % client_ip)
+
+def unpack_ip(key):
+    """Returns the text form of an IP address returned by pack_ip()."""
+    if len(key) == 4:
+        return socket.inet_ntop(socket.AF_INET, key)
+    return socket.inet_ntop(socket.AF_INET6, key)
+
+def get_record_key(key, record):
+    """Returns the binary IP address of a record of the storage engine.
+
+    Records of previous versions are stored by the IP address as text.
+
+    """
+    if record[:1] == RECORD_MARK:
+        return key
+    return pack_ip(key)
+
+def _unhexlify(hexdigest):
+    if len(hexdigest) % 2:
+        hexdigest += '0'
+    try:
+        return binascii.unhexlify(hexdigest)
+    except TypeError:
+        raise ValueError('Invalid digest: %s' % hexdigest)
+
+def _pack_digests(name, digests, parts):
+    if len(name) > 255:
+        raise ValueError('Backend name too long: %s' % name)
+    for algorithm in sorted(digests.keys()):
+        hexdigest = digests[algorithm]
+        if len(hexdigest) > 0xffff:
+            raise ValueError('Digest too long: %s' % algorithm)
+        algorithm_id = ALGORITHM_IDS.get(algorithm, 0)
+        parts.append(DIGEST_HEADER.pack(len(name), algorithm_id, len(hexdigest)))
+        parts.append(name)
+        if not algorithm_id:
+            if len(algorithm) > 255:
+                raise ValueError('Algorithm name too long: %s' % algorithm)
+            parts.append(chr(len(algorithm)) + algorithm)
+        parts.append(_unhexlify(hexdigest))
+
+def pack_record(digests, backend_digests, passphrase, last_update, last_check):
+    """Returns the binary record of a client.
+
+    Accepts the output of util.parse_digest_vector(), the encrypted
+    passphrase as a hex string and the times of the last update and of the
+    last check in seconds since the epoch.
+
+    The record starts with RECORD_HEADER, followed by each digest: a
+    DIGEST_HEADER, the backend name, the algorithm name if the algorithm is
+    not in ALGORITHMS, and the digest as raw bytes.
+
+    On invalid input, raises ValueError.
+
+    """
+    parts = []
+    if digests is not None:
+        _pack_digests('', digests, parts)
+    for name in sorted(backend_digests.keys()):
+        _pack_digests(name, backend_digests[name], parts)
+    passphrase = _unhexlify(passphrase)
+    if len(passphrase) != 20:
+        raise ValueError('Invalid passphrase hash')
+    count = len(digests or {}) + sum([len(d) for d in backend_digests.values()])
+    return RECORD_HEADER.pack(RECORD_VERSION, passphrase, last_update, last_check, count) + ''.join(parts)
+
+def unpack_record(record):
+    """Parses the output of pack_record() or a record of previous versions.
+
+    Returns a tuple:
+
+        (digests, backend_digests, passphrase, last_update, last_check)
+
+    The times are 0 in records of previous versions.
+
+    On invalid input, raises ValueError.
+
+    """
+    if record[:1] != RECORD_MARK:
+        hash, sep, passphrase = record.partition(LEGACY_SEPARATOR)
+        digests, backend_digests = parse_digest_vector(hash)
+        return digests, backend_digests, passphrase, 0, 0
+    try:
+        version, passphrase, last_update, last_check, count = RECORD_HEADER.unpack_from(record)
+        offset = RECORD_HEADER.size
+        digests = None
+        backend_digests = {}
+        for i in xrange(count):
+            name_len, algorithm_id, digits = DIGEST_HEADER.unpack_from(record, offset)
+            offset += DIGEST_HEADER.size
+            name = record[offset:offset + name_len]
+            offset += name_len
+            if algorithm_id:
+                algorithm = ALGORITHMS[algorithm_id - 1]
+            else:
+                length = ord(record[offset])
+                algorithm = record[offset + 1:offset + 1 + length]
+                offset += 1 + length
+            size = (digits + 1) / 2
+            hexdigest = binascii.hexlify(record[offset:offset + size])[:digits]
+            offset += size
+            if name:
+                backend_digests.setdefault(name, {})[algorithm] = hexdigest
+            else:
+                if digests is None:
+                    digests = {}
+                digests[algorithm] = hexdigest
+    except (struct.error, IndexError):
+        raise ValueError('Invalid record')
+    if offset != len(record):
+        raise ValueError('Invalid record')
+    return digests, backend_digests, binascii.hexlify(passphrase), last_update, last_check
+
+def format_hash(digests, backend_digests):
+    """Returns the hash of the UPDATE command for the output of
+    util.parse_digest_vector()."""
+    checksum = None
+    if digests is not None:
+        checksum = format_digests(sorted(digests.items()))
+    return format_digest_vector(checksum,
+        [(name, format_digests(sorted(d.items()))) for name, d in backend_digests.items()])
+
+
+def _index_key(key):
+    if len(key) == 4:
+        return IPV4_MAPPED_PREFIX + key
+    return key
+
+def build_index(path, items):
+    """Writes the record index of the (key, record) items of a storage
+    engine to path (see RecordIndex).
+
+    On error raises RecordIndexError.
+
+    """
+    slots = []
+    for key, record in items:
+        try:
+            slots.append((_index_key(get_record_key(key, record)), record))
+        except ValueError:
+            logger.warning('Not indexing record with invalid key: %r' % key)
+    slots.sort()
+    record_size = INDEX_RECORD_HEADROOM
+    if slots:
+        record_size += max([len(record) for key, record in slots])
+    tmp_path = path + '.tmp'
+    try:
+        f = open(tmp_path, 'wb')
+        try:
+            os.chmod(tmp_path, 0640)
+            f.write(INDEX_HEADER.pack(INDEX_FORMAT, len(slots), record_size, 0).ljust(INDEX_HEADER_SIZE, '\0'))
+            for key, record in slots:
+                f.write(SLOT_HEADER.pack(0, key, len(record)) + record.ljust(record_size, '\0'))
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+    except (IOError, OSError), (err, strerror):
+        raise RecordIndexError(strerror)
+
+
+class RecordIndex:
+    """Sorted, memory-mapped file of the records, which can be searched by
+    several processes without locking.
+
+    The file (see build_index()) consists of INDEX_HEADER, padded to
+    INDEX_HEADER_SIZE, and of one fixed-width slot for each record, sorted
+    by the IP address (IPv4 addresses are mapped to IPv6). A slot consists
+    of SLOT_HEADER and of the record, padded to the record size of the
+    index. Lookups are binary searches over the slots.
+
+    The owner of the database opens the index for writing and updates the
+    slots of the records that it changes. The sequence number of a slot is
+    odd while the slot is being written, so readers retry if the number is
+    odd or has changed while they were reading. Records that are added
+    after the index has been built are not in the index. When the index is
+    rebuilt, the previous file is marked stale and readers open the new
+    file.
+
+    Instances are not thread-safe. Callers serialize access to them.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.slots = 0
+        self.record_size = 0
+        self.slot_size = 0
+
+    def _find(self, key):
+        """Returns the offset of the slot of the key or None."""
+        key = _index_key(key)
+        m = self.map
+        lo = 0
+        hi = self.slots
+        while lo < hi:
+            mid = (lo + hi) / 2
+            offset = INDEX_HEADER_SIZE + mid * self.slot_size
+            probe = m[offset + SLOT_KEY_OFFSET:offset + SLOT_KEY_OFFSET + 16]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return offset
+        return None
+
+    def _read_slot(self, offset):
+        m = self.map
+        for i in xrange(INDEX_READ_RETRIES):
+            sequence, key, length = SLOT_HEADER.unpack_from(m, offset)
+            if sequence % 2:
+                continue
+            if length == SLOT_MOVED:
+                return False, None
+            record = None
+            if length != SLOT_REMOVED:
+                start = offset + SLOT_HEADER.size
+                record = m[start:start + length]
+            if SLOT_SEQUENCE.unpack_from(m, offset)[0] == sequence:
+                return True, record
+        return False, None
+
+    # Public API
+
+    def open(self, writable=False):
+        """Maps the index file in memory.
+
+        On error raises RecordIndexError.
+
+        """
+        try:
+            f = open(self.path, writable and 'r+b' or 'rb')
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size < INDEX_HEADER_SIZE:
+                    raise RecordIndexError('Invalid index: %s' % self.path)
+                access = writable and mmap.ACCESS_WRITE or mmap.ACCESS_READ
+                self.map = mmap.mmap(f.fileno(), size, access=access)
+            finally:
+                f.close()
+        except EnvironmentError, (err, strerror):
+            raise RecordIndexError(strerror)
+        format, self.slots, self.record_size, stale = INDEX_HEADER.unpack_from(self.map)
+        self.slot_size = SLOT_HEADER.size + self.record_size
+        if format != INDEX_FORMAT or size != INDEX_HEADER_SIZE + self.slots * self.slot_size:
+            self.close()
+            raise RecordIndexError('Invalid index: %s' % self.path)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def is_stale(self):
+        return self.map[INDEX_STALE_OFFSET] != '\0'
+
+    def mark_stale(self):
+        """Tells the readers that the index has been rebuilt."""
+        self.map[INDEX_STALE_OFFSET] = '\1'
+
+    def lookup(self, key):
+        """Returns a (found, record) tuple for the binary IP address (see
+        pack_ip()). 'found' is False if the index does not know the record,
+        for example because it has been added after the index was built.
+        'record' is None if the record has been removed.
+
+        If the index has been rebuilt, the new index is opened first. If it
+        cannot be opened, the index is closed and nothing is found.
+
+        """
+        if self.map is None:
+            return False, None
+        offset = self._find(key)
+        result = False, None
+        if offset is not None:
+            result = self._read_slot(offset)
+        if self.is_stale():
+            self.close()
+            try:
+                self.open()
+            except RecordIndexError, strerror:
+                logger.warning('Cannot open the record index: %s' % strerror)
+                return False, None
+            return self.lookup(key)
+        return result
+
+    def update(self, key, record):
+        """Stores the record of the binary IP address in its slot. A record
+        of None marks the record as removed.
+
+        Returns False if the key is not in the index or the record does not
+        fit in the slot, in which case readers do not find it.
+
+        """
+        offset = self._find(key)
+        if offset is None:
+            return False
+        m = self.map
+        sequence = SLOT_SEQUENCE.unpack_from(m, offset)[0]
+        SLOT_SEQUENCE.pack_into(m, offset, (sequence + 1) & 0xffffffff)
+        if record is None:
+            length = SLOT_REMOVED
+        elif len(record) > self.record_size:
+            length = SLOT_MOVED
+        else:
+            length = len(record)
+            start = offset + SLOT_HEADER.size
+            m[start:start + length] = record
+        SLOT_LENGTH.pack_into(m, offset + SLOT_LENGTH_OFFSET, length)
+        SLOT_SEQUENCE.pack_into(m, offset, (sequence + 2) & 0xffffffff)
+        return length != SLOT_MOVED
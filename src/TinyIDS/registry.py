@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import sys
+import imp
+import stat
+import marshal
+import logging
+
+from TinyIDS.util import sha1
+
+
+MANIFEST_FORMAT = 'TINYIDS-BACKEND-MANIFEST 1'
+MANIFEST_FILENAME = 'manifest'
+DEFAULT_BACKEND_CACHE_DIR = '/var/lib/tinyids/backends'
+# Mode of the cache directory. The cached bytecode is executed, so only the
+# user that runs tinyids may write to it.
+BACKEND_CACHE_DIR_MODE = 0700
+
+
+logger = logging.getLogger()
+
+
+class BackendEntry:
+    """Manifest entry of a backend.
+
+    Attributes
+
+      name: the backend name, which is also used as the module name.
+      path: the path to the backend source file.
+      mtime: the modification time of the source file.
+      size: the size of the source file.
+      config_path: the path to the backend configuration file.
+
+    """
+
+    def __init__(self, name, path, mtime, size, config_path):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.config_path = config_path
+
+
+class BackendRegistry:
+    """Discovers the available backends and loads the selected ones.
+
+    The list of backends is kept in a manifest file in 'cache_dir'. The
+    manifest stores the name, path, modification time and configuration file
+    of each backend, together with the modification times of the backend
+    and configuration directories. It is reused as long as none of these
+    directories has changed, so the directories are not listed on each run.
+
+    Only the backends that are requested are imported. The compiled bytecode
+    of each backend is stored in 'cache_dir' together with the SHA-1 digest
+    of its source and reused as long as the source has the same digest. This
+    also works for backends in directories that are not writable.
+
+    The cached bytecode is executed without being verified, so 'cache_dir'
+    is trusted as much as the backend directories. It is created with mode
+    0700, if its parent directory exists. It is only used if it is a
+    directory owned by the user that runs tinyids, and group and other
+    permissions are removed from it. If it cannot be used, the manifest and
+    the bytecode are neither read nor saved, but everything else works as
+    usual.
+
+    Counters:
+
+      manifest_reused: True if the manifest was reused.
+      imports: number of backends that have been imported.
+      bytecode_hits: number of backends loaded from cached bytecode.
+
+    """
+
+    def __init__(self, backend_dirs, conf_dir, cache_dir=DEFAULT_BACKEND_CACHE_DIR):
+        self.backend_dirs = backend_dirs
+        self.conf_dir = conf_dir
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, MANIFEST_FILENAME)
+
+        # List of BackendEntry instances in discovery order
+        self.entries = []
+        self._dirty = False
+
+        self.manifest_reused = False
+        self.imports = 0
+        self.bytecode_hits = 0
+
+        self._cache_usable = None
+
+    def _check_cache_dir(self):
+        """Returns True if the cache directory can be trusted.
+
+        Creates the directory, if it does not exist, and removes group and
+        other permissions from it. The result is remembered.
+
+        """
+        if self._cache_usable is not None:
+            return self._cache_usable
+        self._cache_usable = False
+        try:
+            os.mkdir(self.cache_dir, BACKEND_CACHE_DIR_MODE)
+        except OSError:
+            pass
+        try:
+            st = os.lstat(self.cache_dir)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(st.st_mode):
+            logger.warning('Backend cache disabled: not a directory: %s' % self.cache_dir)
+            return False
+        if st.st_uid != os.geteuid():
+            logger.warning('Backend cache disabled: directory owned by uid %d: %s' % (st.st_uid, self.cache_dir))
+            return False
+        if stat.S_IMODE(st.st_mode) != BACKEND_CACHE_DIR_MODE:
+            try:
+                os.chmod(self.cache_dir, BACKEND_CACHE_DIR_MODE)
+            except OSError, (err, strerror):
+                logger.warning('Backend cache disabled: %s: %s' % (strerror, self.cache_dir))
+                return False
+        self._cache_usable = True
+        return True
+
+    def _get_dir_mtimes(self):
+        """Returns a list of strings with the modification times of the
+        backend and configuration directories."""
+        mtimes = []
+        for directory in self.backend_dirs + [self.conf_dir]:
+            try:
+                mtimes.append(repr(os.stat(directory).st_mtime))
+            except OSError:
+                mtimes.append('-')
+        return mtimes
+
+    def _get_header(self):
+        """Returns the header line of the manifest."""
+        parts = []
+        for directory, mtime in zip(self.backend_dirs + [self.conf_dir], self._get_dir_mtimes()):
+            parts.append('%s\t%s' % (directory, mtime))
+        return '%s\t%s' % (MANIFEST_FORMAT, '\t'.join(parts))
+
+    def _read_manifest(self, header):
+        """Returns the list of entries stored in the manifest or None, if
+        the manifest does not exist or is out of date."""
+        if not self._check_cache_dir():
+            return None
+        try:
+            f = open(self.manifest_path)
+        except IOError:
+            return None
+        try:
+            lines = f.read().splitlines()
+        finally:
+            f.close()
+        if not lines or lines[0] != header:
+            return None
+        entries = []
+        for line in lines[1:]:
+            parts = line.split('\t')
+            if len(parts) != 5:
+                return None
+            name, path, mtime, size, config_path = parts
+            try:
+                entries.append(BackendEntry(name, path, float(mtime), int(size), config_path))
+            except ValueError:
+                return None
+        return entries
+
+    def _scan(self):
+        """Lists the backend directories and returns a list of entries."""
+        entries = []
+        for directory in self.backend_dirs:
+            try:
+                filenames = os.listdir(directory)
+            except OSError:
+                continue
+            for filename in filenames:
+                if not filename.endswith('.py') or filename.startswith('.'):
+                    continue
+                name = filename[:-3]
+                if name == '__init__':
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                config_path = os.path.join(self.conf_dir, name + '.conf')
+                entries.append(BackendEntry(name, path, st.st_mtime, st.st_size, config_path))
+        return entries
+
+    def _write_file(self, path, data):
+        """Writes data to path atomically. Errors are logged and ignored."""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            f = os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError), (err, strerror):
+            logger.debug('Cannot write backend cache file %s: %s' % (path, strerror))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def _get_bytecode_path(self, entry):
+        path_id = sha1(entry.path).hexdigest()[:12]
+        return os.path.join(self.cache_dir, '%s-%s.pyc' % (entry.name, path_id))
+
+    def _get_code(self, entry):
+        """Returns the code object of the backend.
+
+        The code is read from the bytecode cache, if the cached bytecode was
+        compiled by this Python version from a source with the same SHA-1
+        digest. Otherwise, the source is compiled and the bytecode is cached.
+
+        """
+        f = open(entry.path, 'rU')
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        if not self._check_cache_dir():
+            return compile(source + '\n', entry.path, 'exec')
+        bytecode_path = self._get_bytecode_path(entry)
+        header = imp.get_magic() + sha1(source).digest()
+        try:
+            f = open(bytecode_path, 'rb')
+        except IOError:
+            pass
+        else:
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            if data[:len(header)] == header:
+                try:
+                    code = marshal.loads(data[len(header):])
+                except (EOFError, ValueError, TypeError):
+                    pass
+                else:
+                    self.bytecode_hits += 1
+                    return code
+        code = compile(source + '\n', entry.path, 'exec')
+        self._write_file(bytecode_path, header + marshal.dumps(code))
+        return code
+
+    # Public API
+
+    def discover(self):
+        """Sets self.entries from the manifest or, if the manifest is out of
+        date, from a new scan of the backend directories."""
+        header = self._get_header()
+        entries = self._read_manifest(header)
+        self.manifest_reused = entries is not None
+        if entries is None:
+            entries = self._scan()
+            self._dirty = True
+        self.entries = entries
+        self._header = header
+        return entries
+
+    def load(self, entry):
+        """Imports the backend and returns the module.
+
+        The module is registered in sys.modules using the backend name.
+        If the source file has changed since the manifest was written, the
+        manifest entry is updated.
+
+        """
+        st = os.stat(entry.path)
+        if st.st_mtime != entry.mtime or st.st_size != entry.size:
+            entry.mtime = st.st_mtime
+            entry.size = st.st_size
+            self._dirty = True
+        code = self._get_code(entry)
+        m = imp.new_module(entry.name)
+        m.__file__ = entry.path
+        sys.modules[entry.name] = m
+        try:
+            exec code in m.__dict__
+        except:
+            del sys.modules[entry.name]
+            raise
+        self.imports += 1
+        return m
+
+    def save(self):
+        """Writes the manifest, if it has changed."""
+        if not self._dirty or not self._check_cache_dir():
+            return
+        lines = [self._header]
+        for e in self.entries:
+            lines.append('%s\t%s\t%r\t%d\t%s' % (e.name, e.path, e.mtime, e.size, e.config_path))
+        if self._write_file(self.manifest_path, '\n'.join(lines) + '\n'):
+            self._dirty = False
+
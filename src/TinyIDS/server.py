@@ -23,12 +23,32 @@
 #  limitations under the License.
 #
 
+import os
+import time
+import errno
+import fcntl
+import select
 import logging
+import socket
 import SocketServer
 import signal
+import threading
+import collections
+import cStringIO
+from multiprocessing.pool import ThreadPool
 
 from TinyIDS import database
 from TinyIDS import config
+from TinyIDS.storage import DEFAULT_STORAGE_ENGINE, DEFAULT_COMMIT_DELAY, DEFAULT_SNAPSHOT_LOG_SIZE
+from TinyIDS.cache import LRUCache
+from TinyIDS.util import parse_digest_vector, compare_digests
+from TinyIDS.util import format_frame, read_message, get_message_length, FrameError
+
+
+DEFAULT_CACHE_ENTRIES = 100000
+
+# Not defined by the socket module of Python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 
 logger = logging.getLogger()
@@ -40,21 +60,85 @@ class DataDecryptionError(Exception):
 class InternalServerError(Exception):
     pass
 
+class ServerConfigurationError(Exception):
+    pass
+
 class TerminationSignal(Exception):
     pass
 
 
+def _get_number(cfg, option, default, cast, allow_zero=True):
+    """Returns the value of a numeric option of the [main] section or the
+    default value, if the option is not set.
+    
+    If the value is not a positive number (or zero, if 'allow_zero' is
+    True), raises ServerConfigurationError.
+    
+    """
+    value = cfg.get_or_default('main', option, str(default))
+    try:
+        number = cast(value)
+    except ValueError:
+        number = -1
+    if number < 0 or (number == 0 and not allow_zero):
+        raise ServerConfigurationError('Invalid %s: %s' % (option, value))
+    return number
+
+def get_server_options(cfg):
+    """Returns a dictionary of the options of the server engines:
+    'idle_timeout', 'listen_backlog' and 'workers'.
+    
+    On invalid values, raises ServerConfigurationError.
+    
+    """
+    return {
+        'idle_timeout': _get_number(cfg, 'idle_timeout', config.DEFAULT_IDLE_TIMEOUT, float, allow_zero=False),
+        'listen_backlog': _get_number(cfg, 'listen_backlog', config.DEFAULT_LISTEN_BACKLOG, int, allow_zero=False),
+        'workers': _get_number(cfg, 'workers', config.DEFAULT_SERVER_WORKERS, int, allow_zero=False),
+    }
+
+def get_database(cfg):
+    """Returns the database.HashDatabase instance of the database options
+    of the server configuration.
+    
+    On invalid values, raises ServerConfigurationError.
+    
+    """
+    db_path = cfg.get_or_default('main', 'db_path', config.DEFAULT_DATABASE_PATH)
+    db_engine = cfg.get_or_default('main', 'db_engine', DEFAULT_STORAGE_ENGINE)
+    cache_entries = _get_number(cfg, 'cache_entries', DEFAULT_CACHE_ENTRIES, int)
+    cache_bytes = _get_number(cfg, 'cache_bytes', 0, int)
+    cache = None
+    if cache_entries or cache_bytes:
+        cache = LRUCache(cache_entries, cache_bytes)
+    engine_options = {}
+    if db_engine == 'memory':
+        engine_options['commit_delay'] = _get_number(cfg, 'commit_delay',
+            DEFAULT_COMMIT_DELAY * 1000, float) / 1000
+        engine_options['snapshot_log_size'] = _get_number(cfg, 'snapshot_log_size',
+            DEFAULT_SNAPSHOT_LOG_SIZE / 1048576, int, allow_zero=False) * 1048576
+    return database.HashDatabase(db_path, db_engine, cache, engine_options)
+
+
 class TinyIDSServer(SocketServer.ThreadingTCPServer):
     
-    def __init__(self, server_address, RequestHandlerClass, pki):
+    def __init__(self, server_address, RequestHandlerClass, pki, db=None, reuse_port=False):
         """Constructor of the TinyIDS Server.
         
         Extra instance attributes:
         
         cfg - the server ConfigParser instance
-        db - database.HashDatabase instance
+        db - database.HashDatabase instance or an object with the same
+            interface, like prefork.RemoteHashDatabase. If it is not
+            provided, the database of the configuration is used (see
+            get_database()).
+        options - the options of the server engines (see
+            get_server_options())
         pki - crypto.RSAModule instance
         
+        If 'reuse_port' is True, the SO_REUSEPORT socket option is set, so
+        that several server processes can bind to the same address.
+        
         Security Considerations
         
         If PKI module has been enabled, the server's private key should
@@ -68,9 +152,25 @@ class TinyIDSServer(SocketServer.ThreadingTCPServer):
         # Debug protocol
         self.debug_protocol = self.cfg.getboolean('main', 'debug_protocol')
         
-        # Hash Database
-        db_path = self.cfg.get_or_default('main', 'db_path', config.DEFAULT_DATABASE_PATH)
-        self.db = database.HashDatabase(db_path)
+        try:
+            self.options = get_server_options(self.cfg)
+            
+            # Hash Database
+            if db is None:
+                db = get_database(self.cfg)
+        except ServerConfigurationError, strerror:
+            logger.error('%s' % strerror)
+            raise InternalServerError
+        self.db = db
+        
+        # Connections on which no command arrives for 'idle_timeout' seconds
+        # are closed
+        self.idle_timeout = self.options['idle_timeout']
+        
+        # Size of the queue of connections that have not been accepted yet
+        self.request_queue_size = self.options['listen_backlog']
+        
+        self.reuse_port = reuse_port
         
         # PKI Module
         self.pki = pki
@@ -86,6 +186,7 @@ class TinyIDSServer(SocketServer.ThreadingTCPServer):
         signal.signal(signal.SIGTERM, self.SIGTERM_handler)
         signal.signal(signal.SIGINT, self.SIGINT_handler)
         signal.signal(signal.SIGHUP, self.SIGHUP_handler)
+        signal.signal(signal.SIGUSR1, self.SIGUSR1_handler)
         
     def database_activate(self):
         try:
@@ -95,8 +196,16 @@ class TinyIDSServer(SocketServer.ThreadingTCPServer):
             raise InternalServerError
         logger.info('Hash database activated')
     
+    def database_log_stats(self):
+        """Logs the counters of the database cache, if there is one."""
+        if hasattr(self.db, 'get_stats'):
+            stats = self.db.get_stats()
+            if stats is not None:
+                logger.info('Database cache: %s' % stats)
+    
     def database_close(self):
         if self.db is not None:
+            self.database_log_stats()
             self.db.database_close()
             logger.info('Hash database closed')
     
@@ -109,6 +218,11 @@ class TinyIDSServer(SocketServer.ThreadingTCPServer):
             self.pki = None
             logger.info('PKI module deactivated')
     
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        SocketServer.ThreadingTCPServer.server_bind(self)
+    
     def server_activate(self):
         self.database_activate()
         self.pki_activate()
@@ -147,10 +261,24 @@ class TinyIDSServer(SocketServer.ThreadingTCPServer):
         
         """
         logger.info('Caught HUP signal. Not implemented. No action taken')
+    
+    def SIGUSR1_handler(self, signo, frame):
+        """Server logs the counters of the database cache."""
+        self.database_log_stats()
 
 
 
 class TinyIDSCommandHandler(SocketServer.StreamRequestHandler):
+    """Handles the commands of a client.
+    
+    With protocol revision 2, the connection carries a single command line
+    and is closed after the response. With protocol revision 3, commands
+    and responses are sent as frames (see util.format_frame()) and the
+    connection carries any number of commands, until the client closes it
+    or no command arrives for 'idle_timeout' seconds. Commands may be
+    pipelined. The responses are sent in the order of the commands.
+    
+    """
     
     max_data_len = 8192
     cmd_end = '\r\n'
@@ -160,10 +288,17 @@ class TinyIDSCommandHandler(SocketServer.StreamRequestHandler):
         # Indicator of the command that is being processed
         self.doing_command = None
         
+        # True while the client uses framed messages (protocol revision 3)
+        self.framed = False
+        
+        # True if the connection must be closed after the response, even if
+        # the client uses framed messages
+        self.close_connection = False
+        
         # command : (<processing_method>, <number_of_args>)
         self.com2func = {
             'TEST':         (self._com_TEST, 1),          # TEST <protocol_revision>
-            'CHECK':        (self._com_CHECK, 1),         # CHECK <hash>
+            'CHECK':        (self._com_CHECK, 1),         # CHECK <hash>|;<backend_hashes>
             'UPDATE':       (self._com_UPDATE, 2),        # UPDATE <hash> <passphrase>
             'DELETE':       (self._com_DELETE, 1),        # DELETE <passphrase>
             'CHANGEPHRASE': (self._com_CHANGEPHRASE, 2),  # CHANGEPHRASE <old_passphrase> <new_passphrase>
@@ -185,8 +320,13 @@ class TinyIDSCommandHandler(SocketServer.StreamRequestHandler):
         return self.client_address[0]
     
     def _get_data(self):
-        data = self.rfile.readline(self.max_data_len).strip()
-        data = data.rstrip(self.cmd_end)
+        """Returns the next command of the client or None, if the client has
+        closed the connection."""
+        data, framed = read_message(self.rfile, self.max_data_len, self.cmd_end)
+        if data is None:
+            # The connection keeps the mode of its last message
+            return None
+        self.framed = framed
         if self.server.pki is not None:
             # PKI is enabled
             data = self.server.pki.decrypt(data)
@@ -226,17 +366,79 @@ class TinyIDSCommandHandler(SocketServer.StreamRequestHandler):
         self._send_response(40) # INVALID CLIENT
     
     def _com_CHECK(self, hash):
+        """Compares the digests sent by the client with the stored ones.
+        
+        The hash may contain the checksum, the digests of some or all of
+        the backends the checksum has been calculated from, or both (see
+        util.format_digest_vector()).
+        
+        Only the digests of algorithms that have been both sent and stored
+        are compared. If there are no such digests, the hash is considered
+        not found. This makes it possible for a client that calculates the
+        digests of two algorithms to be checked against a hash that has been
+        stored with either of them.
+        
+        If the checksum has been sent, it is compared with the stored one.
+        Otherwise, the digests of the backends that have been sent are
+        compared with the stored ones, so a client may check a subset of its
+        backends. In both cases, the MISMATCH and NOT FOUND responses are
+        followed by a comma-delimited list of the backends whose digests
+        differ or have not been stored, if these are known.
+        
+        """
+        try:
+            digests, backend_digests = parse_digest_vector(hash)
+        except ValueError:
+            self._send_response(41) # INVALID COMMAND
+            return
         try:
-            hash_db = self.server.db.get(self._client())
+            digests_db, backend_digests_db = self.server.db.check(self._client())
         except database.HashDoesNotExistError:
             self._send_response(31) # NOT FOUND
-        else:
-            if hash == hash_db:
+            return
+        mismatched = []
+        missing = []
+        for name in sorted(backend_digests.keys()):
+            result = None
+            if backend_digests_db.has_key(name):
+                result = compare_digests(backend_digests[name], backend_digests_db[name])
+            if result is None:
+                missing.append(name)
+            elif not result:
+                mismatched.append(name)
+        if digests is not None:
+            result = None
+            if digests_db is not None:
+                result = compare_digests(digests, digests_db)
+            if result is None:
+                self._send_response(31) # NOT FOUND
+            elif result:
                 self._send_response(20) # OK
             else:
-                self._send_response(30) # MISMATCH
+                self._send_response(30, detail=','.join(mismatched)) # MISMATCH
+        elif missing:
+            self._send_response(31, detail=','.join(missing)) # NOT FOUND
+        elif mismatched:
+            self._send_response(30, detail=','.join(mismatched)) # MISMATCH
+        else:
+            self._send_response(20) # OK
     
     def _com_UPDATE(self, hash, passphrase):
+        """Stores the digests sent by the client, replacing those of all
+        algorithms and backends that had been stored previously.
+        
+        The hash must contain the checksum. It may also contain the digests
+        of the backends, which are used by subsequent partial checks.
+        
+        """
+        try:
+            digests, backend_digests = parse_digest_vector(hash)
+        except ValueError:
+            self._send_response(41) # INVALID COMMAND
+            return
+        if digests is None:
+            self._send_response(41) # INVALID COMMAND
+            return
         try:
             self.server.db.put(self._client(), hash, passphrase)
         except database.InvalidPassphraseError:
@@ -264,8 +466,10 @@ class TinyIDSCommandHandler(SocketServer.StreamRequestHandler):
         else:
             self._send_response(20) # OK
     
-    def _send_response(self, code, sign=True):
+    def _send_response(self, code, sign=True, detail=None):
         msg, level = self.errcodes[code]
+        if detail:
+            msg = '%s %s' % (msg, detail)
         
         if code == 20:
             logger.info('SUCCESS: %s ran %s successfully' % (self._client(), self.doing_command))
@@ -280,28 +484,354 @@ class TinyIDSCommandHandler(SocketServer.StreamRequestHandler):
             msg = self.server.pki.sign(msg)
             logger.info('PKI: data signed')
         
-        self.wfile.write(msg + self.cmd_end)
+        if self.framed:
+            self.wfile.write(format_frame(msg, self.cmd_end))
+        else:
+            self.wfile.write(msg + self.cmd_end)
         logger.info('Sent response to %s' % self._client())
 
    
     def setup(self):
         logger.debug('%s client connected' % self._client())
+        # Sets the timeout of the connection socket
+        self.timeout = self.server.idle_timeout
         SocketServer.StreamRequestHandler.setup(self)
         
     def handle(self):
-        try:
-            data = self._get_data()
-        except DataDecryptionError:
-            self._send_response(40, sign=False) # INVALID CLIENT
-        else:
-            if self._verify_grammar(data):
-                self._process_command(data)
-                self._finish_command()
-            else:
+        while True:
+            try:
+                data = self._get_data()
+            except socket.timeout:
+                logger.debug('%s client idle for %s seconds' % (self._client(), self.timeout))
+                return
+            except FrameError, strerror:
+                logger.warning('Invalid data from %s: %s' % (self._client(), strerror))
+                # The rest of the data cannot be trusted to start at a
+                # message boundary
+                self.framed = True
+                self.close_connection = True
                 self._send_response(41)
+                return
+            except DataDecryptionError:
+                self._send_response(40, sign=False) # INVALID CLIENT
+            else:
+                if data is None:
+                    return
+                if self._verify_grammar(data):
+                    self._process_command(data)
+                    self._finish_command()
+                else:
+                    self._send_response(41)
+            if not self.framed:
+                return
     
     def finish(self):
         SocketServer.StreamRequestHandler.finish(self)
         logger.debug('%s client disconnected' % self._client())
         
         #self.server.db.dbprint()
+
+
+class _BufferedOutput:
+    """File-like object that collects the data written by a handler."""
+    
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+    
+    def write(self, data):
+        self.chunks.append(data)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class _BufferedRequest:
+    """Stands in for the socket of a connection, so that a request handler
+    processes the messages that have been received by the event loop."""
+    
+    def __init__(self, data):
+        self.rfile = cStringIO.StringIO(data)
+        self.wfile = _BufferedOutput()
+    
+    def settimeout(self, timeout):
+        pass
+    
+    def makefile(self, mode='r', bufsize=-1):
+        if 'r' in mode:
+            return self.rfile
+        return self.wfile
+
+
+class _EventLoopConnection:
+    """State of a connection of the event loop server."""
+    
+    def __init__(self, sock, client_address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.client_address = client_address
+        self.inbuf = ''
+        self.outbuf = ''
+        # True while the messages of the connection are being processed
+        self.busy = False
+        # True if the connection is closed after the output has been sent
+        self.closing = False
+        self.last_activity = 0
+
+
+class TinyIDSEventLoopServer(TinyIDSServer):
+    """TinyIDS Server engine that multiplexes all connections with epoll.
+    
+    A single thread accepts the connections and reads and writes their data
+    without blocking. As soon as complete messages have been received on a
+    connection (see util.get_message_length()), they are processed by the
+    request handler in a pool of 'workers' threads, which also performs the
+    PKI operations and the database writes. The handler reads the messages
+    from a buffer and its responses are sent by the event loop. Only one
+    batch of messages of each connection is processed at a time and the
+    connection is not read in the meantime.
+    
+    If more than 'workers' * WORKER_QUEUE_FACTOR batches are waiting for a
+    worker, no new connections are accepted until the queue drains, so that
+    the excess connections wait in the listen backlog of the kernel.
+    
+    Connections that do not complete a message for 'idle_timeout' seconds
+    are closed.
+    
+    """
+    
+    read_size = 65536
+    WORKER_QUEUE_FACTOR = 4
+    
+    def __init__(self, server_address, RequestHandlerClass, pki, db=None, reuse_port=False):
+        if not hasattr(select, 'epoll'):
+            logger.error('The epoll server engine is not supported on this system')
+            raise InternalServerError
+        self.workers = None
+        self.pool = None
+        self.epoll = None
+        self._wakeup_r = self._wakeup_w = None
+        # fd : _EventLoopConnection instance
+        self.connections = {}
+        # Results of the workers: (connection, output, keep_open) tuples
+        self.results = collections.deque()
+        self.pending = 0
+        self.accepting = False
+        self.last_idle_check = 0
+        self._stop = False
+        TinyIDSServer.__init__(self, server_address, RequestHandlerClass, pki, db, reuse_port)
+    
+    def server_activate(self):
+        TinyIDSServer.server_activate(self)
+        self.workers = self.options['workers']
+        self.pool = ThreadPool(self.workers)
+        self.socket.setblocking(0)
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.epoll = select.epoll()
+        self.epoll.register(self._wakeup_r, select.EPOLLIN)
+        self.epoll.register(self.socket.fileno(), select.EPOLLIN)
+        self.accepting = True
+        logger.info('Event loop engine started with %d workers' % self.workers)
+    
+    def server_close(self):
+        for fd in self.connections.keys():
+            self._close_connection(fd)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        if self.epoll is not None:
+            self.epoll.close()
+            self.epoll = None
+            os.close(self._wakeup_r)
+            os.close(self._wakeup_w)
+        TinyIDSServer.server_close(self)
+    
+    def shutdown(self):
+        self._stop = True
+        self._wakeup()
+    
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            pass
+    
+    def _set_accepting(self):
+        """Stops or resumes accepting connections depending on the number
+        of batches that are waiting for a worker."""
+        accepting = self.pending < self.workers * self.WORKER_QUEUE_FACTOR
+        if accepting != self.accepting:
+            self.accepting = accepting
+            events = 0
+            if accepting:
+                events = select.EPOLLIN
+            self.epoll.modify(self.socket.fileno(), events)
+    
+    def _accept(self):
+        while self.accepting:
+            try:
+                sock, client_address = self.socket.accept()
+            except socket.error, (err, strerror):
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    return
+                logger.warning('Cannot accept connection: %s' % strerror)
+                return
+            if not self.verify_request(sock, client_address):
+                sock.close()
+                continue
+            sock.setblocking(0)
+            conn = _EventLoopConnection(sock, client_address)
+            conn.last_activity = time.time()
+            self.connections[sock.fileno()] = conn
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+    
+    def _close_connection(self, fd):
+        conn = self.connections.pop(fd, None)
+        if conn is None:
+            return
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+        conn.sock.close()
+    
+    def _read(self, fd):
+        conn = self.connections[fd]
+        try:
+            data = conn.sock.recv(self.read_size)
+        except socket.error, (err, strerror):
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            # The client has closed the connection
+            self._close_connection(fd)
+            return
+        conn.inbuf += data
+        self._dispatch(fd)
+    
+    def _dispatch(self, fd):
+        """Passes the complete messages of the connection to a worker."""
+        conn = self.connections[fd]
+        max_len = self.RequestHandlerClass.max_data_len
+        line_end = self.RequestHandlerClass.cmd_end
+        end = 0
+        while True:
+            length = get_message_length(conn.inbuf[end:], max_len, line_end)
+            if not length:
+                break
+            end += length
+        if not end:
+            return
+        data, conn.inbuf = conn.inbuf[:end], conn.inbuf[end:]
+        conn.busy = True
+        conn.last_activity = time.time()
+        self.epoll.modify(fd, 0)
+        self.pending += 1
+        self.pool.apply_async(self._process, (conn, data), callback=self._finish)
+        self._set_accepting()
+    
+    def _process(self, conn, data):
+        """Runs in a worker. Processes the messages with the request handler."""
+        request = _BufferedRequest(data)
+        keep_open = False
+        try:
+            handler = self.RequestHandlerClass(request, conn.client_address, self)
+            keep_open = handler.framed and not handler.close_connection
+        except:
+            self.handle_error(request, conn.client_address)
+        return conn, request.wfile.getvalue(), keep_open
+    
+    def _finish(self, result):
+        """Runs in the result thread of the pool."""
+        self.results.append(result)
+        self._wakeup()
+    
+    def _process_results(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError:
+            pass
+        while self.results:
+            conn, output, keep_open = self.results.popleft()
+            self.pending -= 1
+            if self.connections.get(conn.fd) is not conn:
+                # The connection has been closed in the meantime
+                continue
+            fd = conn.fd
+            conn.outbuf += output
+            conn.closing = not keep_open
+            conn.last_activity = time.time()
+            self._write(fd)
+        self._set_accepting()
+    
+    def _write(self, fd):
+        conn = self.connections[fd]
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except socket.error, (err, strerror):
+                if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._close_connection(fd)
+                    return
+                sent = 0
+            conn.outbuf = conn.outbuf[sent:]
+        if conn.outbuf:
+            self.epoll.modify(fd, select.EPOLLOUT)
+        elif conn.closing:
+            self._close_connection(fd)
+        else:
+            conn.busy = False
+            self.epoll.modify(fd, select.EPOLLIN)
+            # Messages that have been pipelined in the meantime
+            self._dispatch(fd)
+    
+    def _close_idle_connections(self):
+        now = time.time()
+        if now - self.last_idle_check < 1:
+            return
+        self.last_idle_check = now
+        deadline = now - self.idle_timeout
+        for fd, conn in self.connections.items():
+            if not conn.busy and conn.last_activity < deadline:
+                logger.debug('%s client idle for %s seconds' % (conn.client_address[0], self.idle_timeout))
+                self._close_connection(fd)
+    
+    def serve_forever(self, poll_interval=0.5):
+        """Runs the event loop until shutdown() is called."""
+        listen_fd = self.socket.fileno()
+        while not self._stop:
+            try:
+                events = self.epoll.poll(min(poll_interval, self.idle_timeout))
+            except IOError, (err, strerror):
+                if err == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == listen_fd:
+                    self._accept()
+                elif fd == self._wakeup_r:
+                    self._process_results()
+                elif not self.connections.has_key(fd):
+                    continue
+                elif event & select.EPOLLOUT:
+                    self._write(fd)
+                elif event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                    self._read(fd)
+            self._close_idle_connections()
+
+
+# Server engines that can be selected with the 'engine' option
+SERVER_ENGINES = {
+    'threading': TinyIDSServer,
+    'epoll': TinyIDSEventLoopServer,
+}
@@ -0,0 +1,667 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import time
+import zlib
+import struct
+import marshal
+import logging
+import anydbm
+import threading
+
+try:
+    import gdbm
+except ImportError:
+    gdbm = None
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+DEFAULT_STORAGE_ENGINE = 'anydbm'
+MIGRATION_BATCH_SIZE = 1000
+
+# Memory engine
+DEFAULT_COMMIT_DELAY = 0.01     # seconds
+DEFAULT_SNAPSHOT_LOG_SIZE = 64 * 1048576    # bytes
+SNAPSHOT_FORMAT = 'TINYIDS-SNAPSHOT 1\n'
+# crc32 of the rest of the record, operation, key length, value length
+LOG_RECORD_HEADER = struct.Struct('!IBII')
+LOG_PUT = 1
+LOG_DELETE = 2
+
+
+logger = logging.getLogger()
+
+
+class StorageError(Exception):
+    pass
+
+
+class StorageEngine:
+    """Interface of the storage engines of the hash database.
+
+    A storage engine maps string keys to string values. Engines are not
+    required to be thread-safe. Callers serialize access to them.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        """Opens the storage or creates it if it does not exist.
+
+        On error raises StorageError.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def get(self, key):
+        """Returns the value of the key or None, if the key does not exist."""
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Removes the key. Missing keys are ignored."""
+        raise NotImplementedError
+
+    def iteritems(self):
+        """Iterates over all (key, value) pairs without loading them all in
+        memory, if the engine allows it."""
+        raise NotImplementedError
+
+    def put_many(self, items):
+        """Stores an iterable of (key, value) pairs."""
+        for key, value in items:
+            self.put(key, value)
+
+    def sync(self):
+        """Writes pending changes to the disk."""
+        pass
+
+    def commit(self):
+        """Waits until the changes that have been made so far are on the
+        disk, so that they are not lost if the server crashes. Engines that
+        do not keep a log of the changes return at once.
+
+        On error raises StorageError.
+
+        """
+        pass
+
+
+class AnydbmEngine(StorageEngine):
+    """Uses whichever DBM module the anydbm module selects.
+
+    This is the storage of previous TinyIDS versions. Depending on the
+    installed modules, anydbm may fall back to dumbdbm, which rewrites its
+    index on every change and becomes slow as the number of records grows.
+
+    """
+
+    def _open(self):
+        return anydbm.open(self.path, 'c', 0640)
+
+    def open(self):
+        try:
+            self.db = self._open()
+        except anydbm.error, strerror:
+            raise StorageError(str(strerror))
+
+    def close(self):
+        self.db.close()
+
+    def get(self, key):
+        try:
+            return self.db[key]
+        except KeyError:
+            return None
+
+    def put(self, key, value):
+        self.db[key] = value
+
+    def delete(self, key):
+        try:
+            del self.db[key]
+        except KeyError:
+            pass
+
+    def iteritems(self):
+        for key in self.db.keys():
+            yield key, self.db[key]
+
+    def sync(self):
+        if hasattr(self.db, 'sync'):
+            self.db.sync()
+
+
+class GdbmEngine(AnydbmEngine):
+    """Uses the GNU dbm module.
+
+    The database is opened in fast mode, so that writes are not synchronized
+    to the disk one by one. sync() is called when the database is closed.
+
+    """
+
+    def _open(self):
+        if gdbm is None:
+            raise StorageError('The gdbm module is not available')
+        try:
+            return gdbm.open(self.path, 'cf', 0640)
+        except gdbm.error, strerror:
+            raise StorageError(str(strerror))
+
+    def close(self):
+        self.db.sync()
+        self.db.close()
+
+    def iteritems(self):
+        key = self.db.firstkey()
+        while key is not None:
+            yield key, self.db[key]
+            key = self.db.nextkey(key)
+
+
+class SqliteEngine(StorageEngine):
+    """Stores the records in an SQLite database in WAL mode.
+
+    In WAL (write-ahead log) mode, readers do not block the writer and a
+    write only appends to the log, which is synchronized at checkpoints
+    (synchronous = NORMAL). The SQL statements are constant strings, so
+    that the sqlite3 module prepares each one of them only once and reuses
+    it from its statement cache.
+
+    The connection may be used from several threads.
+
+    """
+
+    SQL_CREATE = 'CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value BLOB NOT NULL)'
+    SQL_GET = 'SELECT value FROM records WHERE key = ?'
+    SQL_PUT = 'INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)'
+    SQL_DELETE = 'DELETE FROM records WHERE key = ?'
+    SQL_ITERATE = 'SELECT key, value FROM records ORDER BY key'
+
+    def open(self):
+        if sqlite3 is None:
+            raise StorageError('The sqlite3 module is not available')
+        try:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.conn.text_factory = str
+            mode = self.conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                raise StorageError('Cannot enable WAL mode: %s' % mode)
+            self.conn.execute('PRAGMA synchronous = NORMAL')
+            self.conn.execute(self.SQL_CREATE)
+        except sqlite3.Error, strerror:
+            raise StorageError(str(strerror))
+        os.chmod(self.path, 0640)
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, key):
+        row = self.conn.execute(self.SQL_GET, (key,)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def put(self, key, value):
+        self.conn.execute(self.SQL_PUT, (key, buffer(value)))
+
+    def delete(self, key):
+        self.conn.execute(self.SQL_DELETE, (key,))
+
+    def iteritems(self):
+        for key, value in self.conn.execute(self.SQL_ITERATE):
+            yield key, str(value)
+
+    def put_many(self, items):
+        """Stores the items in a single transaction."""
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany(self.SQL_PUT, ((key, buffer(value)) for key, value in items))
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def sync(self):
+        self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+def _format_log_record(operation, key, value=''):
+    data = LOG_RECORD_HEADER.pack(0, operation, len(key), len(value))[4:] + key + value
+    return struct.pack('!I', zlib.crc32(data) & 0xffffffff) + data
+
+def _replay_log(records, data):
+    """Applies the log records in 'data' to the 'records' dictionary.
+
+    Returns the length of the valid part of the log. Replay stops at the
+    first incomplete or corrupt record, which is the result of a write that
+    was interrupted by a crash.
+
+    """
+    offset = 0
+    end = len(data)
+    while offset + LOG_RECORD_HEADER.size <= end:
+        crc, operation, key_len, value_len = LOG_RECORD_HEADER.unpack_from(data, offset)
+        start = offset + LOG_RECORD_HEADER.size
+        stop = start + key_len + value_len
+        if stop > end:
+            break
+        if zlib.crc32(buffer(data, offset + 4, stop - offset - 4)) & 0xffffffff != crc:
+            break
+        key = data[start:start + key_len]
+        if operation == LOG_PUT:
+            records[key] = data[start + key_len:stop]
+        elif operation == LOG_DELETE:
+            records.pop(key, None)
+        else:
+            break
+        offset = stop
+    return offset
+
+def _fsync_directory(path):
+    fd = os.open(os.path.dirname(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MemoryEngine(StorageEngine):
+    """Keeps all records in memory and every change in an append-only log.
+
+    Files:
+
+      <path>          snapshot of all records
+      <path>.log      changes since the snapshot
+      <path>.log.old  changes that are being compacted into a new snapshot
+
+    Changes are written to the log by a background thread, which
+    synchronizes each batch of changes to the disk with a single fsync()
+    (group commit). Only then are they applied to the records in memory, so
+    get() and iteritems() never return a change that could still be lost in
+    a crash. commit() waits until the changes have been synchronized. The
+    thread waits 'commit_delay' seconds after the first change of a batch,
+    so that the changes of concurrent requests are synchronized together.
+    This bounds the latency that group commit adds to a write.
+
+    When the log grows beyond 'snapshot_log_size' bytes, it is renamed to
+    <path>.log.old and a new log is started. A copy of the records is then
+    written to a new snapshot by another thread, while requests continue to
+    be served, and the old log is removed. If the snapshot cannot be
+    written, the old log is kept and the snapshot is retried after the log
+    has grown by another 'snapshot_log_size' bytes.
+
+    On open, the snapshot is loaded and the logs are replayed. A record that
+    was only partly written when the server crashed is discarded.
+
+    """
+
+    def __init__(self, path, commit_delay=DEFAULT_COMMIT_DELAY,
+            snapshot_log_size=DEFAULT_SNAPSHOT_LOG_SIZE):
+        StorageEngine.__init__(self, path)
+        self.log_path = path + '.log'
+        self.old_log_path = path + '.log.old'
+        self.commit_delay = commit_delay
+        self.snapshot_log_size = snapshot_log_size
+        self.records = {}
+
+        self._lock = threading.Lock()
+        # Notifies the committer of new changes
+        self._changed = threading.Condition(self._lock)
+        # Notifies the callers of commit() that changes are on the disk
+        self._committed = threading.Condition(self._lock)
+        # (sequence number, key, value, log record) tuples of the changes
+        # that have not been written. The value of a removed key is None.
+        self._pending = []
+        # key : (sequence number, value) of the changes that are not on the
+        # disk yet
+        self._changes = {}
+        self._last_appended = 0     # sequence number of the last change
+        self._last_committed = 0    # ... of the last change on the disk
+        self._error = None
+        self._closing = False
+        self._log = None
+        self._log_size = 0
+        # Size of the log at which the next snapshot is started
+        self._snapshot_at = snapshot_log_size
+        self._committer = None
+        self._compactor = None
+
+    # Files
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.path):
+            return {}
+        f = open(self.path, 'rb')
+        try:
+            if f.readline() != SNAPSHOT_FORMAT:
+                raise StorageError('Invalid snapshot: %s' % self.path)
+            try:
+                records = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                raise StorageError('Invalid snapshot: %s' % self.path)
+        finally:
+            f.close()
+        if not isinstance(records, dict):
+            raise StorageError('Invalid snapshot: %s' % self.path)
+        return records
+
+    def _write_snapshot(self, records):
+        tmp_path = self.path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            os.chmod(tmp_path, 0640)
+            f.write(SNAPSHOT_FORMAT)
+            marshal.dump(records, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+        _fsync_directory(self.path)
+
+    def _replay(self, path):
+        """Replays the log at path and truncates its invalid part. Returns
+        the size of the log."""
+        if not os.path.exists(path):
+            return 0
+        f = open(path, 'r+b')
+        try:
+            data = f.read()
+            size = _replay_log(self.records, data)
+            if size < len(data):
+                logger.warning('Discarding %d bytes of incomplete records at the end of %s' % (
+                    len(data) - size, path))
+                f.truncate(size)
+        finally:
+            f.close()
+        return size
+
+    def _open_log(self):
+        self._log = open(self.log_path, 'ab')
+        os.chmod(self.log_path, 0640)
+
+    def _snapshot(self):
+        """Starts a new log and writes a snapshot in the background.
+
+        If the old log still exists, because the previous snapshot could not
+        be written, only the snapshot is retried. The old log is removed once
+        a snapshot contains its changes. Replaying the log on top of a
+        snapshot that already contains some of its changes is harmless.
+
+        """
+        if os.path.exists(self.old_log_path):
+            logger.info('Retrying the database snapshot')
+            self._snapshot_at = self._log_size + self.snapshot_log_size
+        else:
+            self._log.close()
+            os.rename(self.log_path, self.old_log_path)
+            self._open_log()
+            _fsync_directory(self.log_path)
+            self._log_size = 0
+            self._snapshot_at = self.snapshot_log_size
+        # The records contain the changes that have been written to the
+        # logs. Those that have not are written to the new log.
+        self._lock.acquire()
+        try:
+            records = self.records.copy()
+        finally:
+            self._lock.release()
+        self._compactor = threading.Thread(target=self._compact, args=(records,))
+        self._compactor.setDaemon(True)
+        self._compactor.start()
+
+    def _compact(self, records):
+        t0 = time.time()
+        try:
+            self._write_snapshot(records)
+            os.remove(self.old_log_path)
+        except (IOError, OSError), (err, strerror):
+            logger.error('Cannot write the database snapshot: %s. The old log is kept until a snapshot succeeds' % strerror)
+            return
+        logger.info('Database snapshot written: %d records in %.1f seconds' % (
+            len(records), time.time() - t0))
+
+    # Group commit
+
+    def _append(self, operation, key, value=None):
+        record = _format_log_record(operation, key, value or '')
+        self._lock.acquire()
+        try:
+            if self._error is not None:
+                raise StorageError(self._error)
+            self._last_appended += 1
+            self._pending.append((self._last_appended, key, value, record))
+            self._changes[key] = (self._last_appended, value)
+            self._changed.notify()
+        finally:
+            self._lock.release()
+
+    def _publish(self, batch):
+        """Applies a batch of changes that are on the disk to the records.
+        Should be called with the lock held."""
+        for sequence, key, value, record in batch:
+            if value is None:
+                self.records.pop(key, None)
+            else:
+                self.records[key] = value
+            if self._changes[key][0] == sequence:
+                # No later change of the key is pending
+                del self._changes[key]
+
+    def _compacting(self):
+        return self._compactor is not None and self._compactor.isAlive()
+
+    def _commit_loop(self):
+        while True:
+            self._lock.acquire()
+            try:
+                while not self._pending and not self._closing:
+                    self._changed.wait()
+                if not self._pending:
+                    return
+                closing = self._closing
+            finally:
+                self._lock.release()
+            if self.commit_delay and not closing:
+                # Gather the changes of concurrent requests
+                time.sleep(self.commit_delay)
+            self._lock.acquire()
+            try:
+                batch = self._pending
+                self._pending = []
+                last = self._last_appended
+            finally:
+                self._lock.release()
+            error = None
+            try:
+                data = ''.join([record for sequence, key, value, record in batch])
+                self._log.write(data)
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log_size += len(data)
+            except (IOError, OSError), (err, strerror):
+                error = 'Cannot write the database log: %s' % strerror
+            self._lock.acquire()
+            try:
+                if error is None:
+                    self._publish(batch)
+                    self._last_committed = last
+                else:
+                    self._error = error
+                self._committed.notifyAll()
+            finally:
+                self._lock.release()
+            if error is None and self._log_size >= self._snapshot_at and not self._compacting():
+                try:
+                    self._snapshot()
+                except (IOError, OSError), (err, strerror):
+                    error = 'Cannot rotate the database log: %s' % strerror
+                    self._lock.acquire()
+                    try:
+                        self._error = error
+                        self._committed.notifyAll()
+                    finally:
+                        self._lock.release()
+            if error is not None:
+                logger.error(error)
+                return
+
+    # Public API
+
+    def open(self):
+        try:
+            self.records = self._load_snapshot()
+            if os.path.exists(self.old_log_path):
+                self._replay(self.old_log_path)
+            self._log_size = self._replay(self.log_path)
+            if os.path.exists(self.old_log_path):
+                # A snapshot was interrupted. It is written now, because
+                # the old log cannot be replaced while it exists.
+                self._write_snapshot(self.records)
+                open(self.log_path, 'wb').close()
+                os.remove(self.old_log_path)
+                self._log_size = 0
+            self._open_log()
+        except (IOError, OSError), (err, strerror):
+            raise StorageError(strerror)
+        self._committer = threading.Thread(target=self._commit_loop)
+        self._committer.setDaemon(True)
+        self._committer.start()
+
+    def close(self):
+        """Writes the pending changes to the log and closes it."""
+        self._lock.acquire()
+        try:
+            self._closing = True
+            self._changed.notify()
+        finally:
+            self._lock.release()
+        self._committer.join()
+        if self._compactor is not None:
+            self._compactor.join()
+        self._log.close()
+
+    def get(self, key):
+        return self.records.get(key)
+
+    def put(self, key, value):
+        self._append(LOG_PUT, key, value)
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if self._changes.has_key(key):
+                exists = self._changes[key][1] is not None
+            else:
+                exists = self.records.has_key(key)
+        finally:
+            self._lock.release()
+        if exists:
+            self._append(LOG_DELETE, key)
+
+    def iteritems(self):
+        # The committer changes the records at any time
+        self._lock.acquire()
+        try:
+            items = self.records.items()
+        finally:
+            self._lock.release()
+        return iter(items)
+
+    def sync(self):
+        self.commit()
+
+    def commit(self):
+        self._lock.acquire()
+        try:
+            last = self._last_appended
+            while self._last_committed < last and self._error is None:
+                self._committed.wait()
+            if self._error is not None:
+                raise StorageError(self._error)
+        finally:
+            self._lock.release()
+
+
+# Engines that can be selected with the 'db_engine' option
+STORAGE_ENGINES = {
+    'anydbm': AnydbmEngine,
+    'gdbm': GdbmEngine,
+    'sqlite': SqliteEngine,
+    'memory': MemoryEngine,
+}
+
+
+def get_storage_engine(name, path, **options):
+    """Returns a storage engine instance, which has not been opened yet.
+
+    The options are passed to the constructor of the engine.
+
+    If the engine is unknown, raises StorageError.
+
+    """
+    if not STORAGE_ENGINES.has_key(name):
+        raise StorageError('Unknown storage engine: %s' % name)
+    return STORAGE_ENGINES[name](path, **options)
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def migrate(source, target, batch_size=MIGRATION_BATCH_SIZE):
+    """Copies all records from the source to the target storage engine.
+
+    Both engines should have been opened. The records are streamed in
+    batches of 'batch_size', so the database is never loaded in memory as
+    a whole. Existing records of the target with the same keys are
+    replaced. Returns the number of records that have been copied.
+
+    """
+    count = 0
+    for batch in _batches(source.iteritems(), batch_size):
+        target.put_many(batch)
+        count += len(batch)
+    target.sync()
+    return count
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import time
+import ctypes
+import ctypes.util
+import platform
+import threading
+import multiprocessing
+
+
+PRESSURE_DIR = '/proc/pressure'
+DEFAULT_PRESSURE_THRESHOLD = 10.0   # percent of time stalled (avg10)
+DEFAULT_PRESSURE_INTERVAL = 1.0     # seconds
+# The rate limits are never reduced below this fraction
+MIN_RATE_FACTOR = 1.0 / 64
+RATE_INCREASE = 1.25
+
+# ioprio_set(2)
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i486': 289,
+    'i586': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64': 273,
+    'ppc64le': 273,
+    's390x': 282,
+}
+
+# sched_setscheduler(2)
+SCHED_IDLE = 5
+
+
+class PriorityError(Exception):
+    pass
+
+
+def read_pressure(resource, path=PRESSURE_DIR):
+    """Returns the share of time (percent, 10 second average) during which
+    some tasks were stalled waiting for the resource ('io', 'cpu' or
+    'memory') or None if Pressure Stall Information is not available."""
+    try:
+        f = open(os.path.join(path, resource))
+    except IOError:
+        return None
+    try:
+        for line in f:
+            fields = line.split()
+            if fields and fields[0] == 'some':
+                for field in fields[1:]:
+                    key, sep, value = field.partition('=')
+                    if key == 'avg10':
+                        return float(value)
+    finally:
+        f.close()
+    return None
+
+
+class PressureMonitor:
+    """Adjusts the rate limits according to the load of the host.
+
+    Every 'interval' seconds the I/O and CPU pressure (see read_pressure())
+    and the load average are checked. If the I/O or CPU pressure exceeds
+    'pressure_threshold' percent, or if the 1-minute load average per CPU
+    exceeds 'load_threshold' (0 disables the check), the host is considered
+    busy and the rate factor is halved, down to MIN_RATE_FACTOR. Otherwise,
+    the factor is gradually increased back to 1. The rate of the TokenBucket
+    instances that use the monitor is multiplied by the factor.
+
+    If Pressure Stall Information is not available, only the load average
+    is checked.
+
+    Counters:
+
+      checks: number of times the load of the host has been checked.
+      busy_checks: number of checks that found the host busy.
+
+    """
+
+    def __init__(self, pressure_threshold=DEFAULT_PRESSURE_THRESHOLD, load_threshold=0,
+            interval=DEFAULT_PRESSURE_INTERVAL):
+        self.pressure_threshold = pressure_threshold
+        self.load_threshold = load_threshold
+        self.interval = interval
+        self.factor = 1.0
+        self.last_check = 0
+        self.checks = 0
+        self.busy_checks = 0
+        try:
+            self.cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            self.cpus = 1
+        self._lock = threading.Lock()
+
+    def is_busy(self):
+        """Returns True if the host is under pressure."""
+        for resource in ('io', 'cpu'):
+            pressure = read_pressure(resource)
+            if pressure is not None and pressure >= self.pressure_threshold:
+                return True
+        if self.load_threshold:
+            try:
+                load = os.getloadavg()[0]
+            except OSError:
+                return False
+            if load / self.cpus >= self.load_threshold:
+                return True
+        return False
+
+    def get_factor(self):
+        """Returns the factor the rate limits should be multiplied with."""
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if now - self.last_check >= self.interval:
+                self.last_check = now
+                self.checks += 1
+                if self.is_busy():
+                    self.busy_checks += 1
+                    self.factor = max(self.factor / 2, MIN_RATE_FACTOR)
+                else:
+                    self.factor = min(self.factor * RATE_INCREASE, 1.0)
+            return self.factor
+        finally:
+            self._lock.release()
+
+
+class TokenBucket:
+    """Limits the rate of an operation using the token bucket algorithm.
+
+    Tokens are added to the bucket at 'rate' tokens per second, up to
+    'capacity' tokens. Each operation consumes as many tokens as its cost,
+    for example the number of bytes that have been read. If there are not
+    enough tokens, consume() sleeps until the missing tokens have been
+    added, so the sustained rate never exceeds 'rate', while operations that
+    are cheaper than the tokens left in the bucket do not wait at all.
+
+    The capacity defaults to 'rate', that is one second worth of tokens.
+    A rate of 0 disables the limit.
+
+    If a PressureMonitor instance is provided, the rate is multiplied by
+    the factor it returns, so that the bucket slows down while the host is
+    busy.
+
+    Instances are thread-safe. Threads that share a bucket share its rate.
+
+    Counters:
+
+      throttled_time: total time in seconds consume() has slept.
+      throttled_count: number of times consume() has slept.
+
+    """
+
+    def __init__(self, rate, capacity=None, monitor=None):
+        self.rate = float(rate)
+        if capacity is None:
+            capacity = self.rate
+        self.capacity = float(capacity)
+        self.monitor = monitor
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.throttled_time = 0.0
+        self.throttled_count = 0
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Consumes 'amount' tokens and returns the time in seconds the
+        caller has slept because the bucket did not contain enough tokens.
+
+        An amount that exceeds the capacity is allowed. The bucket goes into
+        debt, which later operations have to wait for.
+
+        """
+        if not self.rate:
+            return 0.0
+        rate = self.rate
+        if self.monitor is not None:
+            rate *= self.monitor.get_factor()
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * rate)
+            self.last = now
+            self.tokens -= amount
+            delay = 0.0
+            if self.tokens < 0:
+                delay = -self.tokens / rate
+                self.throttled_time += delay
+                self.throttled_count += 1
+        finally:
+            self._lock.release()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        path = ctypes.util.find_library('c')
+        if not path:
+            raise PriorityError('C library not found')
+        _libc = ctypes.CDLL(path, use_errno=True)
+    return _libc
+
+
+class _SchedParam(ctypes.Structure):
+    _fields_ = [('sched_priority', ctypes.c_int)]
+
+
+def set_idle_io_priority():
+    """Puts the calling process in the idle I/O scheduling class, so that
+    it only gets disk time when no other process needs it. Threads that
+    are started afterwards inherit the I/O priority.
+
+    On error raises PriorityError.
+
+    """
+    syscall_nr = SYS_IOPRIO_SET.get(platform.machine())
+    if syscall_nr is None:
+        raise PriorityError('ioprio_set is not supported on %s' % platform.machine())
+    ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    if _get_libc().syscall(syscall_nr, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        raise PriorityError(os.strerror(ctypes.get_errno()))
+
+
+def set_idle_cpu_priority():
+    """Sets the SCHED_IDLE scheduling policy for the calling process, so
+    that it only runs on otherwise idle CPUs. Threads that are started
+    afterwards inherit the policy.
+
+    On error raises PriorityError.
+
+    """
+    param = _SchedParam(0)
+    if _get_libc().sched_setscheduler(0, SCHED_IDLE, ctypes.byref(param)) != 0:
+        raise PriorityError(os.strerror(ctypes.get_errno()))
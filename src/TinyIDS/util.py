@@ -24,21 +24,280 @@
 #
 
 import imp
+import re
 
 try:
     import hashlib
     sha1 = hashlib.sha1
 except ImportError:
+    hashlib = None
     import sha
     sha1 = sha.new
 
 
+# Digest algorithm of checksums that are not tagged with an algorithm name
+DEFAULT_DIGEST_ALGORITHM = 'sha1'
+
+_RE_ALGORITHM = re.compile(r'^[A-Za-z0-9_-]+$')
+_RE_HEXDIGEST = re.compile(r'^[0-9a-fA-F]+$')
+_RE_BACKEND_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+# Starts the frames of protocol revision 3 (see format_frame())
+FRAME_MARKER = '#'
+
+
+class UnsupportedAlgorithmError(Exception):
+    pass
+
+class FrameError(Exception):
+    pass
+
+
+
 def sha1sum(data):
     """Returns the sha1 checksum of the provided data."""
     s = sha1()
     s.update(data)
     return s.hexdigest()
 
+def get_hasher(algorithm):
+    """Returns a new hashing object for the named digest algorithm.
+    
+    Any algorithm supported by hashlib can be used, for example: sha1,
+    sha256, sha512, blake2b.
+    
+    If the algorithm is not supported, raises UnsupportedAlgorithmError.
+    
+    """
+    algorithm = algorithm.strip().lower()
+    if algorithm == 'sha1':
+        return sha1()
+    elif hashlib is None or not _RE_ALGORITHM.match(algorithm):
+        raise UnsupportedAlgorithmError(algorithm)
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise UnsupportedAlgorithmError(algorithm)
+
+def format_digests(digests):
+    """Returns a string representation of one or more digests.
+    
+    Accepts a list of (algorithm, hexdigest) tuples.
+    
+    The format is:
+    
+        <algorithm>:<hexdigest>[,<algorithm>:<hexdigest>...]
+    
+    A single digest of the default algorithm (sha1) is returned untagged,
+    so that it is understood by servers that do not support digest
+    algorithms.
+    
+    """
+    if len(digests) == 1 and digests[0][0] == DEFAULT_DIGEST_ALGORITHM:
+        return digests[0][1]
+    return ','.join(['%s:%s' % (algorithm, hexdigest) for algorithm, hexdigest in digests])
+
+def parse_digests(data):
+    """Parses the output of format_digests().
+    
+    Returns a dictionary: {<algorithm>: <hexdigest>, ...}
+    
+    Untagged digests are considered to have been calculated with the
+    default algorithm (sha1).
+    
+    On invalid input, raises ValueError.
+    
+    """
+    digests = {}
+    for item in data.split(','):
+        algorithm, sep, hexdigest = item.rpartition(':')
+        if not sep:
+            algorithm = DEFAULT_DIGEST_ALGORITHM
+        algorithm = algorithm.lower()
+        if not _RE_ALGORITHM.match(algorithm) or not _RE_HEXDIGEST.match(hexdigest):
+            raise ValueError('Invalid digest: %s' % item)
+        if digests.has_key(algorithm):
+            raise ValueError('Duplicate digest algorithm: %s' % algorithm)
+        digests[algorithm] = hexdigest.lower()
+    return digests
+
+def format_digest_vector(digests, backend_digests):
+    """Returns a string representation of a checksum and of the digests of
+    the backends it has been calculated from.
+    
+    Accepts the output of format_digests() for the checksum, or None, and
+    a list of (backend_name, format_digests() output) tuples.
+    
+    The format is:
+    
+        [<checksum>];<backend_name>=<digests>[;<backend_name>=<digests>...]
+    
+    The backends are sorted by name. Without backend digests, the checksum
+    is returned as is. Without a checksum, the string starts with ';'.
+    
+    """
+    if not backend_digests:
+        return digests
+    items = ['%s=%s' % (name, backend_digest) for name, backend_digest in sorted(backend_digests)]
+    return '%s;%s' % (digests or '', ';'.join(items))
+
+def parse_digest_vector(data):
+    """Parses the output of format_digest_vector().
+    
+    Returns a (digests, backend_digests) tuple, where 'digests' is the
+    parsed checksum (see parse_digests()) or None, if the checksum is
+    missing, and 'backend_digests' is a dictionary:
+    
+        {<backend_name>: <parsed digests>, ...}
+    
+    On invalid input, raises ValueError.
+    
+    """
+    items = data.split(';')
+    digests = None
+    if items[0]:
+        digests = parse_digests(items[0])
+    backend_digests = {}
+    for item in items[1:]:
+        name, sep, backend_digest = item.partition('=')
+        if not sep or not _RE_BACKEND_NAME.match(name):
+            raise ValueError('Invalid backend digest: %s' % item)
+        if backend_digests.has_key(name):
+            raise ValueError('Duplicate backend: %s' % name)
+        backend_digests[name] = parse_digests(backend_digest)
+    if digests is None and not backend_digests:
+        raise ValueError('No digests')
+    return digests, backend_digests
+
+def compare_digests(digests, digests_db):
+    """Compares two outputs of parse_digests().
+    
+    Only the digests of algorithms that exist in both are compared.
+    Returns True if they are equal, False if they differ or None if there
+    are no digests of common algorithms.
+    
+    """
+    algorithms = [algorithm for algorithm in digests.keys() if digests_db.has_key(algorithm)]
+    if not algorithms:
+        return None
+    return [digests[a] for a in algorithms] == [digests_db[a] for a in algorithms]
+
+def format_frame(data, line_end='\r\n'):
+    """Returns the data as a frame of protocol revision 3.
+    
+    The format is:
+    
+        #<length><line_end><data><line_end>
+    
+    where <length> is the length of the data in bytes. The data may contain
+    any bytes, including line ends.
+    
+    """
+    return '%s%d%s%s%s' % (FRAME_MARKER, len(data), line_end, data, line_end)
+
+def read_message(f, max_len, line_end='\r\n'):
+    """Reads a message from a file-like object.
+    
+    Accepts both frames (see format_frame()) and the plain lines of
+    protocol revision 2. Returns a (data, framed) tuple, where 'framed' is
+    True if the message was a frame. Returns (None, False) if the end of
+    the file has been reached before a message.
+    
+    On invalid or truncated frames, raises FrameError.
+    
+    """
+    line = f.readline(max_len)
+    if not line:
+        return None, False
+    if not line.startswith(FRAME_MARKER):
+        return line.strip(), False
+    length = line[len(FRAME_MARKER):].strip()
+    if not length.isdigit() or int(length) > max_len:
+        raise FrameError('Invalid frame length: %s' % length[:20])
+    length = int(length)
+    data = f.read(length + len(line_end))
+    if len(data) != length + len(line_end) or not data.endswith(line_end):
+        raise FrameError('Truncated frame')
+    return data[:length], True
+
+def get_message_length(data, max_len, line_end='\r\n'):
+    """Returns the length in bytes of the first message in 'data' as it
+    would be consumed by read_message(), or 0 if the message is incomplete.
+    
+    Invalid frames are considered complete after their first line, so that
+    read_message() can report them.
+    
+    """
+    pos = data.find('\n', 0, max_len)
+    if pos < 0:
+        if len(data) < max_len:
+            return 0
+        line_len = max_len
+    else:
+        line_len = pos + 1
+    if not data.startswith(FRAME_MARKER):
+        return line_len
+    length = data[len(FRAME_MARKER):line_len].strip()
+    if not length.isdigit() or int(length) > max_len:
+        return line_len
+    total = line_len + int(length) + len(line_end)
+    if len(data) < total:
+        return 0
+    return total
+
+
+class MultiHasher:
+    """Passes data through several digest algorithms at once.
+    
+    The data is read once and each piece of it updates all the hashing
+    objects, so calculating an extra digest does not require reading the
+    data again.
+    
+    """
+    
+    def __init__(self, algorithms):
+        """Accepts a list of digest algorithm names.
+        
+        Raises UnsupportedAlgorithmError if an algorithm is not supported.
+        
+        """
+        self.hashers = [(algorithm.strip().lower(), get_hasher(algorithm)) for algorithm in algorithms]
+    
+    def update(self, data):
+        """Passes the data through all hashing objects.
+        
+        If the data is a dictionary {<algorithm>: <data>, ...}, each hashing
+        object is updated with the data of its algorithm.
+        
+        """
+        if isinstance(data, dict):
+            for algorithm, hasher in self.hashers:
+                hasher.update(data[algorithm])
+        else:
+            for algorithm, hasher in self.hashers:
+                hasher.update(data)
+    
+    def hexdigests(self):
+        """Returns a list of (algorithm, hexdigest) tuples."""
+        return [(algorithm, hasher.hexdigest()) for algorithm, hasher in self.hashers]
+    
+    def hexdigest(self):
+        """Returns the digests formatted by format_digests()."""
+        return format_digests(self.hexdigests())
+    
+    def update_digests(self, name, other):
+        """Passes the digests of another MultiHasher of the same algorithms
+        through the hashing objects.
+        
+        Each hashing object is updated with the line '<name> <hexdigest>\n',
+        where <hexdigest> is the digest of the same algorithm calculated by
+        the other MultiHasher.
+        
+        """
+        digests = dict(other.hexdigests())
+        for algorithm, hasher in self.hashers:
+            hasher.update('%s %s\n' % (name, digests[algorithm]))
+
 def load_backend(base_dir, name):
     """Loads the backend module and returns it."""
     name = name.strip()
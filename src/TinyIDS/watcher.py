@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+
+# inotify constants (see inotify(7))
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+    IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+# Events that change the list of entries of a directory
+LISTING_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+# Events after which the watch of a directory is no longer valid
+RESCAN_MASK = IN_Q_OVERFLOW | IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')    # wd, mask, cookie, len
+READ_SIZE = 65536
+MAX_SYMLINK_HOPS = 40
+
+DEFAULT_RESCAN_INTERVAL = 86400     # seconds
+
+
+class WatcherError(Exception):
+    pass
+
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        path = ctypes.util.find_library('c')
+        if not path:
+            raise WatcherError('C library not found')
+        _libc = ctypes.CDLL(path, use_errno=True)
+        if not hasattr(_libc, 'inotify_init1'):
+            raise WatcherError('inotify is not supported')
+    return _libc
+
+
+class InotifyWatcher:
+    """Keeps track of changes to a set of files using inotify.
+
+    The watcher subscribes to the events of the directories that contain
+    the watched files and of the directories that contain the targets of
+    symbolic links, and maintains the set of paths that have changed
+    (dirty paths) since the last call to get_changes().
+
+    A full rescan is requested by get_changes() when:
+
+    - no files have been watched yet.
+    - events have been lost because the kernel event queue overflowed.
+    - a watched directory has been removed, moved or unmounted.
+    - 'rescan_interval' seconds have passed since the last full rescan.
+      Changes made through hard links located outside the watched
+      directories do not generate events, so periodic rescans are used as
+      a safety net.
+
+    Counters:
+
+      events: number of events processed.
+      overflows: number of event queue overflows.
+      rescans: number of full rescans requested.
+
+    """
+
+    def __init__(self, rescan_interval=DEFAULT_RESCAN_INTERVAL):
+        """Constructor.
+
+        On error raises WatcherError.
+
+        """
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherError(os.strerror(ctypes.get_errno()))
+        self.rescan_interval = rescan_interval
+
+        # wd : set of directory paths (a directory may be reachable
+        # through several paths, eg /bin and /usr/bin on merged-/usr systems)
+        self.wd2dirs = {}
+        # directory path : wd
+        self.dir2wd = {}
+        # path : set of watched paths that resolve through it
+        self.aliases = {}
+        # watches that have been removed, whose IN_IGNORED event has not
+        # been read yet
+        self.removed_wds = set()
+
+        self.dirty = set()
+        self.listing_changed = False
+        self.need_rescan = True
+        self.last_rescan = 0
+
+        self.events = 0
+        self.overflows = 0
+        self.rescans = 0
+
+    def _add_watch(self, directory):
+        if self.dir2wd.has_key(directory):
+            return
+        wd = _get_libc().inotify_add_watch(self.fd, directory, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise WatcherError('%s: %s' % (directory, os.strerror(err)))
+        self.dir2wd[directory] = wd
+        self.wd2dirs.setdefault(wd, set()).add(directory)
+
+    def _remove_watch(self, directory):
+        wd = self.dir2wd.pop(directory)
+        directories = self.wd2dirs[wd]
+        directories.discard(directory)
+        if directories:
+            # The directory is still watched through another path
+            return
+        del self.wd2dirs[wd]
+        if _get_libc().inotify_rm_watch(self.fd, wd) == 0:
+            self.removed_wds.add(wd)
+
+    def _resolve_chain(self, path):
+        """Returns the list of paths a path resolves through, including
+        the path itself and the targets of all symbolic links."""
+        chain = [path]
+        while os.path.islink(path) and len(chain) < MAX_SYMLINK_HOPS:
+            path = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))
+            chain.append(path)
+        real_path = os.path.realpath(path)
+        if real_path not in chain:
+            chain.append(real_path)
+        return chain
+
+    def _read_events(self):
+        """Reads all pending events from the inotify file descriptor."""
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, (err, strerror):
+                if err in (errno.EAGAIN, errno.EINTR):
+                    return
+                raise WatcherError(strerror)
+            if not data:
+                return
+            pos = 0
+            while pos + EVENT_HEADER.size <= len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip('\0')
+                pos += length
+                self._process_event(wd, mask, name)
+
+    def _process_event(self, wd, mask, name):
+        self.events += 1
+        if wd in self.removed_wds:
+            # Event of a directory that is no longer watched
+            if mask & IN_IGNORED:
+                self.removed_wds.discard(wd)
+            return
+        if mask & IN_Q_OVERFLOW:
+            self.overflows += 1
+        if mask & IN_IGNORED:
+            # The watch has been removed by the kernel
+            for directory in self.wd2dirs.pop(wd, ()):
+                self.dir2wd.pop(directory, None)
+        if mask & RESCAN_MASK:
+            self.need_rescan = True
+            return
+        if mask & LISTING_MASK:
+            self.listing_changed = True
+        for directory in self.wd2dirs.get(wd, ()):
+            path = os.path.join(directory, name)
+            self.dirty.update(self.aliases.get(path, ()))
+
+    # Public API
+
+    def watch(self, paths, rescan=True):
+        """Replaces the set of watched files with 'paths'.
+
+        Should be called before the files are read, so that changes that
+        occur while they are being read are not missed. 'rescan' should be
+        True if the files are about to be rescanned as a whole.
+
+        The watches of directories that no longer contain any of the paths
+        are removed.
+
+        """
+        self._read_events()
+        self.aliases = {}
+        directories = set()
+        for path in paths:
+            for p in self._resolve_chain(path):
+                self.aliases.setdefault(p, set()).add(path)
+                directories.add(os.path.dirname(p))
+                directories.add(os.path.dirname(os.path.realpath(p)))
+        for directory in self.dir2wd.keys():
+            if directory not in directories:
+                self._remove_watch(directory)
+        for directory in sorted(directories):
+            self._add_watch(directory)
+        if rescan:
+            self.need_rescan = False
+            self.last_rescan = time.time()
+
+    def get_changes(self):
+        """Returns a (rescan, listing_changed, dirty_paths) tuple.
+
+        rescan: True if a full rescan is required. In this case the other
+          values should be ignored and watch() should be called.
+        listing_changed: True if entries have been added to or removed from
+          a watched directory, so the file paths should be expanded again.
+        dirty_paths: set of watched paths that have changed.
+
+        The set of dirty paths is reset after each call, also when a full
+        rescan is required, since the rescan covers all paths.
+
+        """
+        self._read_events()
+        if time.time() - self.last_rescan >= self.rescan_interval:
+            self.need_rescan = True
+        dirty, listing_changed = self.dirty, self.listing_changed
+        self.dirty = set()
+        self.listing_changed = False
+        if self.need_rescan:
+            self.rescans += 1
+            return True, True, set()
+        return False, listing_changed, dirty
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
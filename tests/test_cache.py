@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from TinyIDS.cache import LRUCache, LRU_ENTRY_OVERHEAD
+from TinyIDS.database import HashDatabase, HashDoesNotExistError
+
+
+SHA1 = 'a' * 40
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_negative_entry(self):
+        cache = LRUCache(max_entries=10)
+        self.assertEqual(cache.lookup('a'), (False, None))
+        cache.store('a', None)
+        self.assertEqual(cache.lookup('a'), (True, None))
+        self.assertEqual((cache.hits, cache.negative_hits, cache.misses), (1, 1, 1))
+        self.assertEqual(cache.size, len('a') + LRU_ENTRY_OVERHEAD)
+
+    def test_replace_negative_entry(self):
+        cache = LRUCache(max_entries=10)
+        cache.store('a', None)
+        cache.store('a', 'value')
+        self.assertEqual(cache.lookup('a'), (True, 'value'))
+        self.assertEqual(cache.negative_hits, 0)
+        self.assertEqual(cache.size, len('a') + len('value') + LRU_ENTRY_OVERHEAD)
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(max_entries=2)
+        cache.store('a', None)
+        cache.store('b', 'value')
+        # 'a' becomes the most recently used entry
+        cache.lookup('a')
+        cache.store('c', None)
+        self.assertEqual(cache.lookup('b'), (False, None))
+        self.assertEqual(cache.lookup('a'), (True, None))
+        self.assertEqual(cache.lookup('c'), (True, None))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_max_bytes(self):
+        cache = LRUCache(max_bytes=2 * (1 + LRU_ENTRY_OVERHEAD))
+        cache.store('a', None)
+        cache.store('b', None)
+        cache.store('c', 'value')
+        self.assertEqual(sorted(cache.entries.keys()), ['c'])
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(cache.size, len('c') + len('value') + LRU_ENTRY_OVERHEAD)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache.store('a', None)
+        cache.invalidate('a')
+        cache.invalidate('b')
+        self.assertEqual(cache.lookup('a'), (False, None))
+        self.assertEqual((cache.invalidations, cache.size), (1, 0))
+
+
+class DatabaseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = LRUCache(max_entries=10)
+        self.db = HashDatabase(os.path.join(self.tmp_dir, 'tinyids.db'), engine='memory',
+            cache=self.cache, engine_options={'commit_delay': 0})
+        self.db.database_activate()
+
+    def tearDown(self):
+        self.db.database_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_missing_client(self):
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        # The second lookup is answered by the cache
+        self.assertEqual((self.cache.misses, self.cache.negative_hits), (1, 1))
+
+    def test_put_invalidates_negative_entry(self):
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        self.db.put('10.0.0.1', SHA1, 'secret')
+        self.assertEqual(self.db.get('10.0.0.1'), SHA1)
+        self.assertEqual(self.cache.invalidations, 1)
+
+    def test_remove_caches_missing_client(self):
+        self.db.put('10.0.0.1', SHA1, 'secret')
+        self.assertEqual(self.db.get('10.0.0.1'), SHA1)
+        self.db.remove('10.0.0.1', 'secret')
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        self.assertEqual(self.cache.lookup('10.0.0.1'), (True, None))
+
+    def test_unpublished_change(self):
+        self.db.autocommit = False
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        self.db.put('10.0.0.1', SHA1, 'secret')
+        # The negative entry is kept until the change is published
+        self.assertRaises(HashDoesNotExistError, self.db.get, '10.0.0.1')
+        self.db.commit()
+        self.assertEqual(self.db.get('10.0.0.1'), SHA1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import socket
+import threading
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from TinyIDS import config
+from TinyIDS.client import ServerConnection
+from TinyIDS.util import format_frame, read_message
+
+
+class StubClient:
+    """Provides the attributes of TinyIDSClient that ServerConnection uses."""
+
+    command = 'CHECK'
+    debug_protocol = False
+    keys_dir = '/nonexistent'
+
+    def __init__(self, port):
+        self.cfg = config.TinyIDSConfigParser()
+        self.cfg.add_section('server__test')
+        self.cfg.set('server__test', 'host', '127.0.0.1')
+        self.cfg.set('server__test', 'port', str(port))
+        self.server_timeouts = {'server__test': (5, 5)}
+
+    def _get_server_canonical_name(self, section):
+        return section[len('server__'):]
+
+
+class StubServer:
+    """Accepts connections in a thread and passes each one to 'handler',
+    which is called with the file of the connection. The messages that
+    were received are kept in self.received as (data, framed) tuples."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.received = []
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            f = conn.makefile('r+b', 0)
+            try:
+                self.handler(self, f)
+            finally:
+                f.close()
+                conn.close()
+
+    def read(self, f):
+        message = read_message(f, 1024)
+        if message[0] is not None:
+            self.received.append(message)
+        return message
+
+    def close(self):
+        self.sock.close()
+
+
+def legacy_handler(server, f):
+    # Protocol revision 2: one plain line per connection
+    data, framed = server.read(f)
+    if framed:
+        f.write('500 Invalid command\r\n')
+    else:
+        f.write('200 OK\r\n')
+
+def closing_handler(server, f):
+    # Old servers that close the connection on unknown input
+    data, framed = server.read(f)
+    if not framed:
+        f.write('200 OK\r\n')
+
+def framed_handler(server, f):
+    while True:
+        data, framed = server.read(f)
+        if data is None:
+            return
+        f.write(format_frame('200 OK'))
+
+
+class RevisionFallbackTestCase(unittest.TestCase):
+
+    def _request(self, handler, commands):
+        server = StubServer(handler)
+        try:
+            conn = ServerConnection(StubClient(server.port), 'server__test')
+            try:
+                responses = [conn._request(data) for data in commands]
+            finally:
+                conn.close()
+            return conn, server, responses
+        finally:
+            server.close()
+
+    def test_revision_3(self):
+        conn, server, responses = self._request(framed_handler, ['CHECK a', 'CHECK b'])
+        self.assertEqual(conn.revision, config.PROTOCOL_REVISION)
+        self.assertEqual(responses, ['200 OK', '200 OK'])
+        # The TEST command is pipelined and the connection is reused
+        self.assertEqual(server.received, [('TEST 3', True), ('CHECK a', True), ('CHECK b', True)])
+        self.assertEqual(server.connections, 1)
+
+    def test_plain_response(self):
+        conn, server, responses = self._request(legacy_handler, ['CHECK a', 'CHECK b'])
+        self.assertEqual(conn.revision, config.LEGACY_PROTOCOL_REVISION)
+        self.assertEqual(responses, ['200 OK', '200 OK'])
+        # The negotiation is not repeated once the revision is known
+        self.assertEqual(server.received, [('TEST 3', True), ('CHECK a', False), ('CHECK b', False)])
+        self.assertEqual(server.connections, 3)
+
+    def test_closed_connection(self):
+        conn, server, responses = self._request(closing_handler, ['CHECK a'])
+        self.assertEqual(conn.revision, config.LEGACY_PROTOCOL_REVISION)
+        self.assertEqual(responses, ['200 OK'])
+        self.assertEqual(server.received, [('TEST 3', True), ('CHECK a', False)])
+
+    def test_test_command(self):
+        # TEST is sent once with the revision the server speaks
+        conn, server, responses = self._request(legacy_handler, ['TEST 3'])
+        self.assertEqual(server.received, [('TEST 3', True), ('TEST 2', False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
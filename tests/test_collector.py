@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from TinyIDS.collector import FileScan
+
+
+class FileScanExpandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for name in ('bin/ls', 'bin/cp', 'bin/.hidden', 'sbin/init', 'lib/libc.so'):
+            self._write(name)
+        os.mkdir(os.path.join(self.root, 'bin', 'subdir'))
+        os.symlink(os.path.join(self.root, 'sbin', 'init'), os.path.join(self.root, 'bin', 'init'))
+        os.symlink(os.path.join(self.root, 'missing'), os.path.join(self.root, 'bin', 'broken'))
+        self.scan = FileScan()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        try:
+            f.write(name)
+        finally:
+            f.close()
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def _expand(self, name):
+        return sorted([path for path, st in self.scan.expand(self._path(name))])
+
+    def test_regular_files_only(self):
+        # Directories and broken symbolic links are skipped, links to
+        # regular files are followed, hidden files are not matched by '*'
+        self.assertEqual(self._expand('bin/*'),
+            [self._path('bin/cp'), self._path('bin/init'), self._path('bin/ls')])
+
+    def test_hidden_files(self):
+        self.assertEqual(self._expand('bin/.*'), [self._path('bin/.hidden')])
+
+    def test_same_paths_as_glob(self):
+        for pattern in ('*/*', '*bin/*', 'bin/[cl]*', 'lib/libc.so', 'lib/missing'):
+            expected = sorted([path for path in glob.glob(self._path(pattern)) if os.path.isfile(path)])
+            self.assertEqual(self._expand(pattern), expected, pattern)
+
+    def test_stat_results(self):
+        for path, st in self.scan.expand(self._path('*/*')):
+            self.assertEqual(st, os.stat(path))
+
+    def test_cached(self):
+        entries = self.scan.expand(self._path('bin/*'))
+        listdir_calls, stat_calls = self.scan.listdir_calls, self.scan.stat_calls
+        self.assertTrue(self.scan.expand(self._path('bin/*')) is entries)
+        self.assertEqual((self.scan.listdir_calls, self.scan.stat_calls), (listdir_calls, stat_calls))
+
+    def test_directories_listed_once(self):
+        self.scan.expand(self._path('bin/*'))
+        self.scan.expand(self._path('bin/c*'))
+        self.scan.expand(self._path('*/*'))
+        # The root and each of the three directories
+        self.assertEqual(self.scan.listdir_calls, 4)
+
+    def test_changes_after_expansion(self):
+        # The results of a scan do not change during a run
+        self.scan.expand(self._path('bin/*'))
+        self._write('bin/mv')
+        self.assertEqual(self._expand('bin/m*'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
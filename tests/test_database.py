@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from TinyIDS import database
+from TinyIDS.database import HashDatabase, LAST_CHECK_INTERVAL
+
+
+SHA1 = 'a' * 40
+
+
+class FakeTime:
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class CheckTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = HashDatabase(os.path.join(self.tmp_dir, 'tinyids.db'), engine='anydbm')
+        self.db.database_activate()
+        self.clock = FakeTime(time.time())
+        database.time = self.clock
+
+    def tearDown(self):
+        database.time = time
+        self.db.database_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _last_check(self, client_ip):
+        return self.db._read(client_ip, latest=True)[4]
+
+    def _check_later(self, client_ip, seconds):
+        self.clock.now += seconds
+        self.db.check(client_ip)
+        return int(self.clock.now)
+
+    def test_last_check(self):
+        self.db.put('10.0.0.1', SHA1, 'secret')
+        first = self._check_later('10.0.0.1', LAST_CHECK_INTERVAL + 400)
+        self.assertEqual(self._last_check('10.0.0.1'), first)
+        # Checks within the interval are not stored
+        self._check_later('10.0.0.1', 10)
+        self.assertEqual(self._last_check('10.0.0.1'), first)
+        second = self._check_later('10.0.0.1', LAST_CHECK_INTERVAL + 400)
+        self.assertEqual(self._last_check('10.0.0.1'), second)
+        self.assertEqual(self.db._unpublished, {})
+
+    def test_batched_commit(self):
+        # As in the prefork master, which commits once for all requests
+        self.db.autocommit = False
+        self.db.put('10.0.0.1', SHA1, 'secret')
+        self.db.commit()
+        self._check_later('10.0.0.1', LAST_CHECK_INTERVAL + 400)
+        second = self._check_later('10.0.0.1', LAST_CHECK_INTERVAL + 400)
+        # The unpublished time of the first check is replaced
+        self.assertEqual(self._last_check('10.0.0.1'), second)
+        self.db.commit()
+        self.assertEqual(self.db._unpublished, {})
+        self.assertEqual(self._last_check('10.0.0.1'), second)
+
+    def test_pending_update(self):
+        self.db.autocommit = False
+        self.db.put('10.0.0.1', SHA1, 'secret')
+        self.db.commit()
+        self.db.put('10.0.0.1', 'b' * 40, 'secret')
+        self._check_later('10.0.0.1', LAST_CHECK_INTERVAL + 400)
+        # The update is not replaced by the time of the check
+        self.db.commit()
+        self.assertEqual(self.db.get('10.0.0.1'), 'b' * 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
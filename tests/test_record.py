@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from TinyIDS.record import pack_ip, pack_record, unpack_record, build_index, RecordIndex
+from TinyIDS.record import SLOT_SEQUENCE
+
+
+SHA1 = 'a' * 40
+PASSPHRASE = 'f' * 40
+
+
+def make_record(digest, last_update=0):
+    return pack_record({'sha1': digest}, {}, PASSPHRASE, last_update, 0)
+
+
+class RecordTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        backend_digests = {'bindata': {'sha1': 'b' * 40, 'sha256': 'c' * 64}, 'kernel': {'whirlpool': 'd' * 128}}
+        record = pack_record({'sha1': SHA1}, backend_digests, PASSPHRASE, 10, 20)
+        self.assertEqual(unpack_record(record), ({'sha1': SHA1}, backend_digests, PASSPHRASE, 10, 20))
+
+    def test_legacy_record(self):
+        self.assertEqual(unpack_record('%s____%s' % (SHA1, PASSPHRASE)),
+            ({'sha1': SHA1}, {}, PASSPHRASE, 0, 0))
+
+    def test_invalid_record(self):
+        record = make_record(SHA1)
+        self.assertRaises(ValueError, unpack_record, record[:-1])
+        self.assertRaises(ValueError, unpack_record, record + '\0')
+        self.assertRaises(ValueError, pack_record, {'sha1': SHA1}, {}, 'f' * 38, 0, 0)
+
+
+class RecordIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'tinyids.idx')
+        self.records = {
+            '10.0.0.1': make_record('1' * 40),
+            '10.0.0.2': make_record('2' * 40),
+            '::1': make_record('3' * 40),
+        }
+        build_index(self.path, [(pack_ip(ip), record) for ip, record in self.records.items()]
+            + [('not an ip', '%s____%s' % (SHA1, PASSPHRASE))])
+        self.writer = RecordIndex(self.path)
+        self.writer.open(writable=True)
+        self.reader = RecordIndex(self.path)
+        self.reader.open()
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lookup(self):
+        for ip, record in self.records.items():
+            self.assertEqual(self.reader.lookup(pack_ip(ip)), (True, record))
+        self.assertEqual(self.reader.lookup(pack_ip('10.0.0.3')), (False, None))
+        self.assertEqual(self.reader.slots, 3)
+
+    def test_legacy_key(self):
+        record = '%s____%s' % (SHA1, PASSPHRASE)
+        build_index(self.path, [('10.0.0.9', record)])
+        index = RecordIndex(self.path)
+        index.open()
+        self.assertEqual(index.lookup(pack_ip('10.0.0.9')), (True, record))
+        index.close()
+
+    def test_update(self):
+        key = pack_ip('10.0.0.1')
+        record = make_record('5' * 40, 100)
+        self.assertEqual(self.writer.update(key, record), True)
+        self.assertEqual(self.reader.lookup(key), (True, record))
+        self.assertEqual(self.writer.update(pack_ip('10.0.0.3'), record), False)
+
+    def test_removed(self):
+        key = pack_ip('10.0.0.1')
+        self.assertEqual(self.writer.update(key, None), True)
+        self.assertEqual(self.reader.lookup(key), (True, None))
+
+    def test_moved(self):
+        key = pack_ip('10.0.0.1')
+        record = pack_record({'sha1': SHA1}, {'bindata': {'sha512': 'e' * 128}}, PASSPHRASE, 0, 0)
+        self.assertEqual(self.writer.update(key, record), False)
+        # The record is read from the storage engine instead
+        self.assertEqual(self.reader.lookup(key), (False, None))
+
+    def test_slot_being_written(self):
+        key = pack_ip('10.0.0.1')
+        offset = self.writer._find(key)
+        sequence = SLOT_SEQUENCE.unpack_from(self.writer.map, offset)[0]
+        SLOT_SEQUENCE.pack_into(self.writer.map, offset, sequence + 1)
+        self.assertEqual(self.reader.lookup(key), (False, None))
+        SLOT_SEQUENCE.pack_into(self.writer.map, offset, sequence + 2)
+        self.assertEqual(self.reader.lookup(key), (True, self.records['10.0.0.1']))
+
+    def test_concurrent_updates(self):
+        key = pack_ip('10.0.0.1')
+        # Records of different lengths, so that torn reads do not unpack
+        records = [make_record('6' * 40), pack_record({'sha1': '7' * 40, 'md5': '8' * 32}, {}, PASSPHRASE, 0, 0)]
+        expected = records + [self.records['10.0.0.1']]
+        done = []
+        def update():
+            for i in xrange(20000):
+                self.writer.update(key, records[i % 2])
+            done.append(True)
+        thread = threading.Thread(target=update)
+        thread.start()
+        try:
+            while not done:
+                found, record = self.reader.lookup(key)
+                if found:
+                    self.assertTrue(record in expected)
+        finally:
+            thread.join()
+        self.assertEqual(self.reader.lookup(key), (True, records[1]))
+
+    def test_rebuilt(self):
+        key = pack_ip('10.0.0.9')
+        record = make_record('9' * 40)
+        build_index(self.path, [(key, record)])
+        self.assertEqual(self.reader.lookup(key), (False, None))
+        self.writer.mark_stale()
+        # The reader opens the new index
+        self.assertEqual(self.reader.lookup(key), (True, record))
+        self.assertEqual(self.reader.is_stale(), False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from TinyIDS.storage import MemoryEngine, LOG_PUT, LOG_DELETE
+from TinyIDS.storage import _format_log_record, _replay_log
+
+
+class ReplayLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = (_format_log_record(LOG_PUT, 'a', '1') + _format_log_record(LOG_PUT, 'b', '2')
+            + _format_log_record(LOG_DELETE, 'a'))
+
+    def test_replay(self):
+        records = {'c': '3'}
+        self.assertEqual(_replay_log(records, self.data), len(self.data))
+        self.assertEqual(records, {'b': '2', 'c': '3'})
+
+    def test_torn_record(self):
+        record = _format_log_record(LOG_PUT, 'c', '3')
+        # Every incomplete write of the last record is discarded
+        for i in range(len(record)):
+            records = {}
+            self.assertEqual(_replay_log(records, self.data + record[:i]), len(self.data))
+            self.assertEqual(records, {'b': '2'})
+
+    def test_corrupt_record(self):
+        record = _format_log_record(LOG_PUT, 'c', '3')
+        corrupt = record[:-1] + '4'
+        records = {}
+        self.assertEqual(_replay_log(records, self.data + corrupt + record), len(self.data))
+        self.assertEqual(records, {'b': '2'})
+
+    def test_unknown_operation(self):
+        records = {}
+        data = self.data + _format_log_record(9, 'c', '3')
+        self.assertEqual(_replay_log(records, data), len(self.data))
+        self.assertEqual(records, {'b': '2'})
+
+
+class MemoryEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'tinyids.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _open(self, **options):
+        options.setdefault('commit_delay', 0)
+        db = MemoryEngine(self.path, **options)
+        db.open()
+        return db
+
+    def _reopen(self, db, **options):
+        db.close()
+        db = self._open(**options)
+        records = dict(db.iteritems())
+        db.close()
+        return records
+
+    def test_reopen(self):
+        db = self._open()
+        db.put('a', '1')
+        db.put('b', '2')
+        db.put('a', '3')
+        db.delete('b')
+        db.delete('c')
+        db.commit()
+        self.assertEqual(self._reopen(db), {'a': '3'})
+        self.assertEqual(os.path.exists(self.path), False)
+
+    def test_unpublished_change(self):
+        db = self._open(commit_delay=0.5)
+        db.put('a', '1')
+        # The change is not visible until it is on the disk
+        self.assertEqual(db.get('a'), None)
+        db.commit()
+        self.assertEqual(db.get('a'), '1')
+        db.close()
+
+    def test_torn_tail(self):
+        db = self._open()
+        db.put('a', '1')
+        db.commit()
+        db.close()
+        size = os.path.getsize(self.path + '.log')
+        f = open(self.path + '.log', 'ab')
+        f.write(_format_log_record(LOG_PUT, 'b', '2')[:-1])
+        f.close()
+        db = self._open()
+        # The incomplete record is truncated, so later changes are not lost
+        self.assertEqual(os.path.getsize(self.path + '.log'), size)
+        db.put('c', '3')
+        db.commit()
+        self.assertEqual(self._reopen(db), {'a': '1', 'c': '3'})
+
+    def test_snapshot(self):
+        db = self._open(snapshot_log_size=100)
+        expected = {}
+        for i in range(50):
+            key, value = 'key%d' % i, 'value%d' % i
+            db.put(key, value)
+            db.commit()
+            expected[key] = value
+        db.delete('key0')
+        db.commit()
+        del expected['key0']
+        db.close()
+        self.assertEqual(os.path.exists(self.path), True)
+        self.assertEqual(os.path.exists(self.path + '.log.old'), False)
+        db = self._open()
+        self.assertEqual(dict(db.iteritems()), expected)
+        db.close()
+
+    def test_interrupted_snapshot(self):
+        db = self._open()
+        db.put('a', '1')
+        db.put('b', '2')
+        db.commit()
+        db.close()
+        # The server crashed after the log was rotated, before the snapshot
+        # was written
+        os.rename(self.path + '.log', self.path + '.log.old')
+        f = open(self.path + '.log', 'wb')
+        f.write(_format_log_record(LOG_DELETE, 'a') + _format_log_record(LOG_PUT, 'b', '3'))
+        f.close()
+        db = self._open()
+        self.assertEqual(dict(db.iteritems()), {'b': '3'})
+        self.assertEqual(os.path.exists(self.path + '.log.old'), False)
+        self.assertEqual(os.path.getsize(self.path + '.log'), 0)
+        self.assertEqual(self._reopen(db), {'b': '3'})
+
+
+if __name__ == '__main__':
+    unittest.main()
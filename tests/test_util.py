@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of TinyIDS.
+#
+#  TinyIDS is a distributed Intrusion Detection System (IDS) for Unix systems.
+#
+#  Project development web site:
+#
+#      http://www.codetrax.org/projects/tinyids
+#
+#  Copyright (c) 2010 George Notaras, G-Loaded.eu, CodeTRAX.org
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import sys
+import os
+import unittest
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/')] + sys.path
+
+from StringIO import StringIO
+
+from TinyIDS.util import format_digests, parse_digests
+from TinyIDS.util import format_digest_vector, parse_digest_vector, compare_digests
+from TinyIDS.util import format_frame, read_message, get_message_length, FrameError
+
+
+SHA1 = 'a' * 40
+SHA256 = 'b' * 64
+
+
+class DigestVectorTestCase(unittest.TestCase):
+
+    def test_checksum_only(self):
+        # Understood by servers that do not support per-backend digests
+        self.assertEqual(format_digest_vector(SHA1, []), SHA1)
+        self.assertEqual(parse_digest_vector(SHA1), ({'sha1': SHA1}, {}))
+
+    def test_round_trip(self):
+        checksum = format_digests([('sha1', SHA1), ('sha256', SHA256)])
+        backends = [('kernel', format_digests([('sha1', '1' * 40)])),
+            ('bindata', format_digests([('sha1', '2' * 40), ('sha256', '3' * 64)]))]
+        data = format_digest_vector(checksum, backends)
+        # Backends are sorted by name
+        self.assertEqual(data, 'sha1:%s,sha256:%s;bindata=sha1:%s,sha256:%s;kernel=%s' % (
+            SHA1, SHA256, '2' * 40, '3' * 64, '1' * 40))
+        digests, backend_digests = parse_digest_vector(data)
+        self.assertEqual(digests, {'sha1': SHA1, 'sha256': SHA256})
+        self.assertEqual(backend_digests, {
+            'bindata': {'sha1': '2' * 40, 'sha256': '3' * 64},
+            'kernel': {'sha1': '1' * 40},
+        })
+
+    def test_backends_only(self):
+        data = format_digest_vector(None, [('kernel', SHA1)])
+        self.assertEqual(data, ';kernel=%s' % SHA1)
+        self.assertEqual(parse_digest_vector(data), (None, {'kernel': {'sha1': SHA1}}))
+
+    def test_case_insensitive(self):
+        self.assertEqual(parse_digest_vector('SHA256:%s' % SHA256.upper()), ({'sha256': SHA256}, {}))
+
+    def test_invalid(self):
+        for data in ('', ';', '%s;' % SHA1, '%s;kernel' % SHA1, '%s;ker nel=%s' % (SHA1, SHA1),
+                '%s;kernel=%s;kernel=%s' % (SHA1, SHA1, SHA1), 'xyz', 'sha1:%s,sha1:%s' % (SHA1, SHA1),
+                'sha!:%s' % SHA1, ';kernel='):
+            self.assertRaises(ValueError, parse_digest_vector, data)
+
+    def test_compare_common_algorithms(self):
+        digests = parse_digests('sha1:%s,sha256:%s' % (SHA1, SHA256))
+        self.assertEqual(compare_digests(digests, {'sha1': SHA1}), True)
+        self.assertEqual(compare_digests(digests, {'sha256': 'c' * 64}), False)
+        self.assertEqual(compare_digests(digests, {'md5': 'd' * 32}), None)
+
+
+class FrameTestCase(unittest.TestCase):
+
+    def test_format(self):
+        self.assertEqual(format_frame('CHECK x'), '#7\r\nCHECK x\r\n')
+        self.assertEqual(format_frame(''), '#0\r\n\r\n')
+
+    def test_round_trip(self):
+        # Frames may contain line ends
+        data = 'a\r\nb\nc'
+        f = StringIO(format_frame(data))
+        self.assertEqual(read_message(f, 1024), (data, True))
+        self.assertEqual(read_message(f, 1024), (None, False))
+
+    def test_plain_line(self):
+        # Protocol revision 2
+        f = StringIO('TEST 2\r\n')
+        self.assertEqual(read_message(f, 1024), ('TEST 2', False))
+        self.assertEqual(read_message(f, 1024), (None, False))
+
+    def test_pipelined(self):
+        f = StringIO(format_frame('TEST 3') + format_frame('CHECK x') + 'TEST 2\r\n')
+        self.assertEqual(read_message(f, 1024), ('TEST 3', True))
+        self.assertEqual(read_message(f, 1024), ('CHECK x', True))
+        self.assertEqual(read_message(f, 1024), ('TEST 2', False))
+
+    def test_invalid_length(self):
+        for data in ('#\r\n', '#x\r\n', '#-1\r\n', '#2000\r\n' + 'a' * 2000 + '\r\n'):
+            self.assertRaises(FrameError, read_message, StringIO(data), 1024)
+
+    def test_truncated(self):
+        for data in ('#7\r\nCHECK', '#7\r\nCHECK x', '#7\r\nCHECK xyz\r\n'):
+            self.assertRaises(FrameError, read_message, StringIO(data), 1024)
+
+    def test_message_length(self):
+        frame = format_frame('CHECK x')
+        self.assertEqual(get_message_length(frame, 1024), len(frame))
+        self.assertEqual(get_message_length(frame + 'TEST 2\r\n', 1024), len(frame))
+        self.assertEqual(get_message_length('TEST 2\r\n' + frame, 1024), 8)
+        # Incomplete messages
+        for i in range(len(frame)):
+            self.assertEqual(get_message_length(frame[:i], 1024), 0)
+        self.assertEqual(get_message_length('TEST 2', 1024), 0)
+        # Invalid frames are complete after their first line
+        self.assertEqual(get_message_length('#x\r\nCHECK', 1024), 4)
+        # Lines are not longer than max_len
+        self.assertEqual(get_message_length('a' * 20, 10), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()